@@ -62,9 +62,11 @@ titles = {
 'exec': 'Execute commands through the pcocc guest agent',
 'display': 'Display the graphical output of a VM',
 'reset': 'Reset a VM',
+'recycle': 'Revert a VM to a recorded state',
 'ckpt': 'Checkpoint a virtual cluster',
 'dump': 'Dump the memory of a VM to a file',
 'monitor-cmd': 'Send a command to the monitor',
+'io-throttle': 'Show or adjust the I/O limits of a VM',
 'save': 'Save the disk of a VM',
 'batch.yaml': 'Batch environment configuration file',
 'networks.yaml': 'Networks configuration file',
@@ -27,6 +27,7 @@ import subprocess
 import sys
 import random
 import datetime
+import time
 import logging
 import jsonschema
 import etcd
@@ -119,6 +120,16 @@ properties:
           - password
           - munge
           - none
+      launch-concurrency:
+        type: object
+        additionalProperties:
+          type: integer
+          minimum: 1
+      checkpoint-concurrency:
+        type: object
+        additionalProperties:
+          type: integer
+          minimum: 1
     additionalProperties: false
     required:
       - etcd-servers
@@ -186,6 +197,15 @@ class BatchManager(object):
 
         self.proc_type = proc_type
 
+        # Maximum number of VMs of a job concurrently opening images
+        # or restoring memory from each filesystem
+        self.launch_concurrency = settings.get('launch-concurrency', {})
+
+        # Maximum number of VMs of a job concurrently writing
+        # checkpoints to each filesystem
+        self.checkpoint_concurrency = settings.get('checkpoint-concurrency',
+                                                   {})
+
         # "abstract" properties
         self.batchid = 0
         self.batchuser = None
@@ -218,10 +238,25 @@ class BatchManager(object):
         """Called on each node at the resource deletion step"""
         raise PcoccError("Not implemented")
 
-    def batch(self, cluster, alloc_opt, cmd):
-        """Allocate a batch job"""
+    def batch(self, cluster, alloc_opt, cmd, warning=None, requeue=False):
+        """Allocate a batch job
+
+        warning is a (signal, seconds) tuple requesting the batch
+        script to receive signal this number of seconds before the job
+        is terminated. If requeue is set, the job may be requeued.
+
+        """
         raise PcoccError("Not implemented")
 
+    def requeue(self):
+        """Requeue the current batch job"""
+        raise PcoccError("Not implemented")
+
+    @property
+    def restart_count(self):
+        """Returns how many times the current job was requeued"""
+        return 0
+
     def init_node(self):
         """Called on each node at the init step"""
         pass
@@ -368,6 +403,25 @@ class EtcdManager(BatchManager):
         """ Return path to store cluster state file """
         return os.path.join(self.cluster_state_dir, name)
 
+    def get_node_cache_path(self, name):
+        """ Return path to store node-local data shared between jobs """
+        cache_dir = '/tmp/.pcocc_%s_cache' % (self.batchuser)
+        try:
+            os.mkdir(cache_dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise PcoccError('Failed to create node cache directory: '
+                                 + str(e))
+
+        # The path is predictable, make sure nobody else created it
+        st = os.lstat(cache_dir)
+        if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+            raise PcoccError('Node cache directory {0} has unsafe '
+                             'ownership or permissions'.format(cache_dir))
+
+        return os.path.join(cache_dir, name)
+
     def _get_vm_state_dir(self, rank):
         return '%s_%d' % (self.vm_state_dir_prefix, rank)
 
@@ -558,8 +612,14 @@ class EtcdManager(BatchManager):
                 return None, e.payload['index']
 
     @_retry_on_cred_expiry
-    def wait_child_count(self, key_type, key, count):
-        """Wait until a directory has the specified number of elements"""
+    def wait_child_count(self, key_type, key, count, timeout=0):
+        """Wait until a directory has the specified number of elements
+
+        If timeout is set, a KeyTimeoutError is raised if the directory
+        doesn't reach this number of elements within timeout seconds.
+
+        """
+        deadline = time.time() + timeout
         while True:
             ret, last_index  = self.read_dir_index(key_type, key)
             if ret:
@@ -570,7 +630,13 @@ class EtcdManager(BatchManager):
             if num_complete == count:
                 return ret
 
-            self.wait_key_index(key_type, key, last_index, timeout=30)
+            wait = 30
+            if timeout:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    raise KeyTimeoutError(self.get_key_path(key_type, key))
+
+            self.wait_key_index(key_type, key, last_index, timeout=wait)
 
 
     def get_key_path(self, key_type, key):
@@ -1568,17 +1634,38 @@ class SlurmManager(EtcdManager):
 
         return ret
 
-    def batch(self, cluster, alloc_opt, cmd):
+    def batch(self, cluster, alloc_opt, cmd, warning=None, requeue=False):
         """Allocate a batch job"""
+        if warning:
+            # Only the batch script gets the warning, not the VMs
+            signal_opt = ['--signal', 'B:{0}@{1}'.format(*warning)]
+        else:
+            signal_opt = ['--signal', '15']
+        if requeue:
+            signal_opt.append('--requeue')
+
         try:
             if self._etcd_auth_type == 'password':
                 os.environ['PCOCC_REQUEST_CRED'] = self._get_keyval_credential()
             os.environ['SLURM_DISTRIBUTION'] = 'block:block'
-            subprocess.check_call(['sbatch'] + ['-J', 'pcocc',
-                                                '--signal', '15'] + alloc_opt + [cmd])
+            subprocess.check_call(['sbatch'] + ['-J', 'pcocc'] + signal_opt +
+                                  alloc_opt + [cmd])
         except subprocess.CalledProcessError as err:
             raise AllocationError(str(err))
 
+    def requeue(self):
+        """Requeue the current batch job"""
+        self._only_in_a_job()
+        try:
+            subprocess.check_call(['scontrol', 'requeue', str(self.batchid)])
+        except (OSError, subprocess.CalledProcessError) as err:
+            raise BatchError('unable to requeue job: {0}'.format(err))
+
+    @property
+    def restart_count(self):
+        """Returns how many times the current job was requeued"""
+        return int(os.environ.get('SLURM_RESTART_COUNT', 0))
+
     @property
     def task_rank(self):
         """Returns the rank of the current process in the SLURM job
@@ -0,0 +1,956 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Striped and compressed memory images of checkpoints
+
+The migration stream of a VM is cut into fixed size chunks which are
+distributed round-robin to several stripe files, each with its own
+compressor process. A manifest describes the codec and the stripes so
+that the stream can be reassembled by decompressing all the stripes in
+parallel.
+
+When the guest RAM is backed by a file, it is saved apart from the
+migration stream as a delta against the previous checkpoint of the
+VM: only blocks whose digest changed are written, at their offset in
+a sparse data file, and the manifest references the manifest of its
+base. Restoring a VM composes the chain of deltas back into a RAM file.
+The data file of a delta without a base is an image of the whole RAM
+which may be mapped directly.
+
+Checkpoints may be staged on node-local storage first. A staging
+record in the checkpoint directory maps the local files to their final
+paths until they are drained, at which point a marker is written.
+
+Checkpoints may also be deduplicated: memory images, RAM deltas and
+disk images are then cut into chunks which are stored once per
+checkpoint directory under their digest, the manifests listing the
+digests of their chunks. Chunks are hashed and fetched by several
+threads in parallel.
+
+Periodic checkpoints are rotated in a parent directory where only the
+most recent ones are kept, the latest being pointed to by a symbolic
+link. The duration of recent checkpoints is recorded there to estimate
+how long the next one will take.
+
+"""
+
+import os
+import re
+import glob
+import errno
+import shutil
+import hashlib
+import Queue
+import tempfile
+import threading
+import subprocess
+
+import yaml
+
+from .Error import PcoccError
+
+DEFAULT_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Number of chunks buffered for each stripe
+QUEUE_DEPTH = 2
+
+# Compression command, decompression command and file extension
+CODECS = {'lzop': (['lzop', '-c'], ['lzop', '-dc'], '.lzo'),
+          'zstd': (['zstd', '-q', '-c'], ['zstd', '-q', '-dc'], '.zst'),
+          'none': (None, None, '')}
+
+CODEC_LEVELS = {'lzop': (1, 9), 'zstd': (1, 19)}
+
+# Granularity at which RAM deltas are computed
+RAM_BLOCK_SIZE = 2 * 1024 * 1024
+
+# Granularity at which checkpoint images are deduplicated
+DEDUP_CHUNK_SIZE = 1024 * 1024
+
+# Number of threads hashing or fetching chunks by default
+DEDUP_WORKERS = 4
+
+# Directory of a checkpoint holding its unique chunks
+CHUNK_STORE = 'chunks'
+
+# Names of rotated checkpoints and of the link to the latest one
+ROTATION_PATTERN = re.compile(r'^ckpt-(\d+)$')
+ROTATION_LATEST = 'latest'
+
+# Durations of the last checkpoints of a rotation directory
+CKPT_TIMES = 'ckpt-times.yaml'
+CKPT_TIMES_KEPT = 5
+
+# Time for checkpointing when there is no history, and slack added to
+# estimates, in seconds
+DEFAULT_CKPT_TIME = 600
+CKPT_TIME_MARGIN = 60
+
+class CheckpointImageError(PcoccError):
+    """Exception raised when a checkpoint memory image cannot be handled
+    """
+    def __init__(self, error):
+        super(CheckpointImageError, self).__init__(
+            'Checkpoint memory image error: ' + error)
+
+def codec_commands(codec, level=None, threads=None):
+    """Returns the compression and decompression commands of a codec"""
+    try:
+        compress, decompress, _ = CODECS[codec]
+    except KeyError:
+        raise CheckpointImageError('unknown codec: {0}'.format(codec))
+
+    if compress is None:
+        return None, None
+
+    compress = list(compress)
+    if level:
+        compress.append('-{0}'.format(level))
+    if codec == 'zstd' and threads is not None:
+        compress.append('-T{0}'.format(threads))
+
+    return compress, list(decompress)
+
+def memory_layout(prefix, dirs, settings):
+    """Returns the manifest of a memory image with the given settings
+
+    Stripes are spread over dirs in a round-robin fashion and named
+    after prefix.
+
+    """
+    codec = settings.get('codec', 'lzop')
+    stripes = settings.get('stripes', 1)
+    if settings.get('dedup'):
+        # Chunks are stored next to the manifest, stripes set the
+        # number of threads storing them
+        return {'codec': 'none',
+                'chunk-size': DEDUP_CHUNK_SIZE,
+                'workers': stripes,
+                'store': CHUNK_STORE,
+                'stripes': []}
+
+    ext = CODECS[codec][2]
+
+    return {'codec': codec,
+            'level': settings.get('level'),
+            'threads': settings.get('threads'),
+            'chunk-size': settings.get('chunk-size', DEFAULT_CHUNK_SIZE),
+            'stripes': [os.path.join(dirs[i % len(dirs)],
+                                     '{0}.{1}{2}'.format(prefix, i, ext))
+                        for i in xrange(stripes)]}
+
+def save_manifest(path, manifest):
+    """Atomically writes the manifest of a memory image or RAM delta"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            yaml.safe_dump(manifest, f, default_flow_style=False)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise CheckpointImageError(str(err))
+
+def load_manifest(path, required=False):
+    """Returns the manifest of a memory image
+
+    Returns None if it doesn't exist unless required is set.
+
+    """
+    try:
+        with open(path, 'r') as f:
+            manifest = yaml.safe_load(f)
+    except IOError as err:
+        if err.errno == errno.ENOENT and not required:
+            return None
+        raise CheckpointImageError(str(err))
+    except yaml.YAMLError as err:
+        raise CheckpointImageError(str(err))
+
+    if (not isinstance(manifest, dict) or
+        not (manifest.get('stripes') or manifest.get('store')) or
+        not manifest.get('codec') in CODECS):
+        raise CheckpointImageError('invalid manifest {0}'.format(path))
+
+    return manifest
+
+def _read_full(fd, size):
+    chunks = []
+    while size > 0:
+        data = os.read(fd, size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return ''.join(chunks)
+
+def _write_full(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _start_pipeline(cmd, stdin, stdout):
+    try:
+        return subprocess.Popen(cmd, stdin=stdin, stdout=stdout,
+                                close_fds=True)
+    except OSError as err:
+        raise CheckpointImageError('unable to run {0}: {1}'.format(
+                cmd[0], err))
+
+def stripe_write(manifest, in_fd):
+    """Stripes and compresses a stream into the files of a manifest"""
+    compress, _ = codec_commands(manifest['codec'], manifest.get('level'),
+                                 manifest.get('threads'))
+    chunk_size = manifest['chunk-size']
+    errors = []
+    procs = []
+    threads = []
+    queues = []
+
+    def _drain(queue, fd):
+        failed = False
+        while True:
+            data = queue.get()
+            if data is None:
+                break
+            # Keep consuming on errors so that the reader never blocks
+            if failed:
+                continue
+            try:
+                _write_full(fd, data)
+            except OSError as err:
+                errors.append(str(err))
+                failed = True
+        os.close(fd)
+
+    try:
+        for path in manifest['stripes']:
+            with open(path, 'wb') as f:
+                if compress:
+                    r_fd, w_fd = os.pipe()
+                    procs.append(_start_pipeline(compress, r_fd, f))
+                    os.close(r_fd)
+                else:
+                    w_fd = os.dup(f.fileno())
+
+            queue = Queue.Queue(QUEUE_DEPTH)
+            thread = threading.Thread(target=_drain, args=(queue, w_fd))
+            thread.daemon = True
+            thread.start()
+            queues.append(queue)
+            threads.append(thread)
+
+        i = 0
+        while True:
+            data = _read_full(in_fd, chunk_size)
+            if data:
+                queues[i % len(queues)].put(data)
+            if len(data) < chunk_size:
+                break
+            i += 1
+    except (IOError, OSError) as err:
+        errors.append(str(err))
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    for proc in procs:
+        if proc.wait():
+            errors.append('compressor exited with status {0}'.format(
+                    proc.returncode))
+
+    if errors:
+        raise CheckpointImageError(errors[0])
+
+def stripe_read(manifest, out_fd):
+    """Reassembles a stream from the files of a manifest"""
+    _, decompress = codec_commands(manifest['codec'])
+    chunk_size = manifest['chunk-size']
+    errors = []
+    procs = []
+    queues = []
+
+    def _fill(queue, fd):
+        try:
+            while True:
+                data = _read_full(fd, chunk_size)
+                queue.put(data)
+                if len(data) < chunk_size:
+                    break
+        except OSError as err:
+            errors.append(str(err))
+            queue.put('')
+        os.close(fd)
+
+    try:
+        for path in manifest['stripes']:
+            with open(path, 'rb') as f:
+                if decompress:
+                    r_fd, w_fd = os.pipe()
+                    procs.append(_start_pipeline(decompress, f, w_fd))
+                    os.close(w_fd)
+                else:
+                    r_fd = os.dup(f.fileno())
+
+            queue = Queue.Queue(QUEUE_DEPTH)
+            thread = threading.Thread(target=_fill, args=(queue, r_fd))
+            thread.daemon = True
+            thread.start()
+            queues.append(queue)
+
+        i = 0
+        while True:
+            data = queues[i % len(queues)].get()
+            _write_full(out_fd, data)
+            if errors or len(data) < chunk_size:
+                break
+            i += 1
+    except (IOError, OSError) as err:
+        errors.append(str(err))
+
+    for proc in procs:
+        if proc.poll() is None:
+            proc.terminate()
+        elif proc.returncode and not errors:
+            errors.append('decompressor exited with status {0}'.format(
+                    proc.returncode))
+        proc.wait()
+
+    if errors:
+        raise CheckpointImageError(errors[0])
+
+def chunk_store_path(manifest_path, manifest):
+    """Returns the chunk store of a deduplicated image"""
+    return os.path.join(os.path.dirname(manifest_path), manifest['store'])
+
+def _chunk_path(store, digest):
+    return os.path.join(store, digest[:2], digest)
+
+def store_chunk(store, data):
+    """Stores a chunk unless already present and returns its digest
+
+    Zero chunks are never stored and have a None digest.
+
+    """
+    if data.count('\0') == len(data):
+        return None
+
+    digest = hashlib.sha1(data).hexdigest()
+    path = _chunk_path(store, digest)
+    if os.path.exists(path):
+        return digest
+
+    chunk_dir = os.path.dirname(path)
+    try:
+        os.makedirs(chunk_dir)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+    fd, tmp_path = tempfile.mkstemp(dir=chunk_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        # Other VMs may be storing the same chunk concurrently
+        try:
+            os.link(tmp_path, path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    finally:
+        os.unlink(tmp_path)
+
+    return digest
+
+def load_chunk(store, digest, size):
+    """Returns the data of a chunk of the given size"""
+    if digest is None:
+        return '\0' * size
+
+    try:
+        with open(_chunk_path(store, digest), 'rb') as f:
+            data = f.read()
+    except IOError as err:
+        raise CheckpointImageError('unable to read chunk: {0}'.format(err))
+
+    if len(data) != size:
+        raise CheckpointImageError('chunk {0} is corrupted'.format(digest))
+
+    return data
+
+def _store_stream(store, in_fd, chunk_size, workers):
+    """Stores a stream as chunks and returns their digests and its size"""
+    digests = {}
+    errors = []
+    threads = []
+    queue = Queue.Queue(workers * QUEUE_DEPTH)
+
+    def _store():
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            # Keep consuming on errors so that the reader never blocks
+            if errors:
+                continue
+            index, data = item
+            try:
+                digests[index] = store_chunk(store, data)
+            except (IOError, OSError) as err:
+                errors.append(str(err))
+
+    count = 0
+    size = 0
+    try:
+        for _ in xrange(workers):
+            thread = threading.Thread(target=_store)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        while not errors:
+            data = _read_full(in_fd, chunk_size)
+            if data:
+                queue.put((count, data))
+                count += 1
+                size += len(data)
+            if len(data) < chunk_size:
+                break
+    except (IOError, OSError) as err:
+        errors.append(str(err))
+    finally:
+        for _ in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise CheckpointImageError(errors[0])
+
+    return [digests[i] for i in xrange(count)], size
+
+def _load_stream(store, digests, chunk_size, size, out_fd, workers):
+    """Writes the chunks of a stream, fetched in parallel, to out_fd"""
+    workers = max(min(workers, len(digests)), 1)
+    errors = []
+    queues = []
+
+    def _fetch(queue, first):
+        try:
+            for index in xrange(first, len(digests), workers):
+                queue.put(load_chunk(store, digests[index],
+                                     min(chunk_size,
+                                         size - index * chunk_size)))
+        except CheckpointImageError as err:
+            errors.append(str(err))
+            queue.put(None)
+
+    for first in xrange(workers):
+        queue = Queue.Queue(QUEUE_DEPTH)
+        thread = threading.Thread(target=_fetch, args=(queue, first))
+        thread.daemon = True
+        thread.start()
+        queues.append(queue)
+
+    try:
+        for index in xrange(len(digests)):
+            data = queues[index % workers].get()
+            if data is None:
+                break
+            _write_full(out_fd, data)
+    except (IOError, OSError) as err:
+        errors.append(str(err))
+
+    if errors:
+        raise CheckpointImageError(errors[0])
+
+def dedup_write(manifest_path, in_fd):
+    """Stores a stream in the chunk store of a memory manifest
+
+    The digests of the chunks are added to the manifest.
+
+    """
+    manifest = load_manifest(manifest_path, True)
+    digests, size = _store_stream(chunk_store_path(manifest_path, manifest),
+                                  in_fd, manifest['chunk-size'],
+                                  manifest.get('workers') or DEDUP_WORKERS)
+    manifest['chunks'] = digests
+    manifest['size'] = size
+    save_manifest(manifest_path, manifest)
+
+def dedup_read(manifest_path, out_fd):
+    """Reassembles a stream from the chunk store of a memory manifest"""
+    manifest = load_manifest(manifest_path, True)
+    if 'chunks' not in manifest:
+        raise CheckpointImageError('incomplete memory image '
+                                   '{0}'.format(manifest_path))
+
+    _load_stream(chunk_store_path(manifest_path, manifest),
+                 manifest['chunks'], manifest['chunk-size'],
+                 manifest['size'], out_fd,
+                 manifest.get('workers') or DEDUP_WORKERS)
+
+def dedup_file(path, manifest_path, workers=DEDUP_WORKERS):
+    """Moves a file to the chunk store next to its manifest"""
+    manifest = {'store': CHUNK_STORE,
+                'chunk-size': DEDUP_CHUNK_SIZE}
+    try:
+        with open(path, 'rb') as f:
+            manifest['chunks'], manifest['size'] = _store_stream(
+                chunk_store_path(manifest_path, manifest), f.fileno(),
+                DEDUP_CHUNK_SIZE, workers)
+    except IOError as err:
+        raise CheckpointImageError(str(err))
+
+    save_manifest(manifest_path, manifest)
+    try:
+        os.unlink(path)
+    except OSError as err:
+        raise CheckpointImageError(str(err))
+
+def restore_file(manifest_path, path, workers=DEDUP_WORKERS):
+    """Rebuilds a file moved to a chunk store by dedup_file"""
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = yaml.safe_load(f)
+    except (IOError, yaml.YAMLError) as err:
+        raise CheckpointImageError(str(err))
+
+    if (not isinstance(manifest, dict) or
+        not all(key in manifest for key in ['store', 'chunk-size',
+                                            'chunks', 'size'])):
+        raise CheckpointImageError('invalid manifest {0}'.format(
+                manifest_path))
+
+    tmp_path = path + '.copy'
+    try:
+        with open(tmp_path, 'wb') as f:
+            _load_stream(chunk_store_path(manifest_path, manifest),
+                         manifest['chunks'], manifest['chunk-size'],
+                         manifest['size'], f.fileno(), workers)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        raise CheckpointImageError(str(err))
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+def load_ram_manifest(path):
+    """Returns the manifest of a RAM delta"""
+    try:
+        with open(path, 'r') as f:
+            manifest = yaml.safe_load(f)
+    except (IOError, yaml.YAMLError) as err:
+        raise CheckpointImageError(str(err))
+
+    if (not isinstance(manifest, dict) or
+        not all(key in manifest for key in ['size', 'block-size', 'hashes',
+                                            'blocks', 'data'])):
+        raise CheckpointImageError('invalid RAM manifest {0}'.format(path))
+
+    if manifest['data']:
+        manifest['data'] = os.path.join(os.path.dirname(path),
+                                        manifest['data'])
+    if manifest.get('store'):
+        manifest['store'] = chunk_store_path(path, manifest)
+    return manifest
+
+def ram_chain(path):
+    """Returns the manifests of a RAM delta and its bases, newest first"""
+    chain = []
+    while path:
+        if path in [m['path'] for m in chain]:
+            raise CheckpointImageError('loop in RAM deltas at {0}'.format(
+                    path))
+        manifest = load_ram_manifest(path)
+        manifest['path'] = path
+        chain.append(manifest)
+        path = manifest.get('base')
+
+    return chain
+
+def save_ram_delta(ram_path, manifest_path, base_path=None, dedup=False):
+    """Saves the blocks of a RAM file which differ from a base delta
+
+    Blocks are written at their own offset, or to the chunk store of
+    the checkpoint if dedup is set, and zero blocks are never written.
+    Returns the number of bytes written.
+
+    """
+    base_hashes = None
+    size = os.path.getsize(ram_path)
+    if base_path:
+        base = load_ram_manifest(base_path)
+        if base['size'] == size and base['block-size'] == RAM_BLOCK_SIZE:
+            base_hashes = base['hashes']
+        else:
+            base_path = None
+
+    if dedup:
+        data_path = None
+        store = os.path.join(os.path.dirname(manifest_path), CHUNK_STORE)
+    else:
+        data_path = os.path.splitext(manifest_path)[0] + '.delta'
+    hashes = []
+    blocks = []
+    data = None
+    try:
+        if data_path:
+            data = open(data_path, 'wb')
+        with open(ram_path, 'rb') as ram:
+            while True:
+                block = ram.read(RAM_BLOCK_SIZE)
+                if not block:
+                    break
+                index = len(hashes)
+                if block.count('\0') == len(block):
+                    hashes.append(None)
+                    continue
+
+                digest = hashlib.sha1(block).hexdigest()
+                hashes.append(digest)
+                if base_hashes and base_hashes[index] == digest:
+                    continue
+
+                if data:
+                    data.seek(index * RAM_BLOCK_SIZE)
+                    data.write(block)
+                else:
+                    store_chunk(store, block)
+                blocks.append(index)
+        if data:
+            data.truncate(size)
+    except (IOError, OSError) as err:
+        raise CheckpointImageError(str(err))
+    finally:
+        if data:
+            data.close()
+
+    save_manifest(manifest_path,
+                  {'size': size,
+                   'block-size': RAM_BLOCK_SIZE,
+                   'hashes': hashes,
+                   'blocks': blocks,
+                   'data': data_path and os.path.basename(data_path),
+                   'store': dedup and CHUNK_STORE or None,
+                   'base': base_path})
+
+    return len(blocks) * RAM_BLOCK_SIZE
+
+def compose_ram(manifest_path, ram_path, data_paths=None):
+    """Rebuilds a RAM file from a chain of RAM deltas
+
+    data_paths may map data files of the chain to local copies.
+
+    """
+    data_paths = data_paths or {}
+    chain = ram_chain(manifest_path)
+    head = chain[0]
+    if any(m['size'] != head['size'] or
+           m['block-size'] != head['block-size'] for m in chain):
+        raise CheckpointImageError('inconsistent RAM deltas in chain of '
+                                   '{0}'.format(manifest_path))
+
+    block_size = head['block-size']
+    # Newest layer holding each block
+    sources = {}
+    for layer, manifest in enumerate(chain):
+        for index in manifest['blocks']:
+            sources.setdefault(index, layer)
+
+    files = []
+    try:
+        # Deduplicated deltas have their blocks in a chunk store
+        files = [m['data'] and open(data_paths.get(m['data'], m['data']),
+                                    'rb')
+                 for m in chain]
+        with open(ram_path, 'wb') as ram:
+            ram.truncate(head['size'])
+            for index, digest in enumerate(head['hashes']):
+                if digest is None:
+                    continue
+                if index not in sources:
+                    raise CheckpointImageError(
+                        'block {0} missing from chain of {1}'.format(
+                            index, manifest_path))
+                layer = sources[index]
+                ram.seek(index * block_size)
+                if files[layer]:
+                    files[layer].seek(index * block_size)
+                    ram.write(files[layer].read(block_size))
+                else:
+                    ram.write(load_chunk(
+                            chain[layer]['store'], digest,
+                            min(block_size,
+                                head['size'] - index * block_size)))
+    except (IOError, OSError) as err:
+        raise CheckpointImageError(str(err))
+    finally:
+        for f in files:
+            if f:
+                f.close()
+
+def ram_image(manifest_path):
+    """Returns the data file of a delta if it is an image of the RAM"""
+    chain = ram_chain(manifest_path)
+    if len(chain) > 1:
+        return None
+    return chain[0]['data']
+
+def copy_files(files):
+    """Copies files to node-local paths given as a source to dest dict"""
+    try:
+        for src, dest in files.iteritems():
+            tmp_path = dest + '.copy'
+            shutil.copyfile(src, tmp_path)
+            os.rename(tmp_path, dest)
+    except (IOError, OSError) as err:
+        raise CheckpointImageError('unable to copy checkpoint: '
+                                   '{0}'.format(err))
+
+def checkpoint_bases(path):
+    """Returns the checkpoint directories the RAM deltas of path rely on"""
+    bases = set()
+    for manifest_path in glob.glob(os.path.join(path, 'ram-vm*.yaml')):
+        try:
+            chain = ram_chain(manifest_path)
+        except CheckpointImageError:
+            continue
+        bases.update(os.path.dirname(m['path']) for m in chain[1:])
+
+    bases.discard(path)
+    return bases
+
+def rotation_dirs(parent):
+    """Returns the rotated checkpoints in parent, oldest first"""
+    try:
+        names = os.listdir(parent)
+    except OSError as err:
+        raise CheckpointImageError(str(err))
+
+    dirs = []
+    for name in names:
+        match = ROTATION_PATTERN.match(name)
+        if match:
+            dirs.append((int(match.group(1)), os.path.join(parent, name)))
+
+    return [path for _, path in sorted(dirs)]
+
+def next_rotation_dir(parent):
+    """Creates the directory of the next rotated checkpoint in parent"""
+    dirs = rotation_dirs(parent)
+    if dirs:
+        index = int(ROTATION_PATTERN.match(
+                os.path.basename(dirs[-1])).group(1)) + 1
+    else:
+        index = 0
+
+    path = os.path.join(parent, 'ckpt-{0}'.format(index))
+    try:
+        os.mkdir(path)
+    except OSError as err:
+        raise CheckpointImageError(str(err))
+
+    return path
+
+def remove_checkpoint(path):
+    """Removes a checkpoint including stripes stored in other directories"""
+    for manifest_path in glob.glob(os.path.join(path, 'memory-vm*.yaml')):
+        try:
+            manifest = load_manifest(manifest_path)
+        except CheckpointImageError:
+            continue
+        for stripe in manifest['stripes']:
+            if os.path.dirname(stripe) != path:
+                try:
+                    os.unlink(stripe)
+                except OSError:
+                    pass
+
+    shutil.rmtree(path, ignore_errors=True)
+
+def remove_uncommitted(parent):
+    """Removes the rotated checkpoints newer than the latest one
+
+    Such checkpoints were interrupted before being committed.
+
+    """
+    try:
+        latest = os.readlink(os.path.join(parent, ROTATION_LATEST))
+    except OSError:
+        latest = None
+
+    dirs = rotation_dirs(parent)
+    names = [os.path.basename(path) for path in dirs]
+    start = names.index(latest) + 1 if latest in names else 0
+    for path in dirs[start:]:
+        remove_checkpoint(path)
+
+def commit_rotation(parent, path, keep):
+    """Marks a rotated checkpoint as the latest one
+
+    Only the keep most recent checkpoints are retained.
+
+    """
+    link = os.path.join(parent, ROTATION_LATEST)
+    tmp_link = '{0}.{1}'.format(link, os.getpid())
+    try:
+        if os.path.lexists(tmp_link):
+            os.unlink(tmp_link)
+        os.symlink(os.path.basename(path), tmp_link)
+        os.rename(tmp_link, link)
+    except OSError as err:
+        raise CheckpointImageError(str(err))
+
+    dirs = rotation_dirs(parent)
+    kept = dirs[max(len(dirs) - keep, 0):]
+    # Keep the bases of incremental checkpoints as long as needed
+    needed = set(kept) | set([path])
+    for kept_path in list(needed):
+        needed.update(checkpoint_bases(kept_path))
+
+    for old_path in dirs:
+        if old_path not in needed:
+            remove_checkpoint(old_path)
+
+def record_checkpoint_time(parent, duration):
+    """Records the duration of a checkpoint rotated in parent"""
+    times = _load_checkpoint_times(parent)
+    times.append(round(duration, 1))
+    save_manifest(os.path.join(parent, CKPT_TIMES),
+                  times[-CKPT_TIMES_KEPT:])
+
+def _load_checkpoint_times(parent):
+    try:
+        with open(os.path.join(parent, CKPT_TIMES), 'r') as f:
+            times = yaml.safe_load(f)
+    except (IOError, yaml.YAMLError):
+        return []
+
+    if not isinstance(times, list):
+        return []
+    return [t for t in times if isinstance(t, (int, float))]
+
+def expected_checkpoint_time(parent):
+    """Returns how long a checkpoint rotated in parent may take
+
+    The estimate is the longest of the recent checkpoints with a 50%
+    margin, or a default value if there is no history.
+
+    """
+    times = _load_checkpoint_times(parent)
+    if not times:
+        return DEFAULT_CKPT_TIME
+
+    return int(max(times) * 1.5) + CKPT_TIME_MARGIN
+
+def staging_record_path(ckpt_dir, rank):
+    return os.path.join(ckpt_dir, 'staging-vm{0}.yaml'.format(rank))
+
+def drained_marker_path(ckpt_dir, rank):
+    return os.path.join(ckpt_dir, 'drained-vm{0}'.format(rank))
+
+def save_staging_record(ckpt_dir, rank, host, staging_dir, manifest, files):
+    """Records the node-local files of a staged checkpoint
+
+    files maps local paths to final paths and manifest is the memory
+    manifest whose stripes are local until drained.
+
+    """
+    save_manifest(staging_record_path(ckpt_dir, rank),
+                  {'host': host,
+                   'dir': staging_dir,
+                   'manifest': manifest,
+                   'files': files})
+
+def clear_staging(ckpt_dir, rank):
+    """Removes the staging state left by a previous checkpoint"""
+    for path in [staging_record_path(ckpt_dir, rank),
+                 drained_marker_path(ckpt_dir, rank)]:
+        try:
+            os.unlink(path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise CheckpointImageError(str(err))
+
+def staged_files(ckpt_dir, rank):
+    """Returns the local files of a staged checkpoint not yet drained
+
+    The result maps final paths to local paths, or is None if the
+    checkpoint of the VM was not staged or is fully drained.
+
+    """
+    record_path = staging_record_path(ckpt_dir, rank)
+    if (not os.path.exists(record_path) or
+        os.path.exists(drained_marker_path(ckpt_dir, rank))):
+        return None
+
+    record = _load_staging_record(record_path)
+    return dict((final, local) for local, final
+                in record['files'].iteritems())
+
+def _load_staging_record(path):
+    try:
+        with open(path, 'r') as f:
+            record = yaml.safe_load(f)
+    except (IOError, yaml.YAMLError) as err:
+        raise CheckpointImageError(str(err))
+
+    if not isinstance(record, dict) or not isinstance(record.get('files'),
+                                                      dict):
+        raise CheckpointImageError('invalid staging record {0}'.format(path))
+
+    return record
+
+def drain(ckpt_dir, rank):
+    """Copies the local files of a staged checkpoint to their final paths
+
+    The memory manifest is then updated to reference the final stripes
+    before writing the completion marker and removing the local files.
+
+    """
+    record = _load_staging_record(staging_record_path(ckpt_dir, rank))
+    files = record['files']
+    copy_files(files)
+    try:
+        manifest = load_manifest(record['manifest'], True)
+        manifest['stripes'] = [files.get(stripe, stripe)
+                               for stripe in manifest['stripes']]
+        save_manifest(record['manifest'], manifest)
+
+        with open(drained_marker_path(ckpt_dir, rank), 'w'):
+            pass
+    except (IOError, OSError) as err:
+        raise CheckpointImageError('unable to drain checkpoint: '
+                                   '{0}'.format(err))
+
+    for local in files:
+        try:
+            os.unlink(local)
+        except OSError:
+            pass
+    try:
+        os.rmdir(record['dir'])
+    except OSError:
+        pass
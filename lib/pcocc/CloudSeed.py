@@ -0,0 +1,221 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Generation of cloud-init NoCloud seed images
+
+Seed images are small ISO9660 filesystems with Joliet extensions
+labelled cidata. They are generated in-process and can be cached in a
+directory under a name derived from their content so that VMs sharing
+the same seed data reuse the same image.
+
+"""
+
+import os
+import time
+import errno
+import struct
+import hashlib
+import tempfile
+
+from .Error import PcoccError
+
+SECTOR_SIZE = 2048
+
+# Remove cached seeds which have not been used for a week
+SEED_CACHE_EXPIRY = 7 * 24 * 3600
+
+class SeedError(PcoccError):
+    """Exception raised when a seed image cannot be generated
+    """
+    def __init__(self, error):
+        super(SeedError, self).__init__('Unable to generate cloud-init '
+                                        'seed: ' + error)
+
+def make_seed(files, dest_path, cache_dir=None):
+    """Returns the path to a seed image holding the given files
+
+    files is a dict of file names to file contents. If cache_dir is
+    set, the image is looked up or stored there, otherwise it is
+    written to dest_path.
+
+    """
+    try:
+        if not cache_dir:
+            write_iso(dest_path, 'cidata', files)
+            return dest_path
+
+        digest = hashlib.sha1()
+        for name in sorted(files):
+            digest.update('{0}:{1}:'.format(name, len(files[name])))
+            digest.update(files[name])
+
+        seed_path = os.path.join(cache_dir,
+                                 'seed-{0}.iso'.format(digest.hexdigest()))
+        try:
+            # Refresh the timestamp used for expiry
+            os.utime(seed_path, None)
+            return seed_path
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+
+        _prune_cache(cache_dir)
+
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        os.close(fd)
+        try:
+            write_iso(tmp_path, 'cidata', files)
+            os.chmod(tmp_path, 0o600)
+            os.rename(tmp_path, seed_path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+        return seed_path
+    except (OSError, IOError) as err:
+        raise SeedError(str(err))
+
+def _prune_cache(cache_dir):
+    now = time.time()
+    for f in os.listdir(cache_dir):
+        if not f.startswith('seed-'):
+            continue
+        path = os.path.join(cache_dir, f)
+        try:
+            if now - os.stat(path).st_mtime > SEED_CACHE_EXPIRY:
+                os.unlink(path)
+        except OSError:
+            pass
+
+def _both16(val):
+    return struct.pack('<H', val) + struct.pack('>H', val)
+
+def _both32(val):
+    return struct.pack('<I', val) + struct.pack('>I', val)
+
+def _pad(data, size, fill=' '):
+    return data[:size] + fill * (size - len(data[:size]))
+
+def _ucs2(data, size):
+    # Joliet strings are UCS-2 big endian, padded with spaces
+    data = data.encode('utf-16-be')[:size]
+    return data + ('\x00 ' * size)[:size - len(data)]
+
+# Fixed timestamps so that identical content yields identical images
+_DIR_DATE = struct.pack('7B', 70, 1, 1, 0, 0, 0, 0)
+_VOL_DATE = '0' * 16 + '\x00'
+
+def _dir_record(name, lba, size, is_dir=False):
+    length = 33 + len(name)
+    length += length % 2
+    rec = struct.pack('BB', length, 0)
+    rec += _both32(lba) + _both32(size) + _DIR_DATE
+    rec += struct.pack('BBB', 2 if is_dir else 0, 0, 0)
+    rec += _both16(1) + struct.pack('B', len(name)) + name
+    return _pad(rec, length, '\x00')
+
+def _path_table(root_lba, big_endian):
+    fmt = '>IH' if big_endian else '<IH'
+    return _pad(struct.pack('BB', 1, 0) + struct.pack(fmt, root_lba, 1)
+                + '\x00', 10, '\x00')
+
+def _volume_descriptor(joliet, volume_id, total_sectors, root_lba,
+                       path_table_lba):
+    if joliet:
+        vd_type = 2
+        text = _ucs2
+        escapes = _pad('%/E', 32, '\x00')
+    else:
+        vd_type = 1
+        text = _pad
+        escapes = '\x00' * 32
+
+    vd = struct.pack('B', vd_type) + 'CD001' + struct.pack('BB', 1, 0)
+    vd += text('', 32) + text(volume_id, 32)
+    vd += '\x00' * 8 + _both32(total_sectors) + escapes
+    vd += _both16(1) + _both16(1) + _both16(SECTOR_SIZE)
+    vd += _both32(10)
+    vd += struct.pack('<II', path_table_lba, 0)
+    vd += struct.pack('>II', path_table_lba + 1, 0)
+    vd += _dir_record('\x00', root_lba, SECTOR_SIZE, True)
+    vd += text('', 128) * 4 + text('', 37) * 3
+    vd += _VOL_DATE * 4
+    vd += struct.pack('BB', 1, 0)
+    return _pad(vd, SECTOR_SIZE, '\x00')
+
+def _iso_name(name):
+    # Level 1 names: 8.3 uppercase d-characters
+    base, _, ext = name.upper().partition('.')
+    base = ''.join(c if c.isalnum() else '_' for c in base)[:8]
+    ext = ''.join(c if c.isalnum() else '_' for c in ext)[:3]
+    return '{0}.{1};1'.format(base, ext)
+
+def _directory(entries, dir_lba, joliet):
+    data = _dir_record('\x00', dir_lba, SECTOR_SIZE, True)
+    data += _dir_record('\x01', dir_lba, SECTOR_SIZE, True)
+    for name, lba, size in entries:
+        if joliet:
+            name = name.decode('utf-8').encode('utf-16-be')
+        else:
+            name = _iso_name(name)
+        data += _dir_record(name, lba, size)
+
+    if len(data) > SECTOR_SIZE:
+        raise SeedError('too many files')
+
+    return _pad(data, SECTOR_SIZE, '\x00')
+
+def write_iso(path, volume_id, files):
+    """Writes an ISO9660 image with Joliet extensions
+
+    files is a dict of file names to file contents, all stored in the
+    root directory.
+
+    """
+    # Layout: system area, primary and Joliet volume descriptors,
+    # terminator, path tables, root directories and then file data
+    pvd_lba = 16
+    ptable_lba = pvd_lba + 3
+    jptable_lba = ptable_lba + 2
+    root_lba = jptable_lba + 2
+    jroot_lba = root_lba + 1
+    lba = jroot_lba + 1
+
+    entries = []
+    for name in sorted(files):
+        size = len(files[name])
+        entries.append((name, lba, size))
+        lba += max(1, (size + SECTOR_SIZE - 1) // SECTOR_SIZE)
+    total_sectors = lba
+
+    with open(path, 'wb') as f:
+        f.write('\x00' * SECTOR_SIZE * pvd_lba)
+        f.write(_volume_descriptor(False, volume_id, total_sectors,
+                                   root_lba, ptable_lba))
+        f.write(_volume_descriptor(True, volume_id, total_sectors,
+                                   jroot_lba, jptable_lba))
+        f.write(_pad(struct.pack('B', 255) + 'CD001\x01', SECTOR_SIZE,
+                     '\x00'))
+        for dir_lba in [root_lba, jroot_lba]:
+            f.write(_pad(_path_table(dir_lba, False), SECTOR_SIZE, '\x00'))
+            f.write(_pad(_path_table(dir_lba, True), SECTOR_SIZE, '\x00'))
+        f.write(_directory(entries, root_lba, False))
+        f.write(_directory(entries, jroot_lba, True))
+        for name, _, size in entries:
+            sectors = max(1, (size + SECTOR_SIZE - 1) // SECTOR_SIZE)
+            f.write(_pad(files[name], sectors * SECTOR_SIZE, '\x00'))
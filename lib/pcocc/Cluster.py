@@ -17,17 +17,22 @@
 #  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
 
 
+import os
 import sys
 import yaml
 import time
 import logging
-from Queue import Queue
+from Queue import Queue, Empty
 from threading import Thread
 
 from . import Hypervisor
 from . import Batch
 from .Error import PcoccError
 from .Config import Config
+from .Misc import parse_size
+from .ImageCache import ImageCache, ImageBroadcast
+from .IOScheduler import IOScheduler
+from .Checkpoint import staged_files
 from .scripts import click
 
 class InvalidClusterError(PcoccError):
@@ -50,50 +55,50 @@ class ClusterSetupError(PcoccError):
     def __init__(self, error):
         super(ClusterSetupError, self).__init__('Failed to start cluster: ' + error)
 
-class Worker(Thread):
-    """Thread executing tasks from a given tasks queue"""
-    def __init__(self, pool):
-        Thread.__init__(self)
-        self.pool = pool
-        self.daemon = True
-        self.start()
+# Number of VMs stopped, resumed or terminated at once on each host
+CLUSTER_CONCURRENCY = 16
 
-    def run(self):
+def run_per_host(vms, func, concurrency):
+    """Runs func on each VM with at most concurrency VMs per host at once
+
+    Each host processes its VMs independently of the others. Returns a
+    dict of the exceptions raised by func indexed by VM rank.
+
+    """
+    queues = {}
+    for vm in vms:
+        queues.setdefault(vm.get_host(), Queue()).put(vm)
+
+    errors = {}
+    def _work(queue):
         while True:
-            func, args, kargs = self.pool.tasks.get()
             try:
-                func(*args, **kargs)
+                vm = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                func(vm)
             except Exception as e:
-                self.pool.exception = e
-            finally:
-                self.pool.tasks.task_done()
+                errors[vm.rank] = e
 
-class ThreadPool(object):
-    """Pool of threads consuming tasks from a queue"""
-    def __init__(self, num_threads):
-        self.tasks = Queue(num_threads)
-        self.exception = None
-        for _ in range(num_threads):
-            Worker(self)
+    threads = []
+    for queue in queues.itervalues():
+        for _ in range(min(concurrency, queue.qsize())):
+            thread = Thread(target=_work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
 
-    def add_task(self, func, *args, **kargs):
-        """Add a task to the queue"""
-        self.tasks.put((func, args, kargs))
+    for thread in threads:
+        thread.join()
 
-    def wait_completion(self):
-        """Wait for completion of all the tasks in the queue"""
-        self.tasks.join()
+    return errors
 
-        if self.exception is not None:
-            raise self.exception # pylint: disable-msg=E0702
+def do_stop_vm(vm):
+    vm.stop()
 
-def do_checkpoint_vm(vm, ckpt_dir):
-    vm.checkpoint(ckpt_dir)
-
-def do_save_vm(vm, ckpt_dir):
-    if not vm.image_dir is None:
-        vm.save(vm.checkpoint_img_file(ckpt_dir),
-                freeze=Hypervisor.VM_FREEZE_OPT.NO)
+def do_cont_vm(vm):
+    vm.cont()
 
 def do_quit_vm(vm):
     vm.quit()
@@ -106,6 +111,8 @@ class VM(object):
         self.eth_ifs = {}
         self.vfio_ifs = {}
         self.mounts = {}
+        self.cached_image_path = None
+        self._cache_lock = None
 
     def is_on_node(self):
         return Config().batch.is_rank_local(self.rank)
@@ -137,24 +144,50 @@ class VM(object):
     def put_file(self, source, dest):
         return Config().hyp.put_file(self, source, dest)
 
-    def checkpoint(self, ckpt_dir):
-        Config().hyp.checkpoint(self, ckpt_dir)
+    def checkpoint(self, ckpt_dir, live=False, max_remaining=0,
+                   deadline=None, progress=None, bandwidth=None):
+        return Config().hyp.checkpoint(self, ckpt_dir, live, max_remaining,
+                                       deadline, progress, bandwidth)
+
+    def drain_checkpoint(self, ckpt_dir):
+        Config().hyp.drain_checkpoint(self, ckpt_dir)
 
     def save(self, dest_file, full=False, freeze=Hypervisor.VM_FREEZE_OPT.TRY):
         Config().hyp.save(self, dest_file, full, freeze)
 
+    def warm_save(self, dest_file, full=False):
+        Config().hyp.warm_save(self, dest_file, full)
+
+    def stop(self):
+        Config().hyp.stop(self)
+
+    def cont(self):
+        Config().hyp.cont(self)
+
     def quit(self):
         Config().hyp.quit(self)
 
     def reset(self):
         Config().hyp.reset(self)
 
+    def recycle(self):
+        Config().hyp.recycle(self)
+
+    def recycle_save(self):
+        Config().hyp.recycle_save(self)
+
     def human_monitor_cmd(self, cmd):
         return Config().hyp.human_monitor_cmd(self, cmd)
 
     def dump(self, dumpfile):
         Config().hyp.dump(self, dumpfile)
 
+    def get_io_throttle(self):
+        return Config().hyp.get_io_throttle(self)
+
+    def set_io_throttle(self, limits, drives=None):
+        return Config().hyp.set_io_throttle(self, limits, drives)
+
     def wait_start(self):
         Config().hyp.wait_vm_start(self)
     @property
@@ -195,6 +228,10 @@ class VM(object):
     def instance_id(self):
         return self._template.instance_id
 
+    @property
+    def cloud_seed(self):
+        return self._template.cloud_seed
+
     @property
     def full_node(self):
         return self._template.full_node
@@ -207,6 +244,103 @@ class VM(object):
     def persistent_drives(self):
         return self._template.persistent_drives
 
+    @property
+    def overlay(self):
+        overlay = {'path': None,
+                   'cluster-size': 65536,
+                   'lazy-refcounts': False,
+                   'preallocation': 'off'}
+        overlay.update(self._template.overlay or {})
+        return overlay
+
+    @property
+    def image_cache(self):
+        if not self._template.image_cache:
+            return None
+
+        image_cache = {'path': None,
+                       'max-size': parse_size('20G'),
+                       'timeout': 300}
+        image_cache.update(self._template.image_cache)
+        return image_cache
+
+    @property
+    def boot_readahead(self):
+        if not self._template.boot_readahead:
+            return None
+
+        boot_readahead = {'window': 120}
+        boot_readahead.update(self._template.boot_readahead)
+        return boot_readahead
+
+    @property
+    def block_profile(self):
+        block_profile = {'aio': 'threads',
+                         'iothreads': False,
+                         'queues': 1,
+                         'l2-cache-size': None,
+                         'discard': False,
+                         'detect-zeroes': 'off'}
+        block_profile.update(self._template.block_profile or {})
+        return block_profile
+
+    @property
+    def io_throttle(self):
+        if not self._template.io_throttle:
+            return None
+
+        io_throttle = {'scope': 'vm'}
+        io_throttle.update(self._template.io_throttle)
+        return io_throttle
+
+    @property
+    def scratch_disk(self):
+        if not self._template.scratch_disk:
+            return None
+
+        scratch_disk = {'format': 'raw',
+                        'path': '/tmp',
+                        'cache': 'unsafe'}
+        scratch_disk.update(self._template.scratch_disk)
+        return scratch_disk
+
+    @property
+    def checkpoint_settings(self):
+        settings = {'codec': 'lzop',
+                    'stripes': 1,
+                    'stripe-dirs': [],
+                    'incremental': 0}
+        settings.update(self._template.checkpoint or {})
+        return settings
+
+    @property
+    def auto_compact(self):
+        return self._template.auto_compact
+
+    @property
+    def template_name(self):
+        return self._template.name
+
+    @property
+    def kernel(self):
+        return self._template.kernel
+
+    @property
+    def initrd(self):
+        return self._template.initrd
+
+    @property
+    def append(self):
+        return self._template.append
+
+    @property
+    def firmware(self):
+        return self._template.firmware
+
+    @property
+    def warm_start(self):
+        return self._template.warm_start
+
     @property
     def machine_type(self):
         return self._template.machine_type
@@ -337,7 +471,51 @@ class Cluster(object):
         return license_list
 
     def run(self, ckpt_dir=None):
-        self.vms[Config().batch.task_rank].run(ckpt_dir)
+        vm = self.vms[Config().batch.task_rank]
+
+        if vm.image_cache and vm.image_dir is not None and not ckpt_dir:
+            try:
+                self._fetch_cached_image(vm)
+            except (PcoccError, EnvironmentError) as err:
+                logging.warning('Using image from shared storage: %s', err)
+
+        vm.run(ckpt_dir)
+
+    def _fetch_cached_image(self, vm):
+        """Copies the VM image in the node cache
+
+        Nodes hosting VMs with the same image fetch it collectively
+        and a single VM per node takes part in the transfer.
+
+        """
+        batch = Config().batch
+        image_path = vm.image_path
+        peers = [v for v in self.vms if v.image_cache and
+                 v.image_dir is not None and v.image_path == image_path]
+
+        host_ranks = set([v.get_host_rank() for v in peers])
+        leader = min([v.rank for v in peers if v.is_on_node()])
+
+        cache_dir = vm.image_cache['path']
+        if cache_dir:
+            cache_dir = Config().resolve_path(cache_dir, vm)
+        else:
+            cache_dir = batch.get_node_cache_path('images')
+
+        cache = ImageCache(cache_dir, vm.image_cache['max-size'])
+        bcast = ImageBroadcast(cache, image_path, host_ranks, len(peers),
+                               vm.image_cache['timeout'])
+
+        if vm.rank == leader:
+            # The first VM deletes the keys once the broadcast is over
+            path, lock = bcast.fetch(cleanup=(vm.rank == peers[0].rank))
+        else:
+            path, lock = bcast.wait()
+
+        if path:
+            logging.info('Using cached image %s', path)
+            vm.cached_image_path = path
+            vm._cache_lock = lock
 
     def exec_cmd(self, vmid_list, cmd, user):
         #TODO: This should be launched in parallel ala clush
@@ -347,24 +525,131 @@ class Cluster(object):
 
         return ret
 
-    def checkpoint(self, ckpt_dir):
-        pool = ThreadPool(16)
-
-        print "Checkpointing disks..."
+    def checkpoint(self, ckpt_dir, live=False, max_remaining=0,
+                   deadline=None, host_concurrency=2, resume=False,
+                   bandwidth=None, adaptive=True):
+        """Checkpoints all the VMs
+
+        Unless live is set, all the VMs are stopped first so that the
+        checkpoint is a consistent cut of the cluster. Each VM then
+        saves its disk and memory on its own, with at most
+        host_concurrency VMs checkpointed at once on each host and a
+        number of VMs writing at once to the checkpoint filesystem
+        adjusted from the throughput unless adaptive is unset. The
+        memory transfer of each VM is capped to bandwidth bytes per
+        second if set. If any VM fails, all the VMs are resumed.
+        Otherwise, the cluster is terminated unless resume is set, in
+        which case VMs checkpointed live are resumed as soon as their
+        own checkpoint is complete.
+        Checkpoints staged on node-local storage are drained to
+        ckpt_dir after the VMs are resumed, or before they are
+        terminated.
+
+        """
+        blockers = {}
         for vm in self.vms:
-            pool.add_task(do_save_vm, vm, ckpt_dir)
-        pool.wait_completion()
+            blocker = Config().hyp.migration_blocker(vm)
+            if blocker:
+                blockers[vm.rank] = blocker
+        if blockers:
+            raise Hypervisor.CheckpointError(
+                self._format_vm_errors(blockers))
 
-        print "Checkpointing memory..."
+        batch = Config().batch
+        scheduler = IOScheduler(host_concurrency,
+                                batch.checkpoint_concurrency, adaptive)
+        fs = (Hypervisor.admission_key(batch.checkpoint_concurrency,
+                                       ckpt_dir) or
+              os.path.abspath(ckpt_dir))
+
+        def _ckpt_fs(vm):
+            # Staged checkpoints are written to node-local storage
+            if vm.checkpoint_settings.get('staging-dir'):
+                return None
+            return fs
+
+        if not live:
+            print "Stopping VMs..."
+            self._check_vm_errors(run_per_host(self.vms, do_stop_vm,
+                                               CLUSTER_CONCURRENCY))
+            cut_time = time.time()
+
+        # Times at which each VM was stopped and resumed, or saved if
+        # the cluster is terminated
+        stop_times = {}
+        end_times = {}
+        def _checkpoint_vm(vm, report):
+            start_time = time.time()
+            written = [0]
+            def _progress(transferred, remaining):
+                written[0] = transferred
+                report(transferred, remaining)
+
+            stop_time = vm.checkpoint(ckpt_dir, live, max_remaining,
+                                      deadline, _progress, bandwidth)
+            stop_times[vm.rank] = stop_time if live else cut_time
+            if live and resume:
+                # There is no consistent cut to wait for
+                vm.cont()
+            end_times[vm.rank] = time.time()
+            logging.info('vm%d checkpointed in %.1fs', vm.rank,
+                         end_times[vm.rank] - start_time)
+
+            img_file = Config().hyp.checkpoint_img_file(vm, ckpt_dir)
+            if os.path.exists(img_file):
+                written[0] += os.path.getsize(img_file)
+            return written[0]
+
+        self._check_vm_errors(scheduler.run(self.vms, _checkpoint_vm,
+                                            _ckpt_fs, 'Checkpointing VMs'))
+
+        if resume and not live:
+            def _cont_vm(vm):
+                vm.cont()
+                end_times[vm.rank] = time.time()
+
+            errors = run_per_host(self.vms, _cont_vm, CLUSTER_CONCURRENCY)
+            if errors:
+                raise Hypervisor.CheckpointError(
+                    self._format_vm_errors(errors))
+
+        downtimes = []
         for vm in self.vms:
-            pool.add_task(do_checkpoint_vm, vm, ckpt_dir)
-        pool.wait_completion()
+            downtime = end_times[vm.rank] - stop_times[vm.rank]
+            logging.info('vm%d downtime: %.1fs', vm.rank, downtime)
+            downtimes.append(downtime)
+
+        print "Checkpoint complete, downtime %.1fs max, %.1fs average." % (
+            max(downtimes), sum(downtimes) / len(downtimes))
+
+        if any(vm.checkpoint_settings.get('staging-dir') for vm in self.vms):
+            def _drain_vm(vm, report):
+                staged = staged_files(ckpt_dir, vm.rank) or {}
+                vm.drain_checkpoint(ckpt_dir)
+                return sum(os.path.getsize(path) for path in staged
+                           if os.path.exists(path))
+
+            self._check_vm_errors(scheduler.run(self.vms, _drain_vm,
+                                                lambda vm: fs,
+                                                'Draining checkpoint'))
+
+        if not resume:
+            errors = run_per_host(self.vms, do_quit_vm, CLUSTER_CONCURRENCY)
+            if errors:
+                raise Hypervisor.CheckpointError(
+                    self._format_vm_errors(errors))
+
+    def _check_vm_errors(self, errors):
+        """Resumes all the VMs and raises if a checkpoint step failed"""
+        if not errors:
+            return
 
-        print "Checkpoint complete."
-        for vm in self.vms:
-            pool.add_task(do_quit_vm, vm)
-        pool.wait_completion()
+        run_per_host(self.vms, do_cont_vm, CLUSTER_CONCURRENCY)
+        raise Hypervisor.CheckpointError(self._format_vm_errors(errors))
 
+    def _format_vm_errors(self, errors):
+        return '; '.join('vm{0}: {1}'.format(rank, errors[rank])
+                         for rank in sorted(errors))
 
     def _set_host_state(self, state, priority, desc, value, host_rank=None):
         Config().batch.write_key('cluster',
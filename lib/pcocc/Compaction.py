@@ -0,0 +1,109 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Compaction of image revision chains
+
+Each incremental save adds a qcow2 layer on top of the previous
+revision. Compaction merges the backing chain of a revision into a
+standalone image which replaces it under the same name, so that
+revision numbering and resolution are unchanged. Running VMs keep
+reading the previous file through their open descriptors.
+
+"""
+
+import os
+import stat
+import tempfile
+import subprocess
+
+from .Error import PcoccError
+from .Config import Lock
+from .ImageCache import image_chain
+
+class CompactionError(PcoccError):
+    """Exception raised when an image chain cannot be compacted
+    """
+    def __init__(self, error):
+        super(CompactionError, self).__init__('Image compaction failed: '
+                                              + error)
+
+def chain_stats(image_path):
+    """Returns the number of layers and total size of an image chain"""
+    try:
+        chain = image_chain(image_path)
+        return {'layers': len(chain),
+                'size': sum(os.path.getsize(path) for path in chain)}
+    except (PcoccError, OSError) as err:
+        raise CompactionError(str(err))
+
+def compact_image(image_path, converter=None):
+    """Merges the backing chain of an image into a standalone image
+
+    The merged image atomically replaces image_path and keeps its
+    permissions and modification time. Returns the chain statistics
+    before and after compaction.
+
+    """
+    if converter is None:
+        converter = ['nice', '-n', '19', 'qemu-img', 'convert',
+                     '-O', 'qcow2']
+
+    image_dir = os.path.dirname(os.path.abspath(image_path))
+    try:
+        lock = Lock(os.path.join(image_dir, '.compact.lock'))
+    except IOError as err:
+        raise CompactionError(str(err))
+
+    lock.acquire()
+    try:
+        before = chain_stats(image_path)
+        if before['layers'] == 1:
+            return before, before
+
+        st = os.stat(image_path)
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='.{0}.'.format(os.path.basename(image_path)),
+            dir=image_dir)
+        os.close(fd)
+
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call(converter + [image_path, tmp_path],
+                                      stdout=devnull)
+
+            new_st = os.stat(image_path)
+            if (new_st.st_ino, new_st.st_size, new_st.st_mtime) != (
+                    st.st_ino, st.st_size, st.st_mtime):
+                raise CompactionError('{0} was modified during '
+                                      'compaction'.format(image_path))
+
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+            os.utime(tmp_path, (st.st_atime, st.st_mtime))
+            os.rename(tmp_path, image_path)
+        except (OSError, subprocess.CalledProcessError) as err:
+            os.remove(tmp_path)
+            raise CompactionError(str(err))
+        except CompactionError:
+            os.remove(tmp_path)
+            raise
+    except OSError as err:
+        raise CompactionError(str(err))
+    finally:
+        lock.release()
+
+    return before, chain_stats(image_path)
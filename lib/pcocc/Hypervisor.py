@@ -18,6 +18,7 @@
 from __future__ import division
 
 import os
+import glob
 import time
 import socket
 import sys
@@ -31,7 +32,6 @@ import threading
 import errno
 import base64
 import tempfile
-import shutil
 import yaml
 import logging
 import signal
@@ -39,14 +39,32 @@ import datetime
 import random
 import binascii
 import uuid
+import hashlib
+import pipes
 
+from distutils.spawn import find_executable
 from ClusterShell.NodeSet  import RangeSet
 from .scripts import click
 from .Backports import subprocess_check_output, enum
 from .Error import PcoccError
-from .Config import Config
+from .Config import Config, Lock
 from .Misc import fake_signalfd, wait_or_term_child
-from .Misc import stop_threads, systemd_notify
+from .Misc import stop_threads, systemd_notify, KeySemaphore
+from .CloudSeed import make_seed
+from .Qcow2 import create_overlay, create_image, Qcow2Error
+from .Qcow2 import image_info
+from .ImageCache import image_chain, ImageCache
+from .Readahead import load_trace, start_prefetch, start_recording
+from .Readahead import claim_recording, drop_cache
+from .WarmStart import WarmStartError, snapshot_paths, save_manifest
+from .Checkpoint import CheckpointImageError, memory_layout
+from .Checkpoint import load_manifest as load_memory_manifest
+from .Checkpoint import compose_ram, ram_chain
+from .Checkpoint import clear_staging, save_staging_record, staged_files
+from .Checkpoint import copy_files, ram_image
+from .Checkpoint import chunk_store_path, restore_file
+from .Checkpoint import save_manifest as save_memory_manifest
+from .WarmStart import load_manifest, hardware_signature, identity_script
 
 lock = threading.Lock()
 
@@ -58,6 +76,12 @@ def try_kill(sproc):
     except OSError:
         pass
 
+def try_remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
 VM_FREEZE_OPT = enum('NO', 'TRY', 'YES')
 
 class InvalidImageError(PcoccError):
@@ -97,6 +121,26 @@ class AgentError(PcoccError):
 
 QMP_READ_SIZE=32768
 
+# Default rate of memory transfers in bytes per second
+MIGRATION_SPEED = 4 * 1024 * 1024 * 1024
+
+# Dirty bitmap tracking the boot disk changes since the last save
+SAVE_BITMAP = 'pcocc-save'
+
+# Internal snapshot of the VM state to which pcocc recycle reverts
+RECYCLE_SNAPSHOT = 'pcocc-recycle'
+
+# Locations where virtiofsd is looked for outside of the PATH
+VIRTIOFSD_PATHS = ['/usr/libexec/virtiofsd']
+
+# Names of the Qemu throttling parameters for each I/O limit
+THROTTLE_QMP_KEYS = {'iops-total': 'iops',
+                     'iops-read': 'iops_rd',
+                     'iops-write': 'iops_wr',
+                     'bps-total': 'bps',
+                     'bps-read': 'bps_rd',
+                     'bps-write': 'bps_wr'}
+
 class RemoteMonitor(object):
     def __init__(self, vm):
         self.s_mon = Config().hyp.socket_connect(vm, 'monitor_socket')
@@ -167,12 +211,32 @@ class RemoteMonitor(object):
         self.send_raw(mon_cont_cmd)
         self.read_filtered()
 
-    def drive_backup(self, device, dest):
-        mon_backup_cmd = ('{"execute": "drive-backup",'
-                        '"arguments": { "device": "%s",'
-                        '"target": "%s", "sync": "top"'
-                        '} }\n\n' % (device, dest))
-        self.send_raw(mon_backup_cmd)
+    def drive_backup(self, device, dest, sync='top', bitmap=None,
+                     bitmap_action=None):
+        """Copies a drive to dest and waits for completion
+
+        An incremental backup copies the blocks marked in the bitmap to
+        an existing image. Otherwise, a bitmap_action ('add' or
+        'clear') can be applied atomically with the start of the backup
+        so that the bitmap tracks changes made after the copy.
+
+        """
+        backup_args = {"device": device, "target": dest, "sync": sync}
+        if sync == "incremental":
+            backup_args.update({"bitmap": bitmap, "mode": "existing",
+                                "format": "qcow2"})
+
+        if bitmap_action:
+            mon_backup_cmd = {"execute": "transaction", "arguments": {
+                "actions": [
+                    {"type": "block-dirty-bitmap-" + bitmap_action,
+                     "data": {"node": device, "name": bitmap}},
+                    {"type": "drive-backup", "data": backup_args}]}}
+        else:
+            mon_backup_cmd = {"execute": "drive-backup",
+                              "arguments": backup_args}
+
+        self.send_raw(json.dumps(mon_backup_cmd) + '\n\n')
         ret = self.read_filtered()
 
         try:
@@ -251,16 +315,60 @@ class RemoteMonitor(object):
         except KeyError:
             raise PcoccError("Unable to parse output from qemu: " + raw_data)
 
-    def start_migration(self, dest_mem_file):
-        mon_speed_cmd = ('{"execute": "migrate_set_speed", "arguments":{'
-                         '"value": 4294967296'
-                         '} }\n\n')
+    def query_block(self):
+        mon_query_cmd = ('{"execute": "query-block" }\n\n')
+        self.send_raw(mon_query_cmd)
+        data = self.read_filtered()
+        try:
+            ret = json.loads(data)
+        except ValueError:
+            raise PcoccError("Could not parse query-block return: " + data)
+
+        if "error" in ret:
+            raise PcoccError("Qemu monitor error: " + ret["error"]["desc"])
+
+        return ret["return"]
+
+    def block_set_io_throttle(self, device, throttle):
+        args = dict(throttle, device=device)
+        mon_throttle_cmd = json.dumps({"execute": "block_set_io_throttle",
+                                       "arguments": args}) + '\n\n'
+        self.send_raw(mon_throttle_cmd)
+        data = self.read_filtered()
+        try:
+            ret = json.loads(data)
+        except ValueError:
+            raise PcoccError("Could not parse block_set_io_throttle "
+                             "return: " + data)
+
+        if "error" in ret:
+            raise PcoccError("Qemu monitor error: " + ret["error"]["desc"])
+
+    def set_migration_capability(self, capability, state):
+        mon_cap_cmd = json.dumps({"execute": "migrate-set-capabilities",
+                                  "arguments": {"capabilities": [
+                                      {"capability": capability,
+                                       "state": state}]}}) + '\n\n'
+        self.send_raw(mon_cap_cmd)
+        data = self.read_filtered()
+        try:
+            ret = json.loads(data)
+        except ValueError:
+            raise PcoccError("Could not parse migrate-set-capabilities "
+                             "return: " + data)
+
+        if "error" in ret:
+            raise PcoccError("Qemu monitor error: " + ret["error"]["desc"])
+
+    def start_migration(self, uri, bandwidth=None):
+        mon_speed_cmd = json.dumps({"execute": "migrate_set_speed",
+                                    "arguments": {
+                    "value": bandwidth or MIGRATION_SPEED}}) + '\n\n'
         self.send_raw(mon_speed_cmd)
         self.read_filtered()
 
-        mon_save_cmd = ('{"execute": "migrate", "arguments":{'
-                        '"uri": "exec:lzop > %s"'
-                        '} }\n\n'%(dest_mem_file))
+        mon_save_cmd = json.dumps({"execute": "migrate",
+                                   "arguments": {"uri": uri}}) + '\n\n'
         self.send_raw(mon_save_cmd)
         data = self.read_filtered()
         try:
@@ -272,6 +380,25 @@ class RemoteMonitor(object):
             raise
 #            raise PcoccError("Unable to parse output from qemu: " + data)
 
+    def continue_migration(self, state):
+        mon_continue_cmd = json.dumps({"execute": "migrate-continue",
+                                       "arguments": {"state": state}}) + '\n\n'
+        self.send_raw(mon_continue_cmd)
+        data = self.read_filtered()
+        try:
+            ret = json.loads(data)
+        except ValueError:
+            raise PcoccError("Could not parse migrate-continue "
+                             "return: " + data)
+
+        if "error" in ret:
+            raise PcoccError("Qemu monitor error: " + ret["error"]["desc"])
+
+    def cancel_migration(self):
+        mon_cancel_cmd = ('{"execute": "migrate_cancel" }\n\n')
+        self.send_raw(mon_cancel_cmd)
+        self.read_filtered()
+
     def snapshot_image(self, dest_image_file):
         #TODO
         pass
@@ -285,9 +412,322 @@ class RemoteMonitor(object):
         self.s_mon.terminate()
         self.s_mon.communicate()
 
+class QemuCapabilities(object):
+    """Features supported by a Qemu binary
+
+    Probing a binary requires running it several times so the results
+    are cached on the node in a file shared by all the VMs of the
+    user. Cache entries are keyed by the binary path, inode and mtime so
+    that an upgraded binary is probed again.
+
+    """
+    def __init__(self, qemu_bin, cache_file=None):
+        path = find_executable(qemu_bin)
+        if path is None:
+            raise HypervisorError('unable to find Qemu binary '
+                                  '{0}'.format(qemu_bin))
+
+        self.path = os.path.realpath(path)
+        st = os.stat(self.path)
+        self.key = '{0}:{1}:{2}'.format(self.path, st.st_ino,
+                                        int(st.st_mtime))
+
+        caps = None
+        if cache_file:
+            caps = self._load_cache(cache_file).get(self.key, None)
+
+        if caps is None:
+            logging.info('Probing capabilities of %s', self.path)
+            caps = self._probe()
+            if cache_file:
+                self._store_cache(cache_file, caps)
+
+        self._caps = caps
+
+    @property
+    def version(self):
+        return tuple(self._caps['version'])
+
+    @property
+    def machines(self):
+        return self._caps['machines']
+
+    @property
+    def devices(self):
+        return self._caps['devices']
+
+    @property
+    def objects(self):
+        return self._caps['objects']
+
+    @property
+    def accels(self):
+        return self._caps['accels']
+
+    def has_machine(self, machine):
+        # Be permissive if we were unable to list machines
+        return not self.machines or machine in self.machines
+
+    def has_device(self, device):
+        return device in self.devices
+
+    def has_object(self, obj):
+        return obj in self.objects
+
+    def has_accel(self, accel):
+        return accel in self.accels
+
+    @property
+    def kvm_usable(self):
+        if not self.has_accel('kvm'):
+            return False
+
+        return os.access('/dev/kvm', os.R_OK | os.W_OK)
+
+    @property
+    def iothreads(self):
+        return self.has_object('iothread')
+
+    @property
+    def virtiofs_dax(self):
+        return 'cache-size' in self._caps.get('fs-props', [])
+
+    @property
+    def blk_multiqueue(self):
+        return 'num-queues' in self._caps['blk-props']
+
+    @property
+    def aio_modes(self):
+        modes = ['threads', 'native']
+        if self.version >= (5, 0):
+            modes.append('io_uring')
+        return modes
+
+    def _run_probe(self, args):
+        try:
+            with open(os.devnull, 'r') as devnull:
+                return subprocess_check_output([self.path] + args,
+                                               stdin=devnull,
+                                               stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def _probe(self):
+        caps = {}
+
+        output = self._run_probe(['--version'])
+        if output is None:
+            raise HypervisorError('unable to run {0}'.format(self.path))
+        caps['version'] = parse_qemu_version(output)
+
+        caps['machines'] = parse_qemu_machines(
+            self._run_probe(['-machine', 'help']) or '')
+
+        caps['devices'] = parse_qemu_devices(
+            self._run_probe(['-device', 'help']) or '')
+
+        caps['objects'] = parse_qemu_list(
+            self._run_probe(['-object', 'help']) or '')
+
+        caps['blk-props'] = parse_qemu_properties(
+            self._run_probe(['-device', 'virtio-blk-pci,help']) or '')
+
+        caps['fs-props'] = parse_qemu_properties(
+            self._run_probe(['-device', 'vhost-user-fs-pci,help']) or '')
+
+        # -accel help is only available with recent Qemu versions, assume
+        # the usual accelerators for an x86 build otherwise
+        output = self._run_probe(['-accel', 'help'])
+        if output is None:
+            caps['accels'] = ['kvm', 'tcg']
+        else:
+            caps['accels'] = parse_qemu_list(output)
+
+        return caps
+
+    def _load_cache(self, cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = yaml.safe_load(f)
+        except (IOError, yaml.YAMLError):
+            return {}
+
+        if not isinstance(cache, dict):
+            return {}
+
+        return cache
+
+    def _store_cache(self, cache_file, caps):
+        cache_lock = Lock(cache_file + '.lock')
+        cache_lock.acquire()
+        try:
+            cache = self._load_cache(cache_file)
+            # Drop stale entries for this binary
+            for key in cache.keys():
+                if key.rsplit(':', 2)[0] == self.path:
+                    del cache[key]
+            cache[self.key] = caps
+
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(cache_file))
+            with os.fdopen(fd, 'w') as f:
+                yaml.safe_dump(cache, f)
+            os.rename(tmp_path, cache_file)
+        except (IOError, OSError) as err:
+            logging.warning('Unable to cache Qemu capabilities: %s', err)
+        finally:
+            cache_lock.release()
+
+def parse_qemu_version(output):
+    match = re.search(r'version (\d+)\.(\d+)(?:\.(\d+))?', output)
+    if not match:
+        raise HypervisorError('unable to parse Qemu version: ' + output)
+
+    return [int(v) if v else 0 for v in match.groups()]
+
+def parse_qemu_machines(output):
+    machines = []
+    for line in output.splitlines():
+        if not line.strip() or line.startswith('Supported machines'):
+            continue
+        machines.append(line.split()[0])
+    return machines
+
+def parse_qemu_devices(output):
+    devices = []
+    for match in re.finditer(r'name "([^"]+)"(?:.*alias "([^"]+)")?', output):
+        devices += [d for d in match.groups() if d]
+    return devices
+
+def parse_qemu_list(output):
+    items = []
+    for line in output.splitlines():
+        line = line.strip()
+        if not line or line.endswith(':'):
+            continue
+        # Old versions print a comma separated list on a single line
+        if ':' in line:
+            line = line.split(':', 1)[1]
+        items += [i.strip() for i in line.split(',') if i.strip()]
+    return items
+
+def parse_qemu_properties(output):
+    props = []
+    for line in output.splitlines():
+        match = re.match(r'\s*(?:[\w-]+\.)?([\w-]+)\s*=', line)
+        if match:
+            props.append(match.group(1))
+    return props
+
+def parse_block_chain(blocks, device):
+    """Returns the image chain and dirty bitmaps of a drive from query-block"""
+    for blk in blocks:
+        if blk['device'] != device or not 'inserted' in blk:
+            continue
+
+        chain = []
+        image = blk['inserted'].get('image')
+        while image:
+            chain.append(image['filename'])
+            image = image.get('backing-image')
+
+        bitmaps = (blk['inserted'].get('dirty-bitmaps') or
+                   blk.get('dirty-bitmaps') or [])
+        return chain, [b['name'] for b in bitmaps if 'name' in b]
+
+    raise HypervisorError('no such drive: {0}'.format(device))
+
+def admission_key(limits, path):
+    """Returns the entry of the admission limits matching a path
+
+    The most specific filesystem path containing path is selected,
+    otherwise the default entry if there is one.
+
+    """
+    path = os.path.abspath(path)
+    best = None
+    for prefix in limits:
+        if prefix == 'default':
+            continue
+        prefix_dir = os.path.join(os.path.abspath(prefix), '')
+        if ((path + '/').startswith(prefix_dir) and
+            (best is None or len(prefix) > len(best))):
+            best = prefix
+
+    if best is None and 'default' in limits:
+        return 'default'
+
+    return best
+
+def parse_block_snapshots(blocks, device):
+    """Returns the names of the internal snapshots of a drive from query-block"""
+    for blk in blocks:
+        if blk['device'] != device or not 'inserted' in blk:
+            continue
+
+        image = blk['inserted'].get('image', {})
+        return [s['name'] for s in image.get('snapshots', [])]
+
+    raise HypervisorError('no such drive: {0}'.format(device))
+
+def find_virtiofsd():
+    """Returns the path of the virtiofsd daemon
+
+    Only the Rust implementation is supported: the C daemon shipped
+    with Qemu up to 7.2 takes different options.
+
+    """
+    found = None
+    for path in [find_executable('virtiofsd')] + VIRTIOFSD_PATHS:
+        if not path or not os.access(path, os.X_OK):
+            continue
+
+        found = path
+        try:
+            usage = subprocess_check_output([path, '--help'],
+                                            stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as err:
+            usage = err.output
+        except OSError:
+            continue
+
+        if '--shared-dir' in usage:
+            return path
+
+    if found:
+        raise HypervisorError('{0} is not supported, virtiofs mount points '
+                              'require the Rust virtiofsd'.format(found))
+    raise HypervisorError('unable to find virtiofsd')
+
 class Qemu(object):
     def __init__(self):
         self.qemu_bin = 'qemu-system-x86_64'
+        self._caps = {}
+
+    def capabilities(self, qemu_bin=None):
+        """Returns the capabilities of a Qemu binary"""
+        if qemu_bin is None:
+            qemu_bin = self.qemu_bin
+
+        if qemu_bin not in self._caps:
+            try:
+                cache_file = Config().batch.get_node_cache_path(
+                    'qemu_caps.yaml')
+            except PcoccError as err:
+                logging.warning('Not caching Qemu capabilities: %s', err)
+                cache_file = None
+
+            self._caps[qemu_bin] = QemuCapabilities(qemu_bin, cache_file)
+
+        return self._caps[qemu_bin]
+
+    def _check_capabilities(self, vm, caps):
+        if not caps.has_machine(vm.machine_type):
+            raise HypervisorError('machine type {0} is not supported by '
+                                  '{1}'.format(vm.machine_type, caps.path))
+
+        if not caps.kvm_usable:
+            logging.info('KVM is not usable, falling back to emulation')
 
     def _do_lock_image(self, drive, key):
         batch = Config().batch
@@ -345,6 +785,492 @@ class Qemu(object):
                              'mmp/' + path)
 
 
+    def _overlay_path(self, vm):
+        batch = Config().batch
+
+        if not vm.overlay['path']:
+            return batch.get_vm_state_path(vm.rank, 'image_snapshot')
+
+        overlay_dir = Config().resolve_path(vm.overlay['path'], vm)
+        try:
+            if not os.path.isdir(overlay_dir):
+                os.makedirs(overlay_dir)
+        except OSError as err:
+            raise InvalidImageError('unable to create overlay '
+                                    'directory: ' + str(err))
+
+        return os.path.join(overlay_dir,
+                            'pcocc_{0}_vm{1}_snapshot'.format(batch.batchid,
+                                                              vm.rank))
+
+    def _create_overlay(self, vm, image_path, snapshot_path):
+        overlay = vm.overlay
+
+        if overlay['preallocation'] == 'off':
+            try:
+                create_overlay(snapshot_path, image_path,
+                               overlay['cluster-size'],
+                               overlay['lazy-refcounts'])
+                return
+            except Qcow2Error as err:
+                raise InvalidImageError('failed to create temporary disk: '
+                                        + str(err))
+
+        # Preallocation requires allocating data clusters which is left
+        # to qemu-img
+        options = 'cluster_size={0},lazy_refcounts={1},preallocation={2}'.format(
+            overlay['cluster-size'],
+            'on' if overlay['lazy-refcounts'] else 'off',
+            overlay['preallocation'])
+        with open(os.devnull, 'w') as devnull:
+            try:
+                subprocess.check_call(['qemu-img', 'create',
+                                       '-f', 'qcow2', '-o', options,
+                                       '-b', image_path, snapshot_path],
+                                      stdout=devnull)
+            except (OSError, subprocess.CalledProcessError) as err:
+                raise InvalidImageError('failed to create temporary disk')
+
+    def _create_scratch_disk(self, vm):
+        """Creates a sparse scratch disk file and returns its path"""
+        scratch = vm.scratch_disk
+        scratch_dir = Config().resolve_path(scratch['path'], vm)
+
+        try:
+            st = os.statvfs(scratch_dir)
+            if st.f_bavail * st.f_frsize < scratch['size']:
+                logging.warning('Scratch disk is larger than the free '
+                                'space in %s', scratch_dir)
+
+            fd, path = tempfile.mkstemp(
+                prefix='pcocc_scratch_vm{0}_'.format(vm.rank),
+                dir=scratch_dir)
+        except OSError as err:
+            raise HypervisorError('failed to create scratch disk: '
+                                  + str(err))
+
+        try:
+            if scratch['format'] == 'qcow2':
+                os.close(fd)
+                create_image(path, scratch['size'])
+            else:
+                os.ftruncate(fd, scratch['size'])
+                os.close(fd)
+        except (OSError, Qcow2Error) as err:
+            os.remove(path)
+            raise HypervisorError('failed to create scratch disk: '
+                                  + str(err))
+
+        return path
+
+    def _readahead_trace_path(self, vm):
+        trace_name = 'readahead-rev{0}'.format(vm.revision)
+        if os.access(vm.image_dir, os.W_OK):
+            return os.path.join(vm.image_dir, trace_name)
+
+        # Keep traces of read-only images on the node
+        image_id = hashlib.sha1(os.path.realpath(vm.image_path)).hexdigest()
+        return Config().batch.get_node_cache_path(
+            '{0}-{1}'.format(trace_name, image_id))
+
+    def _setup_readahead(self, vm, image_path):
+        try:
+            chain = image_chain(image_path)
+            trace_path = self._readahead_trace_path(vm)
+            layers = load_trace(trace_path, vm.image_path, chain)
+            if layers is not None:
+                start_prefetch(chain, layers)
+            elif image_path == vm.image_path:
+                # Evicting the shared image from the page cache would
+                # affect other VMs, whose reads would skew the trace
+                logging.info('Not recording boot readahead trace from '
+                             'a shared image')
+            elif claim_recording(trace_path):
+                logging.info('Recording boot readahead trace')
+                for path in chain:
+                    drop_cache(path)
+                start_recording(chain, vm.image_path, trace_path,
+                                vm.boot_readahead['window'])
+        except (PcoccError, EnvironmentError) as err:
+            logging.warning('Boot readahead disabled: %s', err)
+
+    def _blk_iothread(self, vm, caps, iothread):
+        if vm.block_profile['iothreads'] and caps.iothreads:
+            return ['-object', 'iothread,id={0}'.format(iothread)]
+        return []
+
+    def _blk_device_opts(self, vm, caps, num_cores, iothread,
+                         dedicated=False):
+        """Returns virtio-blk device options from the block profile
+
+        Dedicated drives always get their iothread when supported.
+
+        """
+        profile = vm.block_profile
+        opts = ''
+
+        if (profile['iothreads'] or dedicated) and caps.iothreads:
+            opts += ',iothread={0}'.format(iothread)
+
+        queues = profile['queues']
+        if queues == 'auto':
+            queues = num_cores
+        if queues > 1 and caps.blk_multiqueue:
+            opts += ',num-queues={0}'.format(queues)
+
+        return opts
+
+    def _blk_drive_opts(self, vm, caps, cache, fmt=None):
+        """Returns -drive options from the block profile"""
+        profile = vm.block_profile
+
+        aio = profile['aio']
+        if aio not in caps.aio_modes:
+            logging.warning('aio=%s is not supported by Qemu, '
+                            'using threads', aio)
+            aio = 'threads'
+        elif aio == 'native' and cache not in ['none', 'directsync']:
+            logging.warning('aio=native requires cache=none or directsync, '
+                            'using threads')
+            aio = 'threads'
+        opts = ',aio={0}'.format(aio)
+
+        if profile['discard']:
+            opts += ',discard=unmap'
+
+        if profile['detect-zeroes'] != 'off':
+            opts += ',detect-zeroes={0}'.format(profile['detect-zeroes'])
+
+        if fmt == 'qcow2' and profile['l2-cache-size']:
+            opts += ',l2-cache-size={0}'.format(profile['l2-cache-size'])
+
+        return opts
+
+    def _blk_throttle_opts(self, vm, drive_id, limits=None):
+        """Returns -drive throttling options
+
+        Drives with their own limits get their own throttle group,
+        otherwise the template limits apply to a group shared by all
+        the drives of the VM, or to each drive separately.
+
+        """
+        if limits:
+            group = drive_id
+        else:
+            limits = vm.io_throttle
+            if not limits:
+                return ''
+            if limits['scope'] == 'drive':
+                group = drive_id
+            else:
+                group = 'vm{0}'.format(vm.rank)
+
+        opts = ''
+        for name in sorted(limits):
+            if name in ['scope', 'burst-length'] or not limits[name]:
+                continue
+            opts += ',throttling.{0}={1}'.format(name, limits[name])
+            if name.endswith('-max') and 'burst-length' in limits:
+                opts += ',throttling.{0}-length={1}'.format(
+                    name, limits['burst-length'])
+
+        if opts:
+            opts += ',throttling.group={0}'.format(group)
+
+        return opts
+
+    def _boot_args(self, vm):
+        """Returns the firmware and boot options"""
+        args = []
+
+        # SeaBIOS is the default Qemu firmware
+        if vm.firmware == 'qboot':
+            args += ['-bios', 'qboot.rom']
+        elif vm.firmware and vm.firmware != 'seabios':
+            args += ['-bios', Config().resolve_path(vm.firmware, vm)]
+
+        if vm.kernel:
+            for opt in ['kernel', 'initrd']:
+                path = getattr(vm, opt)
+                if not path:
+                    continue
+                path = Config().resolve_path(path, vm)
+                if not os.path.isfile(path):
+                    raise HypervisorError('{0} file {1} does not '
+                                          'exist'.format(opt, path))
+                args += ['-' + opt, path]
+            if vm.append:
+                args += ['-append', vm.append]
+        elif not '-boot' in vm.custom_args:
+            args += ['-boot', 'order=cd']
+
+        return args
+
+    def _hardware_description(self, vm, caps, total_mem, num_cores,
+                              num_numa, autobind):
+        """Returns the virtual hardware which a memory snapshot depends on"""
+        throttled = sorted(drive for drive in vm.persistent_drives
+                           if vm.persistent_drives[drive].get('throttle'))
+        return {'qemu': list(caps.version),
+                'kvm': caps.kvm_usable,
+                'machine': vm.machine_type,
+                'firmware': vm.firmware,
+                'memory': total_mem,
+                'cpus': num_cores,
+                'numa': num_numa if autobind else 0,
+                'networks': sorted(vm.eth_ifs),
+                'nic-model': vm.nic_model,
+                'disk-model': vm.disk_model,
+                'drives': list(vm.persistent_drives),
+                'block-device': [self._blk_device_opts(vm, caps, num_cores,
+                                                       'iothread'),
+                                 self._blk_iothread(vm, caps, 'iothread')],
+                'throttle-groups': [vm.io_throttle and
+                                    vm.io_throttle.get('scope'), throttled],
+                'scratch': bool(vm.scratch_disk),
+                'cloud-seed': vm.cloud_seed,
+                'mounts': sorted([name, mount.get('type', '9p')]
+                                 for name, mount in
+                                 vm.mount_points.iteritems()),
+                'incremental-ram': self._incremental_ram(vm),
+                'serial-ports': list(vm.serial_ports),
+                'display': vm.remote_display}
+
+    def _find_warm_snapshot(self, vm, signature):
+        """Returns the manifest of a usable warm snapshot of the VM image"""
+        if (vm.image_dir is None or vm.vfio_ifs or
+            self.migration_blocker(vm)):
+            return None
+
+        try:
+            manifest = load_manifest(vm.image_path, signature)
+        except WarmStartError as err:
+            logging.warning('Cold booting vm%d: %s', vm.rank, err)
+            return None
+
+        if manifest:
+            logging.info('Warm starting vm%d from %s', vm.rank,
+                         manifest['memory'])
+        return manifest
+
+    def _acquire_admission(self, vm, paths):
+        """Acquires the admission semaphores of the filesystems of paths"""
+        limits = Config().batch.launch_concurrency
+        keys = {}
+        for path in paths:
+            key = admission_key(limits, path)
+            if key:
+                keys[key] = limits[key]
+
+        semaphores = []
+        # Acquire in a consistent order to avoid deadlocks
+        for key in sorted(keys):
+            def _progress(position):
+                self._set_vm_state('admission',
+                                   'waiting for access to {0} '
+                                   '(position {1} in queue)'.format(
+                                       key, position),
+                                   None, vm.rank)
+
+            sem = KeySemaphore('admission/{0}'.format(
+                    hashlib.sha1(key).hexdigest()), keys[key])
+            atexit.register(sem.release, vm.rank)
+            sem.acquire(vm.rank, _progress)
+            semaphores.append(sem)
+
+        return semaphores
+
+    def _release_admission(self, vm, semaphores):
+        for sem in semaphores:
+            try:
+                sem.release(vm.rank)
+            except PcoccError as err:
+                logging.warning('Unable to release admission '
+                                'semaphore: %s', err)
+        del semaphores[:]
+
+    def migration_blocker(self, vm):
+        """Returns why the state of a VM can't be saved, if it can't"""
+        mounts = sorted(mount for mount, opts in vm.mount_points.iteritems()
+                        if opts.get('type', '9p') == 'virtiofs')
+        if mounts:
+            return ('virtiofs mount points can\'t be migrated: '
+                    '{0}'.format(', '.join(mounts)))
+        return None
+
+    def _needs_shared_ram(self, vm):
+        # vhost-user backends access the guest memory directly
+        return any(mount.get('type', '9p') == 'virtiofs'
+                   for mount in vm.mount_points.itervalues())
+
+    def _incremental_ram(self, vm):
+        # The guest RAM is kept in files to be saved as deltas
+        return bool(vm.checkpoint_settings.get('incremental'))
+
+    def _ram_file(self, vm, index):
+        return os.path.join('/dev/shm', 'pcocc-{0}-vm{1}-ram-{2}'.format(
+                Config().batch.batchid, vm.rank, index))
+
+    def _ram_backend(self, vm, caps, index=0, image=None):
+        """Returns the memory backend object for the guest RAM
+
+        If image is set, the RAM is a private mapping of this file so
+        that pages are loaded lazily.
+
+        """
+        if image:
+            return 'memory-backend-file,mem-path={0},share=off'.format(image)
+
+        if self._incremental_ram(vm):
+            return 'memory-backend-file,mem-path={0},share=on'.format(
+                self._ram_file(vm, index))
+
+        if not self._needs_shared_ram(vm):
+            return 'memory-backend-ram'
+
+        if caps.has_object('memory-backend-memfd'):
+            return 'memory-backend-memfd,share=on'
+
+        return 'memory-backend-file,mem-path=/dev/shm,share=on'
+
+    def _setup_virtiofs(self, vm, caps, mount, host_path):
+        batch = Config().batch
+        opts = vm.mount_points[mount]
+
+        if not caps.has_device('vhost-user-fs-pci'):
+            raise HypervisorError('virtiofs is not supported by '
+                                  '{0}'.format(caps.path))
+
+        virtiofsd = find_virtiofsd()
+
+        socket_path = batch.get_vm_state_path(vm.rank,
+                                              'virtiofs_{0}'.format(mount))
+        log_path = batch.get_vm_state_path(vm.rank,
+                                           'virtiofsd_{0}.log'.format(mount))
+
+        cmd = [virtiofsd,
+               '--socket-path={0}'.format(socket_path),
+               '--shared-dir={0}'.format(host_path),
+               '--cache={0}'.format(opts.get('cache', 'auto'))]
+        if opts.get('readonly', False):
+            cmd.append('--readonly')
+        # Namespace sandboxing requires privileges
+        if os.getuid() != 0:
+            cmd.append('--sandbox=none')
+
+        logging.info('Starting virtiofsd for mount point %s', mount)
+        with open(os.devnull) as devnull, open(log_path, 'w') as log:
+            proc = subprocess.Popen(cmd, stdin=devnull,
+                                    stdout=log, stderr=subprocess.STDOUT,
+                                    close_fds=True)
+        atexit.register(try_kill, proc)
+
+        # Wait for the daemon to create its socket
+        for _ in xrange(100):
+            if os.path.exists(socket_path):
+                break
+            if proc.poll() is not None:
+                raise HypervisorError('virtiofsd for mount point {0} exited '
+                                      'with status {1}, see {2}'.format(
+                                          mount, proc.returncode, log_path))
+            time.sleep(0.1)
+        else:
+            raise HypervisorError('timeout while starting virtiofsd for '
+                                  'mount point {0}'.format(mount))
+
+        def _supervise():
+            ret = proc.wait()
+            if ret:
+                logging.error('virtiofsd for mount point %s exited with '
+                              'status %d', mount, ret)
+        supervisor = threading.Thread(target=_supervise)
+        supervisor.daemon = True
+        supervisor.start()
+
+        device = 'vhost-user-fs-pci,chardev=virtiofs_{0},tag={0}'.format(mount)
+        if opts.get('dax', None):
+            if not caps.virtiofs_dax:
+                raise HypervisorError('virtiofs DAX is not supported by '
+                                      '{0}'.format(caps.path))
+            device += ',cache-size={0}'.format(opts['dax'])
+
+        return ['-chardev',
+                'socket,id=virtiofs_{0},path={1}'.format(mount, socket_path),
+                '-device', device]
+
+    def _vm_hostname(self, vm):
+        if hasattr(vm, 'domain_name'):
+            # Setting the fqdn as a hostname is not standard but
+            # its what cloud-init wants and its difficult to work
+            # around it.  Ideally we'd set the short hostname for
+            # and cloud-init would use it as a hostname without
+            # appending .localdomain. The fqdn should be
+            # determined by the resolver configuration (dns or
+            # host file).
+            return 'vm{0}.{1}'.format(vm.rank, vm.domain_name)
+        else:
+            # For networks without managed DHCP/DNS set a hostname by default
+            return 'vm%d' % (vm.rank)
+
+    def _setup_cloud_seed(self, vm):
+        batch = Config().batch
+
+        instance_id = vm.instance_id
+        if instance_id is None:
+            instance_id = uuid.uuid4()
+
+        hostname = self._vm_hostname(vm)
+
+        try:
+            if vm.user_data:
+                with open(Config().resolve_path(vm.user_data, vm)) as f:
+                    user_data = f.read()
+            else:
+                user_data = ''
+        except IOError as err:
+            raise HypervisorError('unable to read cloud-init user-data: '
+                                  + str(err))
+
+        args = []
+        if vm.cloud_seed == 'smbios':
+            # The VM identity is passed through the SMBIOS serial
+            # number so that the seed image only holds data shared by
+            # all VMs and can be reused.
+            serial = 'ds=nocloud;i={0};h={1}'.format(instance_id, hostname)
+            args += ['-smbios',
+                     'type=1,serial={0}'.format(serial.replace(',', ',,'))]
+            if not vm.user_data:
+                return args
+
+            files = {'meta-data': '{}\n',
+                     'user-data': user_data}
+            cacheable = True
+        elif vm.cloud_seed == 'iso':
+            files = {'meta-data': 'instance-id: {0}\n'
+                                  'local-hostname: {1}\n'.format(instance_id,
+                                                                 hostname),
+                     'user-data': user_data}
+            # Random instance ids would only pollute the cache
+            cacheable = vm.instance_id is not None
+        else:
+            raise HypervisorError('Unsupported cloud-init seed type: '
+                                  + str(vm.cloud_seed))
+
+        cache_dir = None
+        if cacheable:
+            try:
+                cache_dir = batch.get_node_cache_path('')
+            except PcoccError as err:
+                logging.warning('Not caching cloud-init seed: %s', err)
+
+        iso_file = make_seed(files,
+                             batch.get_vm_state_path(vm.rank, 'cloud_seed'),
+                             cache_dir)
+
+        args += ['-drive',
+                 'file={0},index=3,media=cdrom'.format(iso_file)]
+        return args
+
     def _setup_spice(self, vm):
         batch = Config().batch
         # TODO: Add TLS support for untrusted networks
@@ -427,6 +1353,11 @@ username={3}@pcocc
                            'gathering topological information',
                            None, vm.rank)
 
+        restore_prefetch = None
+        if ckpt_dir:
+            # Copy the checkpoint to local storage while we set up the VM
+            restore_prefetch = self._start_restore_prefetch(vm, ckpt_dir)
+
         # VM may use all cores allocated for the job
         # Disable batch manager affinity
         if vm.full_node:
@@ -518,65 +1449,144 @@ username={3}@pcocc
             cores_on_numa[0] = coreset
 
         if vm.qemu_bin:
-            cmdline = [ vm.qemu_bin ]
+            caps = self.capabilities(vm.qemu_bin)
+        else:
+            caps = self.capabilities()
+
+        cmdline = [ caps.path ]
+        self._check_capabilities(vm, caps)
+
+        # Publish the virtual hardware of the VM to validate warm
+        # snapshots saved from it
+        signature = hardware_signature(self._hardware_description(
+                vm, caps, total_mem, num_cores, len(cores_on_numa),
+                autobind_cpumem))
+        macs = dict((net, vm.eth_ifs[net]['hwaddr']) for net in vm.eth_ifs)
+        batch.write_key('cluster/user', self._hardware_state_key(vm.rank),
+                        yaml.dump({'signature': signature, 'macs': macs}))
+
+        if autobind_cpumem and caps.version >= (2, 1):
+            num_ram = len(cores_on_numa)
         else:
-            cmdline = [ self.qemu_bin ]
+            num_ram = 1
 
-        version_string = subprocess_check_output(cmdline + ['--version'])
-        match = re.search(r'version (\d+\.\d+)', version_string)
-        qemu_version = float(match.group(1))
+        if self._incremental_ram(vm):
+            ram_files = [self._ram_file(vm, i) for i in xrange(num_ram)]
+        else:
+            ram_files = []
 
+        warm_manifest = None
+        lazy_images = []
         if ckpt_dir:
-            dest_mem_file = self.checkpoint_mem_file(vm, ckpt_dir)
+            staged = self._checkpoint_staged(vm, ckpt_dir)
+            prefetched = self._wait_restore_prefetch(restore_prefetch)
+            mem_source, mem_files = self._checkpoint_source(vm, ckpt_dir,
+                                                            prefetched)
+            ram_manifests = self._checkpoint_ram_manifests(vm, ckpt_dir,
+                                                           num_ram)
+            if ram_manifests and not ram_files:
+                raise HypervisorError('the incremental checkpoint setting '
+                                      'differs from the checkpointed VM')
+            if ram_manifests:
+                # The RAM is restored from its files, not from the stream
+                cmdline += ['-global', 'migration.x-ignore-shared=on']
+                if vm.checkpoint_settings.get('lazy-restore'):
+                    lazy_images = self._lazy_ram_images(vm, ckpt_dir,
+                                                        ram_manifests,
+                                                        prefetched)
+                if lazy_images:
+                    # The RAM stays mapped from the checkpoint so later
+                    # checkpoints carry it in the migration stream
+                    ram_files = []
 
             cmdline += ['-incoming',
-                        "exec: lzop -dc %s" % (dest_mem_file)]
+                        "exec: %s" % (mem_source)]
+        elif vm.warm_start:
+            warm_manifest = self._find_warm_snapshot(vm, signature)
+            if warm_manifest:
+                cmdline += ['-incoming',
+                            "exec: lzop -dc %s" % (warm_manifest['memory'])]
 
         # Basic machine definition
-        try:
-            # Check if the kvm is usable
-            f =  open('/dev/kvm', 'w+')
+        if caps.kvm_usable:
             cmdline += ['-machine', 'type={0},accel=kvm'.format(vm.machine_type)]
             cmdline += ['-cpu', 'host']
-        except:
-            cmdline += ['-machine', 'type={0}'.format(vm.machine_type)]
         else:
-            f.close()
+            cmdline += ['-machine', 'type={0}'.format(vm.machine_type)]
 
         cmdline += ['-rtc', 'base=utc']
         cmdline += ['-device', 'qxl-vga,id=video0,ram_size=67108864,'
                     'vram_size=67108864,vgamem_mb=16']
 
+        heavy_paths = []
+        disk_manifest = None
+        if not vm.image_dir is None:
+            if ckpt_dir:
+                image_path = self.checkpoint_img_file(vm, ckpt_dir)
+                image_path = staged.get(image_path, image_path)
+                if (not os.path.exists(image_path) and
+                    os.path.exists(image_path + '.yaml')):
+                    # Deduplicated disks are rebuilt once admitted
+                    disk_manifest = image_path + '.yaml'
+            elif vm.cached_image_path:
+                image_path = vm.cached_image_path
+            else:
+                image_path = vm.image_path
+            heavy_paths.append(image_path)
+
+        if ckpt_dir:
+            heavy_paths += mem_files
+            for manifest_path in ram_manifests:
+                heavy_paths += [m['data'] or m['store']
+                                for m in ram_chain(manifest_path)]
+        elif warm_manifest:
+            heavy_paths.append(warm_manifest['memory'])
+
+        # Opening images and restoring memory are held back until
+        # enough VMs of the job are done with the same filesystems
+        admission = self._acquire_admission(vm, heavy_paths)
+
+        for ram_file in ram_files:
+            atexit.register(os.remove, ram_file)
+
+        batch.write_key('cluster/user', self._ram_state_key(vm.rank),
+                        yaml.dump(ram_files))
+
+        if ckpt_dir and ram_manifests and not lazy_images:
+            self._set_vm_state('memory',
+                               'restoring memory',
+                               None, vm.rank)
+            try:
+                for manifest_path, ram_file in zip(ram_manifests, ram_files):
+                    compose_ram(manifest_path, ram_file, prefetched)
+            except CheckpointImageError as err:
+                raise HypervisorError(str(err))
+
         self._set_vm_state('temporary-disk',
                            'creating disk file',
                            None, vm.rank)
 
         # Image
-        # Emulate -snapshot with qemu-img so that we
+        # Emulate -snapshot with a qcow2 overlay so that we
         # may save the image later if needed
-        snapshot_path = batch.get_vm_state_path(vm.rank, 'image_snapshot')
+        snapshot_path = self._overlay_path(vm)
 
         if not vm.image_dir is None:
-            if ckpt_dir:
-                image_path = self.checkpoint_img_file(vm, ckpt_dir)
-            else:
-                image_path = vm.image_path
-
-            with open(os.devnull, 'w') as devnull:
-                try:
-                    subprocess.check_call(['qemu-img', 'create',
-                                           '-f', 'qcow2',
-                                        '-b', image_path, snapshot_path],
-                                          stdout=devnull)
-                except (OSError, subprocess.CalledProcessError) as err:
-                    raise InvalidImageError('failed to create temporary disk')
+            if disk_manifest:
+                image_path = self._restore_checkpoint_disk(vm, disk_manifest)
+            self._create_overlay(vm, image_path, snapshot_path)
 
+            if vm.boot_readahead and not (ckpt_dir or warm_manifest):
+                self._setup_readahead(vm, image_path)
 
             atexit.register(os.remove, snapshot_path)
 
             if vm.disk_model == 'virtio':
+                cmdline += self._blk_iothread(vm, caps, 'ioth-bootdisk')
                 cmdline += ['-device', 'virtio-blk-pci,'
-                            'drive=bootdisk,addr=06.0']
+                            'drive=bootdisk,addr=06.0' +
+                            self._blk_device_opts(vm, caps, num_cores,
+                                                  'ioth-bootdisk')]
             elif vm.disk_model == 'ide':
                 cmdline += ['-device', 'ich9-ahci,id=ahci,addr=06.0']
                 cmdline += ['-device', 'ide-hd,'
@@ -587,8 +1597,11 @@ username={3}@pcocc
 
             cmdline += ['-drive', 'id=bootdisk,'
                         'file=%s,index=0,if=none,'
-                        'format=qcow2,cache=%s,aio=threads' %
-                        (snapshot_path, vm.disk_cache)]
+                        'format=qcow2,cache=%s' %
+                        (snapshot_path, vm.disk_cache) +
+                        self._blk_drive_opts(vm, caps, vm.disk_cache,
+                                             'qcow2') +
+                        self._blk_throttle_opts(vm, 'bootdisk')]
 
         for i, drive in enumerate(vm.persistent_drives):
             path =  Config().resolve_path(drive, vm)
@@ -603,21 +1616,51 @@ username={3}@pcocc
                                       vm.persistent_drives[drive])
                 atexit.register(self._unlock_image, spath)
 
-            cmdline += ['-object',
-                        'iothread,id=ioth-datadisk{0}'.format(i)]
+            iothread = 'ioth-datadisk{0}'.format(i)
+            if caps.iothreads:
+                cmdline += ['-object',
+                            'iothread,id={0}'.format(iothread)]
             cmdline += ['-device',
                         'virtio-blk-pci,id=ioth-datadisk{0},multifunction=on,'
                         'drive=datadisk{0},addr={1:02d}.{2}'.format(
-                            i, i//3+7, i%3)]
+                            i, i//3+7, i%3) +
+                        self._blk_device_opts(vm, caps, num_cores, iothread)]
             cmdline += ['-drive',
                         'file={0},cache={1},id=datadisk{2},'
                         'if=none'.format(
                         path,
                         vm.persistent_drives[drive]['cache'],
-                        i)]
+                        i) +
+                        self._blk_drive_opts(
+                            vm, caps, vm.persistent_drives[drive]['cache']) +
+                        self._blk_throttle_opts(
+                            vm, 'datadisk{0}'.format(i),
+                            vm.persistent_drives[drive].get('throttle'))]
+
+        # Scratch disk, the PCI address is left to Qemu after all the
+        # fixed addresses have been taken
+        if vm.scratch_disk:
+            scratch_path = self._create_scratch_disk(vm)
+            atexit.register(os.remove, scratch_path)
+
+            if caps.iothreads:
+                cmdline += ['-object', 'iothread,id=ioth-scratch']
+            cmdline += ['-device',
+                        'virtio-blk-pci,id=scratchdev,drive=scratch,'
+                        'serial=pcocc-scratch' +
+                        self._blk_device_opts(vm, caps, num_cores,
+                                              'ioth-scratch', True)]
+            cmdline += ['-drive',
+                        'file={0},format={1},cache={2},id=scratch,'
+                        'if=none'.format(
+                            scratch_path,
+                            vm.scratch_disk['format'],
+                            vm.scratch_disk['cache']) +
+                        self._blk_drive_opts(vm, caps,
+                                             vm.scratch_disk['cache'],
+                                             vm.scratch_disk['format'])]
 
-        if not '-boot' in vm.custom_args:
-            cmdline += ['-boot', 'order=cd']
+        cmdline += self._boot_args(vm)
 
         # Memory
         # FIXME: Reserve 15% if total_memory for qemu
@@ -627,7 +1670,7 @@ username={3}@pcocc
 
         # CPU topology
         #
-        if qemu_version > 2:
+        if caps.version >= (2, 1):
             cmdline += ['-smp', 'threads=1,cores=1,sockets=%d' %
                         (num_cores)]
         else:
@@ -642,15 +1685,23 @@ username={3}@pcocc
                 virt_to_phys_coreid += numa_coreset
                 ncores_on_node = len(numa_coreset)
                 # TODO: adjust the memory for irregular NUMA nodes
-                if qemu_version > 2:
+                if caps.version >= (2, 1):
                     cmdline += ['-numa', 'node,memdev=ram-%d,cpus=%d-%d,nodeid=%d' % (
                             i,
                             start_cpu,
                             start_cpu + ncores_on_node - 1,
                             i)]
 
+                    if lazy_images:
+                        backend = (self._ram_backend(vm, caps, i,
+                                                     lazy_images[i]) +
+                                   ',size=%dM,policy=preferred,')
+                    else:
+                        backend = (self._ram_backend(vm, caps, i) +
+                                   ',size=%dM,policy=preferred,prealloc=yes,')
+
                     cmdline += ['-object',
-                                'memory-backend-ram,size=%dM,policy=preferred,prealloc=yes,'
+                                backend +
                                 'host-nodes=%d,id=ram-%d' % (
                             total_mem // len(cores_on_numa),
                             numa_node, i)]
@@ -664,6 +1715,12 @@ username={3}@pcocc
                 start_cpu += ncores_on_node
         else:
             cmdline += ['-m', str(total_mem)]
+            if self._needs_shared_ram(vm) or self._incremental_ram(vm):
+                cmdline += ['-object',
+                            self._ram_backend(vm, caps, 0,
+                                              (lazy_images or [None])[0]) +
+                            ',size=%dM,id=ram-0' % (total_mem),
+                            '-numa', 'node,memdev=ram-0']
 
         # Ethernet interfaces
         try:
@@ -718,6 +1775,10 @@ username={3}@pcocc
                 raise HypervisorError('unable to access mount '
                                       'point {0}'.format(host_path))
 
+            if vm.mount_points[mount].get('type', '9p') == 'virtiofs':
+                cmdline += self._setup_virtiofs(vm, caps, mount, host_path)
+                continue
+
             cmdline += ['-fsdev', 'local,id=%s,path=%s,security_model=none%s'%
                         (mount, host_path, readonly_string)]
 
@@ -764,50 +1825,7 @@ username={3}@pcocc
             raise HypervisorError('Unsupported remote display type: '
                                   + str(vm.remote_display))
 
-        try:
-            user_data_file = batch.get_vm_state_path(vm.rank, 'user-data')
-            meta_data_file = batch.get_vm_state_path(vm.rank, 'meta-data')
-            iso_file = batch.get_vm_state_path(vm.rank, 'cloud_seed')
-
-            f = open(meta_data_file, 'w')
-            instance_id = vm.instance_id
-            if instance_id is None:
-                instance_id = uuid.uuid4()
-            f.write('instance-id: {0}\n'.format(instance_id))
-
-            if hasattr(vm, 'domain_name'):
-                # Setting the fqdn as a hostname is not standard but
-                # its what cloud-init wants and its difficult to work
-                # around it.  Ideally we'd set the short hostname for
-                # and cloud-init would use it as a hostname without
-                # appending .localdomain. The fqdn should be
-                # determined by the resolver configuration (dns or
-                # host file).
-                f.write('local-hostname: vm{0}.{1}\n'.format(vm.rank, vm.domain_name))
-            else:
-                # For networks without managed DHCP/DNS set a hostname by default
-                f.write('local-hostname: vm%d\n' % (vm.rank))
-
-            f.close()
-
-            if vm.user_data:
-                shutil.copyfile(Config().resolve_path(vm.user_data, vm),
-                                user_data_file)
-            else:
-                shutil.copyfile('/dev/null', user_data_file)
-
-            with open(os.devnull, 'w') as devnull:
-                subprocess.check_call(['genisoimage',
-                                       '-output', iso_file, '-volid', 'cidata', '-joliet',
-                                       '-rock', user_data_file,
-                                       meta_data_file], stdout=devnull, stderr=devnull)
-
-            cmdline += [ '-drive',
-                         'file={0},index=3,media=cdrom'.format(iso_file)]
-
-        except (OSError, IOError, subprocess.CalledProcessError) as err:
-            raise HypervisorError('unable to generate cloud-init iso: '
-                                  + str(err))
+        cmdline += self._setup_cloud_seed(vm)
 
         self._set_vm_state('qemu-start',
                            'starting qemu',
@@ -880,6 +1898,9 @@ username={3}@pcocc
 
         s_mon.close()
 
+        if not (ckpt_dir or warm_manifest):
+            self._release_admission(vm, admission)
+
         qemu_socket_path = batch.get_vm_state_path(vm.rank,
                                                    'qemu_console_socket')
         pcocc_socket_path = batch.get_vm_state_path(vm.rank,
@@ -901,7 +1922,7 @@ username={3}@pcocc
         pcocc_console_sock.listen(0)
 
 
-        if ckpt_dir:
+        if ckpt_dir or warm_manifest:
             # Signal VM restore
             self._set_vm_state('qemu-start',
                            'restoring',
@@ -909,10 +1930,29 @@ username={3}@pcocc
 
             mon = RemoteMonitor(vm)
             while mon.query_status() == 'inmigrate':
-                time.sleep(1)
+                time.sleep(0.1)
+            self._release_admission(vm, admission)
             mon.cont()
             mon.close_monitor()
 
+        if lazy_images:
+            # Fault the RAM in from the page cache rather than storage
+            start_prefetch(lazy_images,
+                           [[[0, os.path.getsize(image)]]
+                            for image in lazy_images])
+
+        if warm_manifest:
+            self._set_vm_state('qemu-start',
+                           'applying identity',
+                           None, vm.rank)
+            try:
+                self._guest_exec(vm, identity_script(
+                        self._vm_hostname(vm),
+                        warm_manifest.get('macs', {}), macs), 60)
+            except PcoccError as err:
+                logging.warning('Unable to apply identity of warm '
+                                'started vm%d: %s', vm.rank, err)
+
         # Signal VM started
         self._set_vm_state('complete',
                            'started',
@@ -1080,20 +2120,184 @@ username={3}@pcocc
         mon.system_reset()
         mon.close_monitor()
 
+    def stop(self, vm):
+        mon = RemoteMonitor(vm)
+        mon.stop()
+        mon.close_monitor()
+
+    def cont(self, vm):
+        mon = RemoteMonitor(vm)
+        mon.cont()
+        mon.close_monitor()
+
+    def recycle_save(self, vm):
+        """Records the current state of a VM as its recycle point
+
+        The memory and device state of the VM and the content of its
+        drives are stored as an internal snapshot of each drive.
+
+        """
+        blocker = self.migration_blocker(vm)
+        if blocker:
+            raise HypervisorError('unable to record recycle point of '
+                                  'vm{0}: {1}'.format(vm.rank, blocker))
+
+        mon = RemoteMonitor(vm)
+        try:
+            res = mon.human_monitor_cmd('savevm ' + RECYCLE_SNAPSHOT)
+        finally:
+            mon.close_monitor()
+
+        if res.strip():
+            raise HypervisorError('unable to record recycle point of '
+                                  'vm{0}: {1}'.format(vm.rank, res.strip()))
+
+    def recycle(self, vm):
+        """Reverts a VM to its recycle point"""
+        mon = RemoteMonitor(vm)
+        try:
+            if not RECYCLE_SNAPSHOT in parse_block_snapshots(mon.query_block(),
+                                                             'bootdisk'):
+                raise HypervisorError('vm{0} has no recycle '
+                                      'point'.format(vm.rank))
+
+            res = mon.human_monitor_cmd('loadvm ' + RECYCLE_SNAPSHOT)
+        finally:
+            mon.close_monitor()
+
+        if res.strip():
+            raise HypervisorError('unable to recycle vm{0}: {1}'.format(
+                    vm.rank, res.strip()))
+
+        # The guest clock went back to the time of the recycle point
+        try:
+            self.guest_set_time(vm, timeout=10)
+        except AgentError:
+            print ('No answer from Qemu agent when trying to set the guest '
+                   'clock: the clock of vm{0} is late'.format(vm.rank))
+
     def human_monitor_cmd(self, vm, cmd):
         mon = RemoteMonitor(vm)
         res = mon.human_monitor_cmd(cmd)
         mon.close_monitor()
         return res
 
-    def checkpoint(self, vm, ckpt_dir):
-        dest_mem_file = self.checkpoint_mem_file(vm, ckpt_dir)
+    def _throttled_drives(self, mon):
+        return dict((blk['device'], blk['inserted'])
+                    for blk in mon.query_block()
+                    if 'inserted' in blk and
+                    re.match(r'(bootdisk|datadisk\d+)$', blk['device']))
 
+    def get_io_throttle(self, vm):
+        """Returns the current I/O limits of each drive of a VM"""
         mon = RemoteMonitor(vm)
-        mon.stop()
+        try:
+            drives = self._throttled_drives(mon)
+        finally:
+            mon.close_monitor()
+
+        res = {}
+        for device, inserted in drives.iteritems():
+            limits = {}
+            for name, key in THROTTLE_QMP_KEYS.iteritems():
+                if inserted.get(key):
+                    limits[name] = inserted[key]
+                if inserted.get(key + '_max'):
+                    limits[name + '-max'] = inserted[key + '_max']
+                    limits['burst-length'] = inserted.get(key + '_max_length',
+                                                          1)
+            if 'group' in inserted:
+                limits['group'] = inserted['group']
+            res[device] = limits
+
+        return res
+
+    def set_io_throttle(self, vm, limits, drives=None):
+        """Updates the I/O limits of the drives of a running VM
+
+        Limits which are not specified are kept. Setting a total limit
+        clears the corresponding read and write limits and conversely. A
+        zero value removes a limit.
+
+        """
+        mon = RemoteMonitor(vm)
+        try:
+            current = self._throttled_drives(mon)
+            if drives is None:
+                drives = sorted(current)
+
+            for device in drives:
+                if device not in current:
+                    raise HypervisorError('no such drive: {0}'.format(device))
+
+                inserted = current[device]
+                args = {}
+                for key in THROTTLE_QMP_KEYS.itervalues():
+                    for suffix in ['', '_max', '_max_length']:
+                        args[key + suffix] = inserted.get(key + suffix, 0)
+
+                for name, value in limits.iteritems():
+                    if name == 'burst-length':
+                        continue
+                    base = name[:-4] if name.endswith('-max') else name
+                    key = THROTTLE_QMP_KEYS[base]
+                    if base != name:
+                        args[key + '_max'] = value
+                        continue
+
+                    args[key] = value
+                    # Total and read/write limits are exclusive
+                    kind, rw = base.split('-')
+                    if value:
+                        others = ['read', 'write'] if rw == 'total' else [
+                            'total']
+                        for other in others:
+                            other_key = THROTTLE_QMP_KEYS[kind + '-' + other]
+                            args[other_key] = 0
+                            args[other_key + '_max'] = 0
+
+                for key in THROTTLE_QMP_KEYS.itervalues():
+                    if not args[key]:
+                        args[key + '_max'] = 0
+                    if not args[key + '_max']:
+                        args[key + '_max_length'] = 1
+                    elif 'burst-length' in limits:
+                        args[key + '_max_length'] = limits['burst-length']
+                    elif not args[key + '_max_length']:
+                        args[key + '_max_length'] = 1
+
+                args['group'] = inserted.get('group',
+                                             'vm{0}'.format(vm.rank))
+                mon.block_set_io_throttle(device, args)
+        finally:
+            mon.close_monitor()
+
+    def _save_memory(self, vm, mon, uri, live=False, max_remaining=0,
+                     deadline=None, ignore_shared=False, progress=None,
+                     bandwidth=None, before_switchover=None):
+        """Saves the memory of a VM to a migration URI
+
+        Unless live is set, the VM must already be stopped. Otherwise,
+        memory is copied while the VM runs and the VM is stopped for
+        the final pass once less than max_remaining bytes are left to
+        copy or after deadline seconds. Returns the time at which the
+        VM was stopped in live mode. If ignore_shared is set, RAM kept
+        in files is left out of the stream. progress is called with the
+        bytes transferred and remaining instead of printing them, and
+        bandwidth caps the transfer rate in bytes per second.
+        before_switchover is called once the VM is stopped for the final
+        pass, while its block devices can still be accessed.
 
+        """
+        start_time = time.time()
+        stop_time = None
         try:
-            mon.start_migration(dest_mem_file)
+            if self._incremental_ram(vm):
+                mon.set_migration_capability('x-ignore-shared',
+                                             ignore_shared)
+            if before_switchover:
+                mon.set_migration_capability('pause-before-switchover', True)
+            mon.start_migration(uri, bandwidth)
             retry_count = 0
             status = 'failed'
 
@@ -1107,6 +2311,12 @@ username={3}@pcocc
                     continue
 
                 status = ret["return"]["status"]
+                if progress and 'ram' in ret["return"]:
+                    ram = ret["return"]["ram"]
+                    progress(int(ram["transferred"]),
+                             int(ram["remaining"])
+                             if status == 'active' else 0)
+
                 if status == "active":
                     remain_mb = (int(ret["return"]["ram"]["remaining"])
                                  // (1024 * 1024))
@@ -1114,21 +2324,41 @@ username={3}@pcocc
                               // (1024 * 1024))
                     remain_pct = 100. * remain_mb / tot_mb
 
-                    if remain_mb > 0:
+                    if remain_mb > 0 and not progress:
                         print ("checkpointing vm%d memory: "
                                "%d MB remaining (%d %%)" )% (
                             vm.rank,
                             remain_mb,
                             remain_pct)
+
+                    if live and stop_time is None and (
+                        int(ret["return"]["ram"]["remaining"]) <= max_remaining
+                        or (deadline is not None and
+                            time.time() - start_time >= deadline)):
+                        mon.stop()
+                        stop_time = time.time()
                 elif status == 'completed':
+                    if live and stop_time is None:
+                        # Qemu stopped the VM by itself for the final pass
+                        stop_time = (time.time() -
+                                     ret["return"].get("downtime", 0) / 1000.)
                     break
+                elif status == 'pre-switchover':
+                    if live and stop_time is None:
+                        stop_time = time.time()
+                    try:
+                        before_switchover()
+                    except:
+                        mon.cancel_migration()
+                        raise
+                    mon.continue_migration('pre-switchover')
                 elif status == 'failed':
                     sys.stderr.write('Memory save error for VM %d, '
                     'output was %s \n' % (vm.rank, data))
                     if retry_count < Config().ckpt_retry_count:
                         retry_count += 1
                         sys.stderr.write('Retrying...\n')
-                        mon.start_migration(dest_mem_file)
+                        mon.start_migration(uri, bandwidth)
                         continue
                     else:
                         break
@@ -1149,12 +2379,436 @@ username={3}@pcocc
             except:
                 pass
             raise CheckpointError(str(err) + ' Monitor sent: ' + data)
-
+        finally:
+            if before_switchover:
+                # Later migrations (such as warm saves) must not pause
+                try:
+                    mon.set_migration_capability('pause-before-switchover',
+                                                 False)
+                except PcoccError:
+                    pass
 
         if status != 'completed':
             raise CheckpointError('status is %s. Monitor sent: ' + data)
 
-        mon.close_monitor()
+        return stop_time
+
+    def _checkpoint_layout(self, vm, ckpt_dir):
+        """Returns the manifest of the memory image of a checkpoint"""
+        settings = vm.checkpoint_settings
+        prefix = os.path.basename(self.checkpoint_mem_file(vm, ckpt_dir))
+        dirs = [Config().resolve_path(d, vm)
+                for d in settings['stripe-dirs']]
+        if dirs:
+            # Stripe directories may be shared by several checkpoints
+            prefix = '{0}-{1}'.format(
+                os.path.basename(os.path.abspath(ckpt_dir)), prefix)
+            for d in dirs:
+                if not os.path.isdir(d):
+                    raise CheckpointError('{0} is not a directory'.format(d))
+        else:
+            dirs = [ckpt_dir]
+
+        return memory_layout(prefix, dirs, settings)
+
+    def checkpoint(self, vm, ckpt_dir, live=False, max_remaining=0,
+                   deadline=None, progress=None, bandwidth=None):
+        """Saves the memory and disk of a VM to a checkpoint
+
+        In live mode, the memory is pre-copied while the VM runs and
+        the disk is saved once the VM is stopped. Otherwise the VM is
+        stopped first, if it isn't already, and its disk is saved
+        before its memory. Returns the time at which the VM was
+        stopped. progress and bandwidth apply to the memory transfer
+        as for _save_memory.
+
+        """
+        manifest_path = self.checkpoint_mem_file(vm, ckpt_dir) + '.yaml'
+        img_file = self.checkpoint_img_file(vm, ckpt_dir)
+        layout = self._checkpoint_layout(vm, ckpt_dir)
+        try:
+            clear_staging(ckpt_dir, vm.rank)
+            staging_dir = self._checkpoint_staging_dir(vm, ckpt_dir)
+            if staging_dir:
+                # Write to node-local storage and drain afterwards
+                files = {}
+                for i, stripe in enumerate(layout['stripes']):
+                    local = os.path.join(staging_dir,
+                                         os.path.basename(stripe))
+                    files[local] = stripe
+                    layout['stripes'][i] = local
+                if not vm.image_dir is None:
+                    local = os.path.join(staging_dir,
+                                         os.path.basename(img_file))
+                    files[local] = img_file
+                    img_file = local
+                save_staging_record(ckpt_dir, vm.rank, vm.get_host(),
+                                    staging_dir, manifest_path, files)
+
+            save_memory_manifest(manifest_path, layout)
+        except CheckpointImageError as err:
+            raise CheckpointError(str(err))
+
+        uri = 'exec:pcocc internal ckpt-write {0}'.format(
+            pipes.quote(manifest_path))
+        incremental = self._incremental_ram(vm)
+
+        # RAM deltas are reported after the migration stream
+        transferred = [0]
+        def _progress(done, remaining):
+            transferred[0] = done
+            progress(done, remaining)
+
+        mem_progress = _progress if progress else None
+        if live:
+            # The disk is saved before the switchover as block devices
+            # are inactive once the migration has completed
+            mon = RemoteMonitor(vm)
+            try:
+                stop_time = self._save_memory(
+                    vm, mon, uri, True, max_remaining, deadline, incremental,
+                    mem_progress, bandwidth,
+                    lambda: self._checkpoint_disk(vm, img_file, mon))
+            finally:
+                mon.close_monitor()
+        else:
+            stop_time = time.time()
+            self.stop(vm)
+            self._checkpoint_disk(vm, img_file)
+            mon = RemoteMonitor(vm)
+            self._save_memory(vm, mon, uri, ignore_shared=incremental,
+                              progress=mem_progress, bandwidth=bandwidth)
+            mon.close_monitor()
+
+        if incremental:
+            self._checkpoint_ram(vm, ckpt_dir, progress and (
+                    lambda written: progress(transferred[0] + written, 0)))
+
+        if vm.checkpoint_settings.get('dedup') and not vm.image_dir is None:
+            self._dedup_checkpoint_disk(vm, img_file)
+
+        return stop_time
+
+    def _checkpoint_ram_manifest(self, vm, ckpt_dir, index):
+        return os.path.join(ckpt_dir, 'ram-vm{0}-{1}.yaml'.format(vm.rank,
+                                                                  index))
+
+    def _checkpoint_ram_manifests(self, vm, ckpt_dir, num_ram):
+        """Returns the manifests of the RAM deltas of a checkpoint"""
+        manifests = [self._checkpoint_ram_manifest(vm, ckpt_dir, i)
+                     for i in xrange(num_ram)]
+        if not os.path.exists(manifests[0]):
+            return []
+
+        return manifests
+
+    def _checkpoint_ram(self, vm, ckpt_dir, progress=None):
+        """Saves the RAM files of a stopped VM as deltas
+
+        Deltas are based on the previous checkpoint of the VM until the
+        chain reaches the maximum length set by the template. progress
+        is called with the number of bytes written so far.
+
+        """
+        batch = Config().batch
+        ram_files = yaml.safe_load(batch.read_key(
+                'cluster/user', self._ram_state_key(vm.rank)) or '[]')
+        if not ram_files:
+            # The RAM of lazily restored VMs is in the migration stream
+            for path in glob.glob(os.path.join(
+                    ckpt_dir, 'ram-vm{0}-*'.format(vm.rank))):
+                try_remove(path)
+            return
+
+        state = yaml.safe_load(batch.read_key(
+                'cluster/user', self._ckpt_state_key(vm.rank)) or '{}')
+        bases = state.get('manifests', [])
+        depth = state.get('depth', 0) + 1
+        if (depth > vm.checkpoint_settings['incremental'] or
+            len(bases) != len(ram_files) or
+            not all(self._valid_ram_base(base, ckpt_dir) for base in bases)):
+            bases = [None] * len(ram_files)
+            depth = 0
+
+        manifests = []
+        written = 0
+        for i, (ram_file, base) in enumerate(zip(ram_files, bases)):
+            manifest_path = self._checkpoint_ram_manifest(vm, ckpt_dir, i)
+            cmd = ['ssh', vm.get_host(), 'pcocc', 'internal', 'ckpt-ram',
+                   ram_file, manifest_path]
+            if base:
+                cmd += ['--base', base]
+            if vm.checkpoint_settings.get('dedup'):
+                cmd += ['--dedup']
+            try:
+                delta = int(subprocess_check_output(cmd))
+            except (OSError, ValueError,
+                    subprocess.CalledProcessError) as err:
+                raise CheckpointError('unable to save RAM of '
+                                      'vm{0}: {1}'.format(vm.rank, err))
+            logging.info('%s: %d MB written',
+                         os.path.basename(manifest_path),
+                         delta // (1024 * 1024))
+            written += delta
+            if progress:
+                progress(written)
+            manifests.append(manifest_path)
+
+        batch.write_key('cluster/user', self._ckpt_state_key(vm.rank),
+                        yaml.dump({'manifests': manifests, 'depth': depth}))
+
+    def _valid_ram_base(self, base, ckpt_dir):
+        """Tells if a RAM delta saved to ckpt_dir may be based on base
+
+        The chain of base must be readable and must not go through
+        ckpt_dir, whose deltas are about to be overwritten when a
+        checkpoint directory is reused.
+
+        """
+        ckpt_dir = os.path.realpath(ckpt_dir)
+        try:
+            chain = ram_chain(base)
+        except CheckpointImageError:
+            return False
+
+        return not any(os.path.dirname(os.path.realpath(m['path'])) ==
+                       ckpt_dir for m in chain)
+
+    def _checkpoint_disk(self, vm, img_file, mon=None):
+        # The VM is stopped so the disk is consistent with the memory
+        if not vm.image_dir is None:
+            self.save(vm, img_file, freeze=VM_FREEZE_OPT.NO, mon=mon)
+
+    def _dedup_checkpoint_disk(self, vm, img_file):
+        """Moves the disk of a checkpoint to its chunk store"""
+        try:
+            subprocess.check_call(['ssh', vm.get_host(), 'pcocc', 'internal',
+                                   'ckpt-dedup', img_file,
+                                   img_file + '.yaml'])
+        except (OSError, subprocess.CalledProcessError) as err:
+            raise CheckpointError('unable to deduplicate disk of '
+                                  'vm{0}: {1}'.format(vm.rank, err))
+
+    def _restore_checkpoint_disk(self, vm, manifest_path):
+        """Rebuilds the deduplicated disk of a checkpoint on this node
+
+        The image is rebuilt next to the overlay of the VM. Returns its
+        path.
+
+        """
+        self._set_vm_state('temporary-disk',
+                           'restoring disk file',
+                           None, vm.rank)
+
+        image_path = self._overlay_path(vm) + '_ckpt'
+        atexit.register(try_remove, image_path)
+        try:
+            restore_file(manifest_path, image_path)
+        except CheckpointImageError as err:
+            raise HypervisorError(str(err))
+
+        return image_path
+
+    def _checkpoint_staging_dir(self, vm, ckpt_dir):
+        """Creates the node-local staging directory of a checkpoint"""
+        staging_dir = vm.checkpoint_settings.get('staging-dir')
+        if not staging_dir:
+            return None
+
+        staging_dir = os.path.join(
+            Config().resolve_path(staging_dir, vm),
+            'pcocc-ckpt-{0}'.format(hashlib.sha1(
+                    os.path.abspath(ckpt_dir)).hexdigest()[:16]))
+        try:
+            subprocess.check_call(['ssh', vm.get_host(),
+                                   'mkdir', '-p', staging_dir])
+        except (OSError, subprocess.CalledProcessError) as err:
+            raise CheckpointError('unable to create staging directory '
+                                  '{0}: {1}'.format(staging_dir, err))
+
+        return staging_dir
+
+    def drain_checkpoint(self, vm, ckpt_dir):
+        """Copies a staged checkpoint from node-local storage"""
+        try:
+            if staged_files(ckpt_dir, vm.rank) is None:
+                return
+        except CheckpointImageError as err:
+            raise CheckpointError(str(err))
+
+        try:
+            subprocess.check_call(['ssh', vm.get_host(), 'pcocc', 'internal',
+                                   'ckpt-drain', os.path.abspath(ckpt_dir),
+                                   str(vm.rank)])
+        except (OSError, subprocess.CalledProcessError) as err:
+            raise CheckpointError('unable to drain checkpoint of '
+                                  'vm{0}: {1}'.format(vm.rank, err))
+
+    def _checkpoint_staged(self, vm, ckpt_dir):
+        """Returns the local files of a checkpoint which is not drained
+
+        They map the final paths of the files and can only be used on
+        the host where the checkpoint was staged.
+
+        """
+        try:
+            staged = staged_files(ckpt_dir, vm.rank)
+        except CheckpointImageError as err:
+            raise HypervisorError(str(err))
+
+        if staged and not all(os.path.exists(local)
+                              for local in staged.itervalues()):
+            raise HypervisorError('checkpoint of vm{0} is not drained and '
+                                  'its files are not on this '
+                                  'node'.format(vm.rank))
+
+        return staged or {}
+
+    def _checkpoint_source(self, vm, ckpt_dir, prefetched=None):
+        """Returns the command reading the memory of a checkpoint
+
+        Also returns the list of files which are read. prefetched maps
+        checkpoint files to local copies.
+
+        """
+        prefetched = prefetched or {}
+        mem_file = self.checkpoint_mem_file(vm, ckpt_dir)
+        try:
+            manifest = load_memory_manifest(mem_file + '.yaml')
+        except CheckpointImageError as err:
+            raise HypervisorError(str(err))
+
+        if manifest is None:
+            # Checkpoints from previous versions
+            mem_file = prefetched.get(mem_file, mem_file)
+            return 'lzop -dc {0}'.format(pipes.quote(mem_file)), [mem_file]
+
+        manifest_path = mem_file + '.yaml'
+        if manifest.get('store'):
+            return ('pcocc internal ckpt-read {0}'.format(
+                    pipes.quote(manifest_path)),
+                    [chunk_store_path(manifest_path, manifest)])
+
+        if any(stripe in prefetched for stripe in manifest['stripes']):
+            manifest['stripes'] = [prefetched.get(stripe, stripe)
+                                   for stripe in manifest['stripes']]
+            manifest_path = os.path.join(
+                os.path.dirname(manifest['stripes'][0]),
+                os.path.basename(manifest_path))
+            try:
+                save_memory_manifest(manifest_path, manifest)
+            except CheckpointImageError as err:
+                raise HypervisorError(str(err))
+            atexit.register(os.remove, manifest_path)
+
+        return ('pcocc internal ckpt-read {0}'.format(
+                pipes.quote(manifest_path)), manifest['stripes'])
+
+    def _restore_dir(self, vm, ckpt_dir):
+        """Returns the node-local directory for restoring a checkpoint"""
+        staging_dir = vm.checkpoint_settings.get('staging-dir')
+        if not staging_dir:
+            return None
+
+        return os.path.join(
+            Config().resolve_path(staging_dir, vm),
+            'pcocc-restore-{0}-vm{1}'.format(hashlib.sha1(
+                    os.path.abspath(ckpt_dir)).hexdigest()[:16], vm.rank))
+
+    def _start_restore_prefetch(self, vm, ckpt_dir):
+        """Copies the memory of a checkpoint to node-local storage
+
+        The copy runs in a background thread. Returns None if the
+        template doesn't enable prefetching.
+
+        """
+        restore_dir = self._restore_dir(vm, ckpt_dir)
+        if not restore_dir or not vm.checkpoint_settings.get('prefetch'):
+            return None
+
+        mem_file = self.checkpoint_mem_file(vm, ckpt_dir)
+        try:
+            manifest = load_memory_manifest(mem_file + '.yaml')
+            sources = manifest['stripes'] if manifest else [mem_file]
+            for manifest_path in glob.glob(os.path.join(
+                    ckpt_dir, 'ram-vm{0}-*.yaml'.format(vm.rank))):
+                sources += [m['data'] for m in ram_chain(manifest_path)
+                            if m['data']]
+        except CheckpointImageError as err:
+            logging.warning('Checkpoint prefetch disabled: %s', err)
+            return None
+
+        # Files which are still staged on this node are already local
+        staged = self._checkpoint_staged(vm, ckpt_dir).values()
+        files = dict((src, os.path.join(restore_dir, '{0}-{1}'.format(
+                        i, os.path.basename(src))))
+                     for i, src in enumerate(sources) if src not in staged)
+        if not files:
+            return None
+
+        if not os.path.isdir(restore_dir):
+            os.makedirs(restore_dir)
+        for dest in files.itervalues():
+            atexit.register(try_remove, dest)
+
+        def _prefetch():
+            start = time.time()
+            try:
+                copy_files(files)
+                logging.info('Prefetched checkpoint in %.1fs',
+                             time.time() - start)
+            except CheckpointImageError as err:
+                thread.error = err
+
+        thread = threading.Thread(target=_prefetch)
+        thread.daemon = True
+        thread.error = None
+        thread.files = files
+        thread.start()
+        return thread
+
+    def _wait_restore_prefetch(self, thread):
+        """Waits for the checkpoint prefetch and returns the local files"""
+        if thread is None:
+            return {}
+
+        thread.join()
+        if thread.error:
+            raise HypervisorError(str(thread.error))
+
+        return thread.files
+
+    def _lazy_ram_images(self, vm, ckpt_dir, ram_manifests, prefetched):
+        """Returns the RAM images to map for a lazy restore
+
+        Chains of deltas are composed in the node-local restore
+        directory. Returns an empty list if the RAM must be restored
+        eagerly.
+
+        """
+        images = []
+        try:
+            for i, manifest_path in enumerate(ram_manifests):
+                image = ram_image(manifest_path)
+                if image:
+                    images.append(prefetched.get(image, image))
+                    continue
+
+                restore_dir = self._restore_dir(vm, ckpt_dir)
+                if not restore_dir:
+                    logging.info('Restoring RAM eagerly as chains of '
+                                 'deltas require a staging directory')
+                    return []
+                if not os.path.isdir(restore_dir):
+                    os.makedirs(restore_dir)
+                image = os.path.join(restore_dir, 'ram-{0}'.format(i))
+                compose_ram(manifest_path, image, prefetched)
+                atexit.register(try_remove, image)
+                images.append(image)
+        except (CheckpointImageError, OSError) as err:
+            raise HypervisorError(str(err))
+
+        return images
 
 
 
@@ -1163,8 +2817,66 @@ username={3}@pcocc
         s_mon.quit()
         s_mon.close_monitor()
 
-    def save(self, vm, dest_img_file, full=False, freeze=VM_FREEZE_OPT.TRY):
-        remote_host = vm.get_host()
+    def _save_state_key(self, vm_rank):
+        return "state/saves/{0}".format(vm_rank)
+
+    def _hardware_state_key(self, vm_rank):
+        return "state/hardware/{0}".format(vm_rank)
+
+    def _ram_state_key(self, vm_rank):
+        return "state/ram/{0}".format(vm_rank)
+
+    def _ckpt_state_key(self, vm_rank):
+        return "state/ckpt/{0}".format(vm_rank)
+
+    def _incremental_base(self, vm, vm_image_path, bitmaps):
+        """Returns the previous save on which the next one may be based
+
+        The bitmap tracks changes since the last save of the VM, which
+        can be used as a backing file if it is still the latest image.
+
+        """
+        if not SAVE_BITMAP in bitmaps:
+            return None
+
+        last_save = Config().batch.read_key('cluster/user',
+                                            self._save_state_key(vm.rank))
+        if not last_save:
+            return None
+
+        last_save = yaml.safe_load(last_save)
+        try:
+            if self._same_file_on_host(vm, last_save['path'], vm_image_path):
+                return vm_image_path
+        except (KeyError, TypeError):
+            pass
+
+        return None
+
+    def _same_file_on_host(self, vm, path1, path2):
+        """Tells if two paths refer to the same file on the VM host
+
+        Saved images may be node-local so paths are compared where the
+        VM runs rather than on the client.
+
+        """
+        try:
+            return subprocess.call(['ssh', vm.get_host(),
+                                    'test', pipes.quote(path1),
+                                    '-ef', pipes.quote(path2)]) == 0
+        except OSError:
+            return False
+
+    def _image_cmd_on_host(self, vm, args, error):
+        """Runs a qemu-img command on the VM host"""
+        try:
+            subprocess.check_call(['ssh', vm.get_host(), 'qemu-img'] +
+                                  [pipes.quote(arg) for arg in args])
+        except (OSError, subprocess.CalledProcessError):
+            raise ImageSaveError(error)
+
+    def save(self, vm, dest_img_file, full=False, freeze=VM_FREEZE_OPT.TRY,
+             mon=None):
         vm_image_path = vm.image_path
         use_fsfreeze = False
 
@@ -1185,55 +2897,166 @@ username={3}@pcocc
                        'saved image could be corrupted if the filesystem '
                        'is accessed')
 
-        if use_fsfreeze:
-            self.fsfreeze(vm)
-
-        try:
+        # A monitor may be passed by callers which already hold it
+        own_mon = mon is None
+        if own_mon:
             mon = RemoteMonitor(vm)
-            mon.drive_backup('bootdisk', dest_img_file)
-            mon.close_monitor()
-        except:
+        try:
+            chain, bitmaps = parse_block_chain(mon.query_block(), 'bootdisk')
+
+            incremental_base = None
+            if not full:
+                incremental_base = self._incremental_base(vm, vm_image_path,
+                                                          bitmaps)
+
+            if incremental_base:
+                # Only copy the blocks modified since the last save on top
+                # of it. The destination may be node-local so the overlay
+                # is created on the VM host.
+                try:
+                    base_format = image_info(incremental_base)['format']
+                except Qcow2Error as err:
+                    raise ImageSaveError(str(err))
+                self._image_cmd_on_host(vm, ['create', '-f', 'qcow2',
+                                             '-b', incremental_base,
+                                             '-F', base_format,
+                                             dest_img_file],
+                                        'Unable to create incremental image')
+                sync = 'incremental'
+                bitmap_action = None
+                print 'Saving changes since the last save of this VM...'
+            else:
+                sync = 'full' if full else 'top'
+                bitmap_action = 'clear' if SAVE_BITMAP in bitmaps else 'add'
+
             if use_fsfreeze:
-                self.fsthaw(vm)
-            raise
+                self.fsfreeze(vm)
+
+            try:
+                mon.drive_backup('bootdisk', dest_img_file, sync,
+                                 SAVE_BITMAP, bitmap_action)
+            except:
+                if use_fsfreeze:
+                    self.fsthaw(vm)
+                raise
+        finally:
+            if own_mon:
+                mon.close_monitor()
 
         if use_fsfreeze:
             self.fsthaw(vm)
 
-        need_rebase = False
-        if full:
-            need_rebase = True
-            new_backing_file = '""'
-            print 'Merging snapshot with backing file to make it standalone...'
-        else:
+        Config().batch.write_key('cluster/user',
+                                 self._save_state_key(vm.rank),
+                                 yaml.dump({'path': dest_img_file}))
+
+        if full or incremental_base:
+            return
+
+        # The snapshot is backed by the image the VM was started from
+        if len(chain) < 2:
+            raise ImageSaveError('unable to determine backing file')
+        backing_file = chain[1]
+
+        # The snapshot may be node-local when staged so it is only
+        # inspected and modified on the VM host
+        if self._same_file_on_host(vm, backing_file, vm_image_path):
+            return
+
+        if (os.path.basename(os.path.dirname(backing_file)) ==
+            ImageCache.entry_key(vm_image_path)):
+            # A node-local copy has the same content so we only need to
+            # update the backing file name
             try:
-                img_info_output =  subprocess_check_output(['ssh', remote_host,
-                                                            'qemu-img', 'info',
-                                                            dest_img_file])
-            except (OSError, subprocess.CalledProcessError):
-                raise ImageSaveError('unable to determine backing file')
-
-            match = re.search(r'backing file: (.+)\n', img_info_output)
-            if not match:
-                raise ImageSaveError('unable to determine backing file. Qemu-img '
-                                     'output was ' + img_info_output)
-
-            backing_file = match.group(1)
-
-            if not os.path.samefile(backing_file, vm_image_path):
-                need_rebase = True
-                new_backing_file = vm_image_path
-                print 'Current snapshot backing file is %s' % backing_file
-                print 'Rebasing snapshot on %s to preserve chaining...' % vm_image_path
-
-        if need_rebase:
+                image_format = image_info(vm_image_path)['format']
+            except Qcow2Error as err:
+                raise ImageSaveError(str(err))
+            self._image_cmd_on_host(vm, ['rebase', '-u',
+                                         '-b', vm_image_path,
+                                         '-F', image_format,
+                                         dest_img_file],
+                                    'Unable to update backing file')
+            return
+
+        print 'Current snapshot backing file is %s' % backing_file
+        print 'Rebasing snapshot on %s to preserve chaining...' % vm_image_path
+        self._image_cmd_on_host(vm, ['rebase', '-b', vm_image_path,
+                                     dest_img_file],
+                                'Unable to rebase disk')
+
+    def warm_save(self, vm, dest_img_file, full=False):
+        """Saves the disk and memory of a VM for warm starts
+
+        The VM is paused so that the disk and memory snapshots are taken
+        at the same instant.
+
+        """
+        blocker = self.migration_blocker(vm)
+        if blocker:
+            raise ImageSaveError('unable to save memory of vm{0}: '
+                                 '{1}'.format(vm.rank, blocker))
+
+        hardware = Config().batch.read_key('cluster/user',
+                                           self._hardware_state_key(vm.rank))
+        if not hardware:
+            raise ImageSaveError('virtual hardware of vm{0} is '
+                                 'unknown'.format(vm.rank))
+        hardware = yaml.safe_load(hardware)
+
+        mem_file, _ = snapshot_paths(dest_img_file)
+
+        # The monitor only accepts one client at a time
+        mon = RemoteMonitor(vm)
+        mon.stop()
+        mon.close_monitor()
+        try:
+            self.save(vm, dest_img_file, full, VM_FREEZE_OPT.NO)
+            print 'Saving memory...'
+            mon = RemoteMonitor(vm)
             try:
-                subprocess.check_call(['ssh', remote_host,
-                                       'qemu-img', 'rebase',
-                                       '-b', new_backing_file,
-                                       dest_img_file])
-            except (OSError, subprocess.CalledProcessError):
-                raise ImageSaveError('Unable to rebase disk')
+                self._save_memory(vm, mon, 'exec:lzop > {0}'.format(
+                        pipes.quote(mem_file)))
+            finally:
+                mon.close_monitor()
+            save_manifest(dest_img_file, hardware['signature'],
+                          hardware['macs'])
+        finally:
+            mon = RemoteMonitor(vm)
+            mon.cont()
+            mon.close_monitor()
+
+    def _guest_exec(self, vm, script, timeout=0):
+        """Runs a shell script in the guest with the Qemu agent"""
+        s_ctl = self._get_agent_ctl_safe(vm, QEMU_GUEST_AGENT_PORT, timeout)
+        try:
+            s_ctl.stdin.write(json.dumps(
+                {'execute': 'guest-exec',
+                 'arguments': {'path': '/bin/sh',
+                               'arg': ['-c', script]}}))
+            data = os.read(s_ctl.stdout.fileno(), QMP_READ_SIZE)
+            pid = json.loads(data)['return']['pid']
+
+            while True:
+                s_ctl.stdin.write(json.dumps(
+                    {'execute': 'guest-exec-status',
+                     'arguments': {'pid': pid}}))
+                data = os.read(s_ctl.stdout.fileno(), QMP_READ_SIZE)
+                ret = json.loads(data)['return']
+                if ret['exited']:
+                    break
+                time.sleep(0.5)
+        except IOError as err:
+            raise AgentError("failed to communicate:  %s" % err)
+        except (KeyError, ValueError):
+            raise AgentError("unexpected answer when "
+                             "running guest command "
+                             "%s\n" % data)
+        finally:
+            s_ctl.terminate()
+
+        if ret.get('exitcode'):
+            raise AgentError('guest command exited with status '
+                             '{0}'.format(ret['exitcode']))
 
     def _get_agent_ctl_safe(self, vm, port='taskcontrolport', timeout=0, kill_atexit=True):
         # We need to make several tries because nc and qemu may drop or
@@ -1412,6 +3235,21 @@ username={3}@pcocc
 
         s_ctl.terminate()
 
+    def guest_set_time(self, vm, port=QEMU_GUEST_AGENT_PORT, timeout=0):
+        s_ctl = self._get_agent_ctl_safe(vm, port, timeout)
+        # Without a time argument, the guest clock is set from the RTC
+        s_ctl.stdin.write('{"execute":"guest-set-time"}')
+        data = os.read(s_ctl.stdout.fileno(), QMP_READ_SIZE)
+        s_ctl.terminate()
+        try:
+            ret = json.loads(data)
+        except:
+            raise AgentError("Failed to parse agent output")
+
+        if "error" in ret:
+            raise AgentError("Error while setting VM time: " +
+                             ret["error"]["desc"])
+
     def exec_cmd(self, vm, cmd, user):
         if cmd:
             s_ctl = self._get_agent_ctl_safe(vm)
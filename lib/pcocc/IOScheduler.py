@@ -0,0 +1,250 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Adaptive scheduling of the checkpoint I/O of a cluster
+
+Each VM is processed by a task which writes to a filesystem. At most a
+fixed number of tasks run at once on each host, and the number of
+tasks writing at once to each filesystem is a window adjusted from the
+measured throughput: it grows by one task as long as the aggregate
+throughput doesn't drop, and is halved when it does, since shared
+filesystems and their metadata servers degrade past their saturation
+point. Windows may be capped by the batch configuration.
+
+A single progress line aggregates the data written by all the tasks
+with the throughput and the estimated remaining time.
+
+"""
+
+import sys
+import time
+import logging
+import threading
+
+# Initial number of tasks writing to a filesystem
+DEFAULT_WINDOW = 4
+
+# Fraction of the best aggregate throughput below which windows shrink
+BACKOFF_THRESHOLD = 0.8
+
+# Interval between progress updates in seconds
+PROGRESS_INTERVAL = 5
+
+class FilesystemWindow(object):
+    """Adaptive number of tasks writing at once to a filesystem"""
+    def __init__(self, limit=None, initial=DEFAULT_WINDOW):
+        self.limit = limit
+        self.size = min(initial, limit) if limit else initial
+        self.active = 0
+        self._best = 0.
+        # Integral of the number of active tasks over time
+        self._busy = 0.
+        self._last = time.time()
+
+    def _account(self):
+        now = time.time()
+        self._busy += self.active * (now - self._last)
+        self._last = now
+
+    def start(self):
+        """Accounts for a starting task and returns its token"""
+        self._account()
+        self.active += 1
+        return self._last, self._busy
+
+    def finish(self, token, written, adapt=True):
+        """Accounts for a completed task which wrote written bytes
+
+        The window is adjusted from the throughput of the task and the
+        average number of tasks which ran alongside it if adapt is set.
+
+        """
+        self._account()
+        self.active -= 1
+        start, busy = token
+        duration = self._last - start
+        if adapt and written and duration > 0:
+            self.update(written / duration, (self._busy - busy) / duration)
+
+    def update(self, throughput, concurrency):
+        """Adjusts the window once a task completed
+
+        throughput is the rate of the task and concurrency the number
+        of tasks which ran alongside it, including itself.
+
+        """
+        aggregate = throughput * concurrency
+        if aggregate >= self._best * BACKOFF_THRESHOLD:
+            self._best = max(self._best, aggregate)
+            # Only grow windows which are actually filled
+            if concurrency > self.size - 1:
+                self.size += 1
+        else:
+            self.size = max(1, self.size // 2)
+            self._best = aggregate
+
+        if self.limit:
+            self.size = min(self.size, self.limit)
+
+def format_bytes(size):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024.
+    return '%.1f TB' % (size)
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+    return '%dm%02ds' % (seconds // 60, seconds % 60)
+
+class IOScheduler(object):
+    """Runs a task for each VM with per host and per filesystem limits
+
+    fs_limits maps filesystem keys to the maximum number of tasks
+    writing to them at once. If adaptive is not set, windows stay at
+    their limit, or unbounded without a limit.
+
+    """
+    def __init__(self, host_concurrency, fs_limits=None, adaptive=True,
+                 initial=DEFAULT_WINDOW, out=None):
+        self._host_concurrency = host_concurrency
+        self._fs_limits = fs_limits or {}
+        self._adaptive = adaptive
+        self._initial = initial
+        self._out = out or sys.stdout
+        self._cond = threading.Condition()
+        self.windows = {}
+
+    def _window(self, fs):
+        if fs not in self.windows:
+            limit = self._fs_limits.get(fs)
+            if self._adaptive:
+                window = FilesystemWindow(limit, self._initial)
+            else:
+                window = FilesystemWindow(limit, limit or sys.maxint)
+            self.windows[fs] = window
+        return self.windows[fs]
+
+    def run(self, vms, func, fs_of, label):
+        """Runs func(vm, report) on each VM and returns the exceptions
+        raised indexed by VM rank
+
+        fs_of(vm) returns the filesystem a VM writes to, or None if
+        there is no limit. Tasks call report(done, left) with the
+        bytes written and left to write by their VM, and return the
+        total bytes written if known.
+
+        """
+        pending = list(vms)
+        running = {}
+        done = {}
+        errors = {}
+        host_active = {}
+        start = time.time()
+        last_progress = start
+
+        def _task(vm, fs, token):
+            window = self._window(fs) if fs is not None else None
+
+            def _report(written, left):
+                with self._cond:
+                    running[vm.rank] = (written, left)
+
+            try:
+                written = func(vm, _report)
+            except Exception as e:
+                written = None
+                errors[vm.rank] = e
+
+            with self._cond:
+                if written is None:
+                    written = running[vm.rank][0]
+                del running[vm.rank]
+                done[vm.rank] = written
+                host_active[vm.get_host()] -= 1
+                if window:
+                    # The window no longer matters once all VMs started
+                    window.finish(token, written,
+                                  self._adaptive and bool(pending) and
+                                  vm.rank not in errors)
+                self._cond.notify()
+
+        with self._cond:
+            while pending or running:
+                for vm in list(pending):
+                    host = vm.get_host()
+                    if host_active.get(host, 0) >= self._host_concurrency:
+                        continue
+                    fs = fs_of(vm)
+                    window = self._window(fs) if fs is not None else None
+                    if window and window.active >= window.size:
+                        continue
+
+                    pending.remove(vm)
+                    host_active[host] = host_active.get(host, 0) + 1
+                    token = window.start() if window else None
+                    running[vm.rank] = (0, 0)
+                    thread = threading.Thread(target=_task,
+                                              args=(vm, fs, token))
+                    thread.daemon = True
+                    thread.start()
+
+                if not (pending or running):
+                    break
+
+                self._cond.wait(1)
+                if time.time() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.time()
+                    self._progress(label, start, len(pending), running,
+                                   done)
+
+            self._progress(label, start, 0, running, done, True)
+
+        return errors
+
+    def _progress(self, label, start, num_pending, running, done,
+                  final=False):
+        written = (sum(w for w, _ in running.itervalues()) +
+                   sum(done.itervalues()))
+        elapsed = max(time.time() - start, 0.001)
+        rate = written / elapsed
+
+        # VMs which didn't start are assumed to be as large as the others
+        sizes = done.values() or [w + l for w, l in running.itervalues()]
+        average = sum(sizes) / max(len(sizes), 1)
+        left = (sum(l for _, l in running.itervalues()) +
+                num_pending * average)
+
+        line = '%s: %d/%d VMs done, %d running, %s at %s/s' % (
+            label, len(done), len(done) + len(running) + num_pending,
+            len(running), format_bytes(written), format_bytes(rate))
+        if not final and rate > 0:
+            line += ', ETA %s' % (format_duration(left / rate))
+        else:
+            line += ' in %s' % (format_duration(elapsed))
+        logging.debug('Checkpoint windows: %s', dict(
+                (fs, w.size) for fs, w in self.windows.iteritems()))
+
+        if self._out.isatty():
+            # Overwrite the previous line
+            self._out.write('\r\033[K' + line + ('\n' if final else ''))
+        else:
+            self._out.write(line + '\n')
+        self._out.flush()
@@ -0,0 +1,484 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Node-local cache of VM images
+
+Images are copied with their whole backing chain in a local directory
+so that VMs don't have to read them from the shared storage. When
+several nodes of a job need the same image, they fetch it through a
+pipelined broadcast tree: only the root reads the image and each node
+forwards the data to its children while writing its own copy.
+
+"""
+
+import os
+import time
+import json
+import errno
+import fcntl
+import socket
+import shutil
+import hashlib
+import logging
+import binascii
+import tempfile
+import threading
+
+import yaml
+
+from .Config import Config
+from .Error import PcoccError
+from .Qcow2 import image_info, set_backing_file
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+class ImageCacheError(PcoccError):
+    """Exception raised when an image cannot be cached locally
+    """
+    def __init__(self, error):
+        super(ImageCacheError, self).__init__('Image cache error: '
+                                              + error)
+
+def image_chain(image_path):
+    """Returns the list of files making an image, from top to base"""
+    chain = []
+    path = os.path.realpath(image_path)
+    while path:
+        if path in chain:
+            raise ImageCacheError('loop in backing chain of '
+                                  + image_path)
+        chain.append(path)
+        backing = image_info(path)['backing-file']
+        if backing and not os.path.isabs(backing):
+            backing = os.path.join(os.path.dirname(path), backing)
+        path = os.path.realpath(backing) if backing else None
+
+    return chain
+
+def broadcast_tree(ranks):
+    """Returns the parent and children of each rank in a binary tree
+
+    The first rank in the list is the root.
+
+    """
+    tree = {}
+    for i, rank in enumerate(ranks):
+        parent = ranks[(i - 1) // 2] if i else None
+        children = [ranks[c] for c in [2 * i + 1, 2 * i + 2]
+                    if c < len(ranks)]
+        tree[rank] = (parent, children)
+    return tree
+
+class ImageCache(object):
+    """A directory holding local copies of images
+
+    Each entry is a directory named after the image identity holding
+    one file per layer of the backing chain. Entries are evicted in
+    least recently used order when the cache exceeds its size
+    budget. VMs hold a shared lock on the entries they use so that
+    they are not evicted.
+
+    """
+    def __init__(self, cache_dir, max_size):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0o700)
+        except OSError as err:
+            raise ImageCacheError('unable to create cache directory: '
+                                  + str(err))
+
+    @staticmethod
+    def entry_key(image_path):
+        path = os.path.realpath(image_path)
+        st = os.stat(path)
+        return hashlib.sha1('{0}:{1}:{2}'.format(
+            path, st.st_size, int(st.st_mtime))).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _lock_path(self, key):
+        return os.path.join(self.cache_dir, key + '.lock')
+
+    def layer_path(self, key, index):
+        return os.path.join(self._entry_path(key), 'layer{0}'.format(index))
+
+    def lookup(self, key):
+        """Returns the top layer of an entry and a lock file
+
+        The lock file must be kept open as long as the entry is in
+        use. Returns None, None if the entry is not in the cache.
+
+        """
+        lock_file = open(self._lock_path(key), 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_SH)
+        try:
+            # Refresh the timestamp used for eviction
+            os.utime(self._entry_path(key), None)
+        except OSError as err:
+            lock_file.close()
+            if err.errno == errno.ENOENT:
+                return None, None
+            raise ImageCacheError(str(err))
+
+        return self.layer_path(key, 0), lock_file
+
+    def _entry_size(self, path):
+        size = 0
+        for f in os.listdir(path):
+            size += os.stat(os.path.join(path, f)).st_blocks * 512
+        return size
+
+    def reserve(self, size):
+        """Evicts entries until size bytes can be added to the cache
+
+        Returns False if there is not enough space left.
+
+        """
+        if size > self.max_size:
+            return False
+
+        entries = []
+        used = 0
+        for f in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, f)
+            if (f.startswith('.') or f.endswith('.lock') or
+                not os.path.isdir(path)):
+                continue
+            try:
+                entry_size = self._entry_size(path)
+                entries.append((os.stat(path).st_mtime, f, entry_size))
+            except OSError:
+                continue
+            used += entry_size
+
+        for _, key, entry_size in sorted(entries):
+            if used + size <= self.max_size:
+                break
+
+            lock_file = open(self._lock_path(key), 'a')
+            try:
+                # Skip entries used by running VMs
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock_file.close()
+                continue
+
+            logging.info('Evicting image %s from cache', key)
+            try:
+                shutil.rmtree(self._entry_path(key))
+                os.unlink(self._lock_path(key))
+                used -= entry_size
+            except OSError:
+                pass
+            finally:
+                lock_file.close()
+
+        return used + size <= self.max_size
+
+    def new_entry(self):
+        """Returns a temporary directory to fill a new entry"""
+        return tempfile.mkdtemp(prefix='.tmp', dir=self.cache_dir)
+
+    def commit_entry(self, key, tmp_dir, num_layers):
+        """Makes a filled entry available in the cache
+
+        Backing files of the layers are updated to point to their
+        local copies.
+
+        """
+        for i in xrange(num_layers - 1):
+            path = os.path.join(tmp_dir, 'layer{0}'.format(i))
+            backing = os.path.join(tmp_dir, 'layer{0}'.format(i + 1))
+            set_backing_file(path, self.layer_path(key, i + 1),
+                             image_info(backing)['format'])
+
+        try:
+            os.rename(tmp_dir, self._entry_path(key))
+        except OSError as err:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            # Someone else cached the same image
+            if err.errno not in [errno.EEXIST, errno.ENOTEMPTY]:
+                raise ImageCacheError(str(err))
+
+def _recv_line(sock):
+    line = ''
+    while not line.endswith('\n'):
+        data = sock.recv(1)
+        if not data:
+            raise ImageCacheError('connection closed by peer')
+        line += data
+    return line
+
+def _forward(children, data):
+    for child in list(children):
+        try:
+            child.sendall(data)
+        except socket.error as err:
+            logging.warning('Dropping image cache peer: %s', err)
+            children.remove(child)
+            child.close()
+
+class ImageBroadcast(object):
+    """Fetches an image in the node cache through a broadcast tree
+
+    One process per node, the leader, takes part in the transfer. The
+    participating nodes publish whether they already have the image
+    in the keystore and a tree is built, rooted at a node which has the
+    image or at the first one if none has it.
+
+    Each of the num_vms VMs using the image acknowledges the end of the
+    transfer and the keys are deleted once all of them did so that
+    the image may be broadcast again within the same job.
+
+    """
+    def __init__(self, cache, image_path, host_ranks, num_vms, timeout):
+        self.cache = cache
+        self.image_path = image_path
+        self.host_ranks = sorted(host_ranks)
+        self.num_vms = num_vms
+        self.timeout = timeout
+        self.key = ImageCache.entry_key(image_path)
+
+    def _key_dir(self):
+        return 'image-cache/{0}'.format(self.key)
+
+    def _done_dir(self):
+        return 'image-cache-done/{0}'.format(self.key)
+
+    def _done_key(self, host_rank):
+        return '{0}/{1}'.format(self._done_dir(), host_rank)
+
+    def _ack_dir(self):
+        return 'image-cache-ack/{0}'.format(self.key)
+
+    def wait(self):
+        """Waits for the node leader and returns the cached image"""
+        batch = Config().batch
+        try:
+            batch.read_key('cluster/user', self._done_key(batch.node_rank),
+                           blocking=True, timeout=self.timeout)
+        finally:
+            self._acknowledge(False)
+        return self.cache.lookup(self.key)
+
+    def fetch(self, cleanup=False):
+        """Takes part in the broadcast and returns the cached image
+
+        If cleanup is set, the keys of the broadcast are deleted in the
+        background once all the VMs acknowledged its end.
+
+        """
+        batch = Config().batch
+        try:
+            return self._fetch()
+        finally:
+            batch.write_key('cluster/user', self._done_key(batch.node_rank),
+                            'done')
+            self._acknowledge(cleanup)
+
+    def _acknowledge(self, cleanup):
+        batch = Config().batch
+        batch.write_key('cluster/user', '{0}/{1}'.format(self._ack_dir(),
+                                                         batch.task_rank),
+                        'done')
+        if cleanup:
+            thread = threading.Thread(target=self._cleanup)
+            thread.daemon = True
+            thread.start()
+
+    def _cleanup(self):
+        batch = Config().batch
+        try:
+            batch.wait_child_count('cluster/user', self._ack_dir(),
+                                   self.num_vms, timeout=self.timeout)
+        except PcoccError as err:
+            logging.warning('Image broadcast not acknowledged by all VMs: %s',
+                            err)
+
+        for key_dir in [self._key_dir(), self._done_dir(), self._ack_dir()]:
+            try:
+                batch.delete_dir('cluster/user', key_dir)
+            except Exception as err:
+                logging.warning('Failed to delete image broadcast keys: %s',
+                                err)
+
+    def _fetch(self):
+        batch = Config().batch
+        path, lock_file = self.cache.lookup(self.key)
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('', 0))
+            listener.listen(4)
+            listener.settimeout(self.timeout)
+
+            token = binascii.hexlify(os.urandom(16))
+            batch.write_key('cluster/user',
+                            '{0}/{1}'.format(self._key_dir(),
+                                             batch.node_rank),
+                            yaml.dump({'have': path is not None,
+                                       'host': batch.nodeset[batch.node_rank],
+                                       'port': listener.getsockname()[1],
+                                       'token': token}))
+
+            ret = batch.wait_child_count('cluster/user', self._key_dir(),
+                                         len(self.host_ranks),
+                                         timeout=self.timeout)
+            peers = {}
+            for child in ret.children:
+                peers[int(os.path.basename(child.key))] = yaml.safe_load(
+                    child.value)
+
+            have = [r for r in self.host_ranks if peers[r]['have']]
+            need = [r for r in self.host_ranks if not peers[r]['have']]
+            if not need:
+                return path, lock_file
+
+            if have:
+                order = [have[0]] + need
+            else:
+                order = need
+
+            tree = broadcast_tree(order)
+            if batch.node_rank not in tree:
+                return path, lock_file
+
+            parent, children = tree[batch.node_rank]
+            return self._transfer(listener, token, peers, parent, children,
+                                  path, lock_file)
+        finally:
+            listener.close()
+
+    def _connect_parent(self, peer):
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                sock = socket.create_connection((peer['host'], peer['port']),
+                                                self.timeout)
+                sock.sendall(peer['token'] + '\n')
+                return sock
+            except socket.error:
+                if time.time() > deadline:
+                    raise
+                time.sleep(1)
+
+    def _accept_children(self, listener, token, num_children):
+        children = []
+        deadline = time.time() + self.timeout
+        while len(children) < num_children and time.time() < deadline:
+            try:
+                sock, _ = listener.accept()
+            except socket.timeout:
+                break
+            sock.settimeout(self.timeout)
+            try:
+                if _recv_line(sock).strip() == token:
+                    children.append(sock)
+                    continue
+            except (socket.error, ImageCacheError):
+                pass
+            sock.close()
+
+        if len(children) < num_children:
+            logging.warning('Only %d of %d image cache peers connected',
+                            len(children), num_children)
+        return children
+
+    def _transfer(self, listener, token, peers, parent, children,
+                  path, lock_file):
+        source = None
+        if parent is not None:
+            source = self._connect_parent(peers[parent])
+            source.settimeout(self.timeout)
+
+        children = self._accept_children(listener, token, len(children))
+
+        tmp_dir = None
+        try:
+            if source:
+                header = _recv_line(source)
+                layers = json.loads(header)
+            else:
+                if path:
+                    files = [self.cache.layer_path(self.key, i) for i in
+                             xrange(len(os.listdir(os.path.dirname(path))))]
+                else:
+                    files = image_chain(self.image_path)
+                layers = [os.path.getsize(f) for f in files]
+                header = json.dumps(layers) + '\n'
+
+            _forward(children, header)
+
+            # Whatever happens, data is forwarded to the children but
+            # it is only written locally if we don't have it and there
+            # is enough room in the cache
+            if not path and self.cache.reserve(sum(layers)):
+                tmp_dir = self.cache.new_entry()
+
+            for i, size in enumerate(layers):
+                dest = None
+                if tmp_dir:
+                    dest = open(os.path.join(tmp_dir,
+                                             'layer{0}'.format(i)), 'wb')
+                src = None
+                if not source:
+                    src = open(files[i], 'rb')
+
+                remaining = size
+                while remaining:
+                    if source:
+                        data = source.recv(min(CHUNK_SIZE, remaining))
+                        if not data:
+                            raise ImageCacheError('connection closed '
+                                                  'by peer')
+                    else:
+                        data = src.read(min(CHUNK_SIZE, remaining))
+                        if not data:
+                            raise ImageCacheError('{0} was truncated'.format(
+                                    files[i]))
+                    remaining -= len(data)
+                    _forward(children, data)
+                    if dest:
+                        # Keep images sparse
+                        if data.strip('\x00'):
+                            dest.write(data)
+                        else:
+                            dest.seek(len(data), os.SEEK_CUR)
+
+                if dest:
+                    dest.truncate(size)
+                    dest.close()
+                if src:
+                    src.close()
+
+            if tmp_dir:
+                self.cache.commit_entry(self.key, tmp_dir, len(layers))
+                return self.cache.lookup(self.key)
+
+            return path, lock_file
+        except (IOError, OSError, socket.error, ValueError) as err:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise ImageCacheError(str(err))
+        finally:
+            for sock in children + [source]:
+                if sock:
+                    sock.close()
@@ -19,10 +19,12 @@
 import signal
 import threading
 import os
+import time
 import fcntl
 import select
 import logging
 import errno
+import re
 import socket
 import datetime
 import jsonschema
@@ -142,6 +144,204 @@ epoch = datetime.datetime.utcfromtimestamp(0)
 def datetime_to_epoch(dt):
     return int((dt - epoch).total_seconds())
 
+size_units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+def parse_size(size):
+    """Converts a size in bytes with an optional K/M/G/T suffix to an int"""
+    if isinstance(size, (int, long)):
+        return size
+
+    match = re.match(r'^\s*(\d+)\s*([KMGT]?)i?B?\s*$', str(size),
+                     re.IGNORECASE)
+    if not match:
+        raise ValueError('invalid size: {0}'.format(size))
+
+    return int(match.group(1)) * size_units[match.group(2).upper()]
+
+io_limit_names = ['iops-total', 'iops-read', 'iops-write',
+                  'bps-total', 'bps-read', 'bps-write']
+def parse_io_limits(limits, partial=False):
+    """Validates I/O throttling limits and converts them to ints
+
+    Each limit may have a burst value with a -max suffix. Bandwidth
+    limits accept a size suffix. Unless partial is set, the limits are
+    also checked for consistency as a whole.
+
+    """
+    if not isinstance(limits, dict):
+        raise ValueError('I/O limits must be a key/value mapping')
+
+    parsed = {}
+    for name, value in limits.iteritems():
+        base = name[:-4] if name.endswith('-max') else name
+        if base not in io_limit_names and name != 'burst-length':
+            raise ValueError('unknown I/O limit: {0}'.format(name))
+        try:
+            if base.startswith('bps-'):
+                value = parse_size(value)
+            else:
+                value = int(value)
+        except (TypeError, ValueError):
+            raise ValueError('invalid value for {0}: {1}'.format(name,
+                                                                 value))
+        if value < 0 or (base == 'burst-length' and value < 1):
+            raise ValueError('invalid value for {0}: {1}'.format(name,
+                                                                 value))
+        parsed[name] = value
+
+    if partial:
+        return parsed
+
+    for kind in ['iops', 'bps']:
+        total = '{0}-total'.format(kind)
+        for rw in ['read', 'write']:
+            if parsed.get(total) and parsed.get('{0}-{1}'.format(kind, rw)):
+                raise ValueError('{0} cannot be combined with '
+                                 '{1}-{2}'.format(total, kind, rw))
+
+    for name in io_limit_names:
+        burst = parsed.get(name + '-max', 0)
+        if burst and burst < parsed.get(name, 0):
+            raise ValueError('{0}-max must be higher than '
+                             '{0}'.format(name))
+        if burst and not parsed.get(name):
+            raise ValueError('{0}-max requires {0}'.format(name))
+
+    return parsed
+
+semaphore_schema = """
+type: object
+properties:
+  holders:
+    type: object
+  waiters:
+    type: object
+required:
+  - holders
+  - waiters
+"""
+
+class KeySemaphore(object):
+    """Counting semaphore shared by the processes of a job
+
+    Holders and waiters are recorded in a key of the keystore. Waiters
+    are admitted in arrival order. Entries of holders which died
+    without releasing the semaphore expire after stale_delay seconds,
+    and waiters which stopped refreshing their entry after wait_delay
+    seconds.
+
+    """
+    def __init__(self, key_path, count, stale_delay=1800, wait_delay=60):
+        if count <= 0:
+            raise ValueError('Invalid semaphore count: {0}'.format(count))
+
+        self.key_path = key_path
+        self.count = count
+        self.stale_delay = stale_delay
+        self.wait_delay = wait_delay
+
+    def try_acquire(self, holder):
+        """Tries to acquire the semaphore for holder
+
+        Returns 0 if the semaphore was acquired or the position of
+        holder in the queue of waiters.
+
+        """
+        return Config().batch.atom_update_key(
+            'cluster/user',
+            self.key_path,
+            self._do_acquire,
+            holder)
+
+    def acquire(self, holder, progress=None):
+        """Waits until the semaphore is acquired for holder
+
+        progress is called with the position of holder in the queue
+        of waiters when it changes.
+
+        Waiters watch the key and only update it when they may be
+        admitted or to refresh their entry before it expires, so that
+        a change doesn't make all of them update the key in turn.
+
+        """
+        from .Batch import KeyTimeoutError
+        batch = Config().batch
+
+        last_position = None
+        while True:
+            position = self.try_acquire(holder)
+            refresh = time.time() + self.wait_delay / 2.
+
+            while position:
+                if progress and position != last_position:
+                    progress(position)
+                last_position = position
+
+                state, index = batch.read_key_index('cluster/user',
+                                                    self.key_path)
+                _, position = self._do_acquire(holder, state)
+                timeout = refresh - time.time()
+                if not position or timeout <= 0:
+                    break
+
+                try:
+                    batch.wait_key_index('cluster/user', self.key_path,
+                                         index, timeout=timeout)
+                except KeyTimeoutError:
+                    break
+            else:
+                return
+
+    def release(self, holder):
+        return Config().batch.atom_update_key(
+            'cluster/user',
+            self.key_path,
+            self._do_release,
+            holder)
+
+    def _load_state(self, state):
+        if not state:
+            return {'holders': {}, 'waiters': {}}
+
+        state = yaml.safe_load(state)
+        jsonschema.validate(state,
+                            yaml.safe_load(semaphore_schema))
+        return state
+
+    def _do_acquire(self, holder, state):
+        """Helper to acquire the semaphore using the key/value store"""
+        state = self._load_state(state)
+        now = time.time()
+
+        for h, since in state['holders'].items():
+            if now - since > self.stale_delay:
+                del state['holders'][h]
+        for w, (_, seen) in state['waiters'].items():
+            if now - seen > self.wait_delay and w != holder:
+                del state['waiters'][w]
+
+        if holder in state['holders']:
+            return yaml.dump(state), 0
+
+        arrival = state['waiters'].get(holder, [now, now])[0]
+        state['waiters'][holder] = [arrival, now]
+
+        queue = sorted(state['waiters'],
+                       key=lambda w: (state['waiters'][w][0], str(w)))
+        position = queue.index(holder)
+        if position < self.count - len(state['holders']):
+            del state['waiters'][holder]
+            state['holders'][holder] = now
+            return yaml.dump(state), 0
+
+        return yaml.dump(state), position + 1
+
+    def _do_release(self, holder, state):
+        """Helper to release the semaphore using the key/value store"""
+        state = self._load_state(state)
+        state['holders'].pop(holder, None)
+        state['waiters'].pop(holder, None)
+        return yaml.dump(state), None
+
 #Schema to validate the global key state in the key/value store
 
 id_allocation_schema = """
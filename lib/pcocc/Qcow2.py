@@ -0,0 +1,228 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Minimal handling of qcow2 image headers
+
+This allows creating empty images and overlays and changing the backing
+file of an image without spawning qemu-img.
+
+"""
+
+import os
+import struct
+
+from .Error import PcoccError
+
+QCOW2_MAGIC = 'QFI\xfb'
+QCOW2_VERSION = 3
+QCOW2_HEADER_LENGTH = 104
+
+# Header extensions
+QCOW2_EXT_END = 0
+QCOW2_EXT_BACKING_FORMAT = 0xE2792ACA
+
+# Compatible feature bits
+QCOW2_COMPAT_LAZY_REFCOUNTS = 1
+
+# 16 bit refcounts
+QCOW2_REFCOUNT_ORDER = 4
+
+class Qcow2Error(PcoccError):
+    """Exception raised when a qcow2 image cannot be handled
+    """
+    def __init__(self, error):
+        super(Qcow2Error, self).__init__('qcow2 error: ' + error)
+
+def _div_round_up(a, b):
+    return (a + b - 1) // b
+
+def image_info(path):
+    """Returns the format, virtual size and backing file of an image"""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(QCOW2_HEADER_LENGTH)
+            if header[:4] != QCOW2_MAGIC:
+                f.seek(0, os.SEEK_END)
+                return {'format': 'raw',
+                        'virtual-size': f.tell(),
+                        'backing-file': None}
+
+            (backing_offset,
+             backing_size) = struct.unpack('>QI', header[8:20])
+            virtual_size = struct.unpack('>Q', header[24:32])[0]
+            backing_file = None
+            if backing_offset:
+                f.seek(backing_offset)
+                backing_file = f.read(backing_size)
+    except (IOError, struct.error) as err:
+        raise Qcow2Error('unable to read {0}: {1}'.format(path, err))
+
+    return {'format': 'qcow2',
+            'virtual-size': virtual_size,
+            'backing-file': backing_file}
+
+def _backing_path(path, backing_file):
+    # Relative backing files are relative to the image directory
+    return os.path.join(os.path.dirname(path), backing_file)
+
+def _header_extensions(backing_format):
+    data = ''
+    if backing_format:
+        data += struct.pack('>II', QCOW2_EXT_BACKING_FORMAT,
+                            len(backing_format))
+        data += backing_format
+        data += '\x00' * (-len(backing_format) % 8)
+
+    data += struct.pack('>II', QCOW2_EXT_END, 0)
+    return data
+
+def create_image(path, size, cluster_size=65536, lazy_refcounts=False,
+                 backing_file='', backing_format=None):
+    """Creates an empty qcow2 v3 image of the given virtual size"""
+    if (cluster_size < 512 or cluster_size > 2 * 1024 * 1024 or
+        cluster_size & (cluster_size - 1)):
+        raise Qcow2Error('invalid cluster size {0}'.format(cluster_size))
+    cluster_bits = cluster_size.bit_length() - 1
+
+    l1_size = _div_round_up(size, cluster_size * (cluster_size // 8))
+    l1_clusters = max(1, _div_round_up(l1_size * 8, cluster_size))
+
+    # Find how many refcount blocks are needed to cover the metadata
+    # clusters, including the refcount structures themselves
+    refcounts_per_block = cluster_size * 8 // (1 << QCOW2_REFCOUNT_ORDER)
+    rb_clusters = 1
+    while True:
+        rt_clusters = _div_round_up(rb_clusters * 8, cluster_size)
+        total_clusters = 1 + rt_clusters + rb_clusters + l1_clusters
+        needed = _div_round_up(total_clusters, refcounts_per_block)
+        if needed <= rb_clusters:
+            break
+        rb_clusters = needed
+
+    rt_offset = cluster_size
+    rb_offset = rt_offset + rt_clusters * cluster_size
+    l1_offset = rb_offset + rb_clusters * cluster_size
+
+    extensions = _header_extensions(backing_format)
+    if backing_file:
+        backing_offset = QCOW2_HEADER_LENGTH + len(extensions)
+        if backing_offset + len(backing_file) > cluster_size:
+            raise Qcow2Error('backing file name is too long')
+    else:
+        backing_offset = 0
+
+    compat = 0
+    if lazy_refcounts:
+        compat |= QCOW2_COMPAT_LAZY_REFCOUNTS
+
+    header = struct.pack('>4sIQIIQIIQQIIQQQQII',
+                         QCOW2_MAGIC, QCOW2_VERSION,
+                         backing_offset, len(backing_file),
+                         cluster_bits, size,
+                         0, l1_size, l1_offset,
+                         rt_offset, rt_clusters,
+                         0, 0,
+                         0, compat, 0,
+                         QCOW2_REFCOUNT_ORDER, QCOW2_HEADER_LENGTH)
+
+    refcount_table = ''.join(struct.pack('>Q', rb_offset + i * cluster_size)
+                             for i in xrange(rb_clusters))
+    refcount_blocks = struct.pack('>H', 1) * total_clusters
+
+    try:
+        with open(path, 'wb') as f:
+            f.write(header + extensions + backing_file)
+            f.seek(rt_offset)
+            f.write(refcount_table)
+            f.seek(rb_offset)
+            f.write(refcount_blocks)
+            # The L1 table is left zeroed
+            f.truncate(total_clusters * cluster_size)
+    except IOError as err:
+        raise Qcow2Error('unable to create {0}: {1}'.format(path, err))
+
+def create_overlay(path, backing_file, cluster_size=65536,
+                   lazy_refcounts=False):
+    """Creates an empty qcow2 v3 image backed by backing_file
+
+    The backing file format is probed so that Qemu doesn't have to
+    guess it, and the overlay gets the same virtual size.
+
+    """
+    info = image_info(_backing_path(path, backing_file))
+    create_image(path, info['virtual-size'], cluster_size, lazy_refcounts,
+                 backing_file, info['format'])
+
+def set_backing_file(path, backing_file, backing_format=None):
+    """Changes the backing file of a qcow2 image in place
+
+    This is equivalent to an unsafe rebase: the guest visible content
+    is only preserved if the new backing file has the same content as
+    the previous one. An empty backing_file makes the image standalone.
+    The backing format is probed unless specified.
+
+    """
+    try:
+        with open(path, 'r+b') as f:
+            header = f.read(QCOW2_HEADER_LENGTH)
+            if header[:4] != QCOW2_MAGIC:
+                raise Qcow2Error('{0} is not a qcow2 image'.format(path))
+
+            version = struct.unpack('>I', header[4:8])[0]
+            cluster_bits = struct.unpack('>I', header[20:24])[0]
+            if version < 3:
+                header_length = 72
+            else:
+                header_length = struct.unpack('>I', header[100:104])[0]
+
+            # Extensions end before the backing file name if any
+            old_backing_offset = struct.unpack('>Q', header[8:16])[0]
+            ext_end = old_backing_offset or (1 << cluster_bits)
+
+            # Keep all extensions except the backing format
+            f.seek(header_length)
+            extensions = ''
+            while f.tell() + 8 <= ext_end:
+                ext_type, ext_len = struct.unpack('>II', f.read(8))
+                if ext_type == QCOW2_EXT_END:
+                    break
+                data = f.read(ext_len + (-ext_len % 8))
+                if ext_type != QCOW2_EXT_BACKING_FORMAT:
+                    extensions += struct.pack('>II', ext_type, ext_len) + data
+
+            if backing_file:
+                if not backing_format:
+                    backing_format = image_info(
+                        _backing_path(path, backing_file))['format']
+                extensions += _header_extensions(backing_format)
+            else:
+                extensions += _header_extensions(None)
+
+            backing_offset = header_length + len(extensions)
+            if backing_offset + len(backing_file) > (1 << cluster_bits):
+                raise Qcow2Error('backing file name is too long')
+
+            f.seek(header_length)
+            f.write(extensions + backing_file)
+            f.seek(8)
+            if backing_file:
+                f.write(struct.pack('>QI', backing_offset, len(backing_file)))
+            else:
+                f.write(struct.pack('>QI', 0, 0))
+    except (IOError, struct.error) as err:
+        raise Qcow2Error('unable to update {0}: {1}'.format(path, err))
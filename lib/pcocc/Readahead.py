@@ -0,0 +1,244 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Boot-time readahead of VM images
+
+The parts of an image read during a boot are recorded by dropping the
+image from the host page cache before the VM starts and looking at
+which pages are resident after a boot window. Later boots prefetch
+these extents with large sequential reads while Qemu starts.
+
+"""
+
+import os
+import time
+import errno
+import ctypes
+import ctypes.util
+import logging
+import tempfile
+import threading
+
+import yaml
+
+from .Error import PcoccError
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# Extents closer than this are merged to issue larger reads
+MERGE_GAP = 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+
+# Size of the windows mapped to query page residency
+MAP_WINDOW = 1024 * 1024 * 1024
+
+PROT_READ = 1
+MAP_SHARED = 1
+POSIX_FADV_DONTNEED = 4
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+_libc.mmap.restype = ctypes.c_void_p
+_libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                       ctypes.c_int, ctypes.c_int, ctypes.c_long]
+_libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+_libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                          ctypes.POINTER(ctypes.c_ubyte)]
+_libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_long,
+                                ctypes.c_long, ctypes.c_int]
+
+class ReadaheadError(PcoccError):
+    """Exception raised when a readahead trace cannot be handled
+    """
+    def __init__(self, error):
+        super(ReadaheadError, self).__init__('Boot readahead error: '
+                                             + error)
+
+def drop_cache(path):
+    """Evicts a file from the host page cache"""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        ret = _libc.posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+        if ret:
+            raise ReadaheadError('fadvise failed on {0}: {1}'.format(
+                path, os.strerror(ret)))
+    finally:
+        os.close(fd)
+
+def resident_extents(path):
+    """Returns the list of [offset, length] of a file in the page cache"""
+    extents = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        for start in xrange(0, size, MAP_WINDOW):
+            length = min(MAP_WINDOW, size - start)
+            addr = _libc.mmap(None, length, PROT_READ, MAP_SHARED, fd, start)
+            if addr in [None, ctypes.c_void_p(-1).value]:
+                raise ReadaheadError('unable to map {0}: {1}'.format(
+                    path, os.strerror(ctypes.get_errno())))
+            try:
+                pages = (length + PAGE_SIZE - 1) // PAGE_SIZE
+                vec = (ctypes.c_ubyte * pages)()
+                if _libc.mincore(addr, length, vec):
+                    raise ReadaheadError('mincore failed on {0}: {1}'.format(
+                        path, os.strerror(ctypes.get_errno())))
+            finally:
+                _libc.munmap(addr, length)
+
+            for i in xrange(pages):
+                if vec[i] & 1:
+                    extents.append([start + i * PAGE_SIZE, PAGE_SIZE])
+    finally:
+        os.close(fd)
+
+    return merge_extents(extents)
+
+def merge_extents(extents, gap=0):
+    """Sorts extents and merges those separated by less than gap bytes"""
+    merged = []
+    for offset, length in sorted(extents):
+        if merged and offset <= merged[-1][0] + merged[-1][1] + gap:
+            end = max(merged[-1][0] + merged[-1][1], offset + length)
+            merged[-1][1] = end - merged[-1][0]
+        else:
+            merged.append([offset, length])
+    return merged
+
+def trace_key(path):
+    st = os.stat(path)
+    return '{0}:{1}'.format(st.st_size, int(st.st_mtime))
+
+def load_trace(trace_path, image_path, chain):
+    """Returns the extents to prefetch for each file of an image chain
+
+    The chain may be a copy of image_path from which the trace was
+    recorded. Returns None if there is no trace or if it doesn't match
+    the image.
+
+    """
+    try:
+        with open(trace_path, 'r') as f:
+            trace = yaml.safe_load(f)
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            return None
+        raise ReadaheadError(str(err))
+    except yaml.YAMLError as err:
+        raise ReadaheadError(str(err))
+
+    if (not isinstance(trace, dict) or
+        trace.get('key') != trace_key(image_path) or
+        len(trace.get('layers', [])) != len(chain)):
+        return None
+
+    return trace['layers']
+
+def save_trace(trace_path, image_path, layers):
+    """Atomically writes the trace of an image"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(trace_path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            yaml.safe_dump({'key': trace_key(image_path),
+                            'layers': layers}, f)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, trace_path)
+    except (IOError, OSError) as err:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise ReadaheadError(str(err))
+
+def prefetch(chain, layers):
+    """Reads the traced extents of each file of an image chain"""
+    buf = bytearray(READ_SIZE)
+    total = 0
+    for path, extents in zip(chain, layers):
+        with open(path, 'rb', 0) as f:
+            for offset, length in merge_extents(extents, MERGE_GAP):
+                f.seek(offset)
+                while length > 0:
+                    view = memoryview(buf)[:min(READ_SIZE, length)]
+                    count = f.readinto(view)
+                    if not count:
+                        break
+                    length -= count
+                    total += count
+    return total
+
+def start_prefetch(chain, layers):
+    """Prefetches the traced extents in a background thread"""
+    def _prefetch():
+        start = time.time()
+        try:
+            total = prefetch(chain, layers)
+            logging.info('Prefetched %d MB of image in %.1fs',
+                         total // (1024 * 1024), time.time() - start)
+        except (IOError, OSError) as err:
+            logging.warning('Image prefetch failed: %s', err)
+
+    thread = threading.Thread(target=_prefetch)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def start_recording(chain, image_path, trace_path, window):
+    """Records a boot trace in a background thread
+
+    The chain must have been dropped from the page cache before
+    starting the VM.
+
+    """
+    def _record():
+        time.sleep(window)
+        try:
+            layers = [resident_extents(path) for path in chain]
+            save_trace(trace_path, image_path, layers)
+            logging.info('Recorded boot readahead trace %s', trace_path)
+        except (PcoccError, OSError) as err:
+            logging.warning('Unable to record boot trace: %s', err)
+        finally:
+            try:
+                os.unlink(trace_path + '.recording')
+            except OSError:
+                pass
+
+    thread = threading.Thread(target=_record)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def claim_recording(trace_path, stale_delay=3600):
+    """Returns True if we should record the trace
+
+    Only one VM records a given trace at a time.
+
+    """
+    marker = trace_path + '.recording'
+    try:
+        if time.time() - os.stat(marker).st_mtime > stale_delay:
+            os.unlink(marker)
+    except OSError:
+        pass
+
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                         0o644))
+        return True
+    except OSError:
+        return False
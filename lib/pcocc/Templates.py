@@ -26,6 +26,8 @@ from .scripts.Shine.TextTable import TextTable
 from .Config import Config
 from .Error import InvalidConfigurationError
 from .Backports import OrderedDict
+from .Misc import parse_size, parse_io_limits
+from .Checkpoint import CODECS, CODEC_LEVELS
 
 # For each valid setting, is it required, whats the default value and is it
 # inheritable
@@ -37,6 +39,7 @@ template_settings = {'image': (False, None, True),
                      'mount-points': (False, [], True),
                      'user-data': (False, None, True),
                      'instance-id': (False, None, True),
+                     'cloud-seed': (False, 'iso', True),
                      'inherits': (False, None, True),
                      'full-node': (False, False, True),
                      'emulator-cores': (False, 0, True),
@@ -46,6 +49,19 @@ template_settings = {'image': (False, None, True),
                      'remote-display': (False, None, True),
                      'description': (False, '', False),
                      'persistent-drives': (False, [], True),
+                     'overlay': (False, None, True),
+                     'image-cache': (False, None, True),
+                     'boot-readahead': (False, None, True),
+                     'block-profile': (False, None, True),
+                     'io-throttle': (False, None, True),
+                     'scratch-disk': (False, None, True),
+                     'auto-compact': (False, None, True),
+                     'kernel': (False, None, True),
+                     'initrd': (False, None, True),
+                     'append': (False, None, True),
+                     'firmware': (False, None, True),
+                     'warm-start': (False, False, True),
+                     'checkpoint': (False, None, True),
                      'placeholder': (False, False, False)}
 
 class TemplateConfig(dict):
@@ -244,11 +260,60 @@ class Template(object):
         if 'persistent-drives' in self.settings:
             self._convert_drives_to_dict()
 
+        if self.settings.get('overlay', None):
+            self._validate_overlay()
+
+        if self.settings.get('image-cache', None):
+            self._validate_image_cache()
+
+        if self.settings.get('boot-readahead', None):
+            self._validate_boot_readahead()
+
+        if self.settings.get('block-profile', None):
+            self._validate_block_profile()
+
+        if self.settings.get('io-throttle', None):
+            self._validate_io_throttle()
+
+        if self.settings.get('scratch-disk', None):
+            self._validate_scratch_disk()
+
+        if self.settings.get('checkpoint', None):
+            self._validate_checkpoint()
+
+        auto_compact = self.settings.get('auto-compact', None)
+        if auto_compact is not None and (not isinstance(auto_compact, int)
+                                         or auto_compact < 1):
+            raise InvalidConfigurationError(
+                "template \"%s\" auto-compact setting must be a "
+                "positive number of layers" % (self.name))
+
+        if self.append and not self.kernel:
+            raise InvalidConfigurationError(
+                "template \"%s\" append setting requires "
+                "a kernel" % (self.name))
+
+        if self.initrd and not self.kernel:
+            raise InvalidConfigurationError(
+                "template \"%s\" initrd setting requires "
+                "a kernel" % (self.name))
+
+        if not isinstance(self.warm_start, bool):
+            raise InvalidConfigurationError(
+                "template \"%s\" warm-start setting must be a "
+                "boolean" % (self.name))
+
+        if self.cloud_seed not in ['iso', 'smbios']:
+            raise InvalidConfigurationError(
+                "template \"%s\" has an invalid cloud-seed "
+                "method" % (self.name))
+
         # Convert mount-point option from string to newer dict format
         for mount in self.mount_points:
             if not isinstance(self.mount_points[mount], dict):
                 path = self.mount_points[mount]
                 self.mount_points[mount] = {'path': path}
+            self._validate_mount_point(mount)
 
 
         # Value for absent image is None but accept YAML representations
@@ -275,6 +340,15 @@ class Template(object):
                 if not 'cache' in opts:
                     opts['cache'] = 'writeback'
 
+                if opts.get('throttle', None):
+                    try:
+                        opts['throttle'] = parse_io_limits(opts['throttle'])
+                    except ValueError as err:
+                        raise InvalidConfigurationError(
+                            "template \"%s\" drive \"%s\" has invalid "
+                            "throttling limits: %s" % (self.name, path,
+                                                       str(err)))
+
                 ordered_drives[path] = opts
             # String syntax
             else:
@@ -286,6 +360,258 @@ class Template(object):
         self.settings['persistent-drives'] = ordered_drives
 
 
+    def _validate_mount_point(self, mount):
+        opts = self.mount_points[mount]
+
+        if opts.get('type', '9p') not in ['9p', 'virtiofs']:
+            raise InvalidConfigurationError(
+                "template \"%s\" mount point \"%s\" has an invalid "
+                "type" % (self.name, mount))
+
+        if opts.get('cache', 'auto') not in ['auto', 'always', 'never',
+                                             'metadata']:
+            raise InvalidConfigurationError(
+                "template \"%s\" mount point \"%s\" has an invalid "
+                "cache mode" % (self.name, mount))
+
+        try:
+            if opts.get('dax', None):
+                opts['dax'] = parse_size(opts['dax'])
+        except ValueError as err:
+            raise InvalidConfigurationError(
+                "template \"%s\" mount point \"%s\" has an invalid "
+                "DAX window size: %s" % (self.name, mount, str(err)))
+
+    def _validate_overlay(self):
+        overlay = self.settings['overlay']
+        if not isinstance(overlay, dict):
+            raise InvalidConfigurationError(
+                "template \"%s\" overlay setting must be a "
+                "key/value mapping" % (self.name))
+
+        for opt in overlay:
+            if opt not in ['path', 'cluster-size', 'lazy-refcounts',
+                           'preallocation']:
+                raise InvalidConfigurationError(
+                    "template \"%s\" has unknown overlay "
+                    "option \"%s\"" % (self.name, opt))
+
+        try:
+            if 'cluster-size' in overlay:
+                overlay['cluster-size'] = parse_size(overlay['cluster-size'])
+        except ValueError as err:
+            raise InvalidConfigurationError(
+                "template \"%s\" has an invalid overlay cluster "
+                "size: %s" % (self.name, str(err)))
+
+        if overlay.get('preallocation', 'off') not in ['off', 'metadata',
+                                                       'falloc', 'full']:
+            raise InvalidConfigurationError(
+                "template \"%s\" has an invalid overlay "
+                "preallocation mode" % (self.name))
+
+    def _validate_image_cache(self):
+        image_cache = self.settings['image-cache']
+        if image_cache is True:
+            image_cache = self.settings['image-cache'] = {}
+        elif not isinstance(image_cache, dict):
+            raise InvalidConfigurationError(
+                "template \"%s\" image-cache setting must be a boolean "
+                "or a key/value mapping" % (self.name))
+
+        for opt in image_cache:
+            if opt not in ['path', 'max-size', 'timeout']:
+                raise InvalidConfigurationError(
+                    "template \"%s\" has unknown image-cache "
+                    "option \"%s\"" % (self.name, opt))
+
+        try:
+            if 'max-size' in image_cache:
+                image_cache['max-size'] = parse_size(image_cache['max-size'])
+        except ValueError as err:
+            raise InvalidConfigurationError(
+                "template \"%s\" has an invalid image cache "
+                "size: %s" % (self.name, str(err)))
+
+    def _validate_boot_readahead(self):
+        boot_readahead = self.settings['boot-readahead']
+        if boot_readahead is True:
+            boot_readahead = self.settings['boot-readahead'] = {}
+        elif not isinstance(boot_readahead, dict):
+            raise InvalidConfigurationError(
+                "template \"%s\" boot-readahead setting must be a boolean "
+                "or a key/value mapping" % (self.name))
+
+        for opt in boot_readahead:
+            if opt not in ['window']:
+                raise InvalidConfigurationError(
+                    "template \"%s\" has unknown boot-readahead "
+                    "option \"%s\"" % (self.name, opt))
+
+        window = boot_readahead.get('window', 120)
+        if not isinstance(window, int) or window < 1:
+            raise InvalidConfigurationError(
+                "template \"%s\" boot-readahead window must be a "
+                "positive number of seconds" % (self.name))
+
+    def _validate_block_profile(self):
+        profile = self.settings['block-profile']
+        if not isinstance(profile, dict):
+            raise InvalidConfigurationError(
+                "template \"%s\" block-profile setting must be a "
+                "key/value mapping" % (self.name))
+
+        choices = {'aio': ['threads', 'native', 'io_uring'],
+                   'detect-zeroes': ['off', 'on', 'unmap']}
+
+        for opt, value in profile.iteritems():
+            if opt in choices:
+                if value not in choices[opt]:
+                    raise InvalidConfigurationError(
+                        "template \"%s\" has an invalid block-profile "
+                        "%s: \"%s\"" % (self.name, opt, value))
+            elif opt == 'queues':
+                if value != 'auto' and (not isinstance(value, int) or
+                                        value < 1):
+                    raise InvalidConfigurationError(
+                        "template \"%s\" has an invalid block-profile "
+                        "number of queues" % (self.name))
+            elif opt == 'l2-cache-size':
+                try:
+                    profile[opt] = parse_size(value)
+                except ValueError as err:
+                    raise InvalidConfigurationError(
+                        "template \"%s\" has an invalid block-profile "
+                        "l2 cache size: %s" % (self.name, str(err)))
+            elif opt not in ['iothreads', 'discard']:
+                raise InvalidConfigurationError(
+                    "template \"%s\" has unknown block-profile "
+                    "option \"%s\"" % (self.name, opt))
+
+        if (profile.get('detect-zeroes') == 'unmap' and
+            not profile.get('discard', False)):
+            raise InvalidConfigurationError(
+                "template \"%s\" block-profile detect-zeroes=unmap "
+                "requires discard" % (self.name))
+
+    def _validate_io_throttle(self):
+        throttle = self.settings['io-throttle']
+        if not isinstance(throttle, dict):
+            raise InvalidConfigurationError(
+                "template \"%s\" io-throttle setting must be a "
+                "key/value mapping" % (self.name))
+
+        limits = dict(throttle)
+        scope = limits.pop('scope', 'vm')
+        if scope not in ['vm', 'drive']:
+            raise InvalidConfigurationError(
+                "template \"%s\" has an invalid io-throttle "
+                "scope: \"%s\"" % (self.name, scope))
+
+        try:
+            limits = parse_io_limits(limits)
+        except ValueError as err:
+            raise InvalidConfigurationError(
+                "template \"%s\" has invalid io-throttle "
+                "limits: %s" % (self.name, str(err)))
+
+        if 'scope' in throttle:
+            limits['scope'] = scope
+        self.settings['io-throttle'] = limits
+
+    def _validate_scratch_disk(self):
+        scratch = self.settings['scratch-disk']
+        if not isinstance(scratch, dict):
+            raise InvalidConfigurationError(
+                "template \"%s\" scratch-disk setting must be a "
+                "key/value mapping" % (self.name))
+
+        for opt in scratch:
+            if opt not in ['size', 'format', 'path', 'cache']:
+                raise InvalidConfigurationError(
+                    "template \"%s\" has unknown scratch-disk "
+                    "option \"%s\"" % (self.name, opt))
+
+        if not 'size' in scratch:
+            raise InvalidConfigurationError(
+                "template \"%s\" scratch-disk has no size" % (self.name))
+
+        try:
+            scratch['size'] = parse_size(scratch['size'])
+        except ValueError as err:
+            raise InvalidConfigurationError(
+                "template \"%s\" has an invalid scratch disk "
+                "size: %s" % (self.name, str(err)))
+
+        if scratch.get('format', 'raw') not in ['raw', 'qcow2']:
+            raise InvalidConfigurationError(
+                "template \"%s\" has an invalid scratch disk "
+                "format" % (self.name))
+
+    def _validate_checkpoint(self):
+        ckpt = self.settings['checkpoint']
+        if not isinstance(ckpt, dict):
+            raise InvalidConfigurationError(
+                "template \"%s\" checkpoint setting must be a "
+                "key/value mapping" % (self.name))
+
+        for opt in ckpt:
+            if opt not in ['codec', 'level', 'threads', 'stripes',
+                           'stripe-dirs', 'incremental', 'staging-dir',
+                           'prefetch', 'lazy-restore', 'dedup']:
+                raise InvalidConfigurationError(
+                    "template \"%s\" has unknown checkpoint "
+                    "option \"%s\"" % (self.name, opt))
+
+        codec = ckpt.get('codec', 'lzop')
+        if codec not in CODECS:
+            raise InvalidConfigurationError(
+                "template \"%s\" has an invalid checkpoint "
+                "codec \"%s\"" % (self.name, codec))
+
+        if 'level' in ckpt:
+            low, high = CODEC_LEVELS.get(codec, (None, None))
+            if (not isinstance(ckpt['level'], int) or low is None
+                or not low <= ckpt['level'] <= high):
+                raise InvalidConfigurationError(
+                    "template \"%s\" has an invalid checkpoint "
+                    "level for codec %s" % (self.name, codec))
+
+        for opt, low in [('threads', 0), ('stripes', 1), ('incremental', 0)]:
+            if opt in ckpt and (not isinstance(ckpt[opt], int) or
+                                ckpt[opt] < low):
+                raise InvalidConfigurationError(
+                    "template \"%s\" has an invalid checkpoint "
+                    "%s value" % (self.name, opt))
+
+        if (not isinstance(ckpt.get('stripe-dirs', []), list) or
+            not all(isinstance(d, basestring)
+                    for d in ckpt.get('stripe-dirs', []))):
+            raise InvalidConfigurationError(
+                "template \"%s\" checkpoint stripe-dirs must be a "
+                "list of directories" % (self.name))
+
+        for opt in ['prefetch', 'lazy-restore', 'dedup']:
+            if not isinstance(ckpt.get(opt, False), bool):
+                raise InvalidConfigurationError(
+                    "template \"%s\" checkpoint %s must be a "
+                    "boolean" % (self.name, opt))
+
+        if not isinstance(ckpt.get('staging-dir', ''), basestring):
+            raise InvalidConfigurationError(
+                "template \"%s\" checkpoint staging-dir must be a "
+                "directory" % (self.name))
+
+        if ckpt.get('dedup') and ckpt.get('staging-dir'):
+            raise InvalidConfigurationError(
+                "template \"%s\" checkpoint dedup cannot be combined "
+                "with staging-dir" % (self.name))
+
+        if ckpt.get('prefetch') and not ckpt.get('staging-dir'):
+            raise InvalidConfigurationError(
+                "template \"%s\" checkpoint prefetch requires "
+                "staging-dir" % (self.name))
+
     def _parent_template(self):
         if 'inherits' in self.settings:
             try:
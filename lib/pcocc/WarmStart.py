@@ -0,0 +1,144 @@
+#  Copyright (C) 2014-2015 CEA/DAM/DIF
+#
+#  This file is part of PCOCC, a tool to easily create and deploy
+#  virtual machines using the resource manager of a compute cluster.
+#
+#  PCOCC is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  PCOCC is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with PCOCC. If not, see <http://www.gnu.org/licenses/>
+
+"""Warm start of VMs from a memory snapshot
+
+A warm snapshot is the memory of a booted VM saved alongside the
+image revision holding its disk at the same instant. VMs started from
+this exact revision with the same virtual hardware may restore the
+snapshot instead of booting. The identity of each VM is then fixed up
+through the Qemu guest agent.
+
+"""
+
+import os
+import errno
+import hashlib
+import tempfile
+
+import yaml
+
+from .Error import PcoccError
+
+class WarmStartError(PcoccError):
+    """Exception raised when a warm snapshot cannot be handled
+    """
+    def __init__(self, error):
+        super(WarmStartError, self).__init__('Warm start error: '
+                                             + error)
+
+def snapshot_paths(image_path):
+    """Returns the memory and manifest paths of the snapshot of an image"""
+    name = 'warm-' + os.path.basename(image_path)
+    mem_path = os.path.join(os.path.dirname(image_path), name)
+    return mem_path, mem_path + '.yaml'
+
+def image_key(image_path):
+    # Compaction rewrites the image but keeps its name and mtime
+    st = os.stat(image_path)
+    return '{0}:{1}'.format(os.path.basename(image_path), int(st.st_mtime))
+
+def hardware_signature(hardware):
+    """Returns a digest of the virtual hardware description of a VM"""
+    return hashlib.sha1(yaml.safe_dump(hardware,
+                                       default_flow_style=True)).hexdigest()
+
+def save_manifest(image_path, signature, macs):
+    """Atomically writes the manifest of the snapshot of an image"""
+    mem_path, manifest_path = snapshot_paths(image_path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(manifest_path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            yaml.safe_dump({'key': image_key(image_path),
+                            'memory': os.path.basename(mem_path),
+                            'signature': signature,
+                            'macs': macs}, f, default_flow_style=False)
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, manifest_path)
+    except (IOError, OSError) as err:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise WarmStartError(str(err))
+
+def load_manifest(image_path, signature):
+    """Returns the manifest of the snapshot of an image
+
+    Returns None if there is no snapshot. Raises WarmStartError if the
+    snapshot cannot be used to start a VM with this signature.
+
+    """
+    mem_path, manifest_path = snapshot_paths(image_path)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = yaml.safe_load(f)
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            return None
+        raise WarmStartError(str(err))
+    except yaml.YAMLError as err:
+        raise WarmStartError(str(err))
+
+    if not isinstance(manifest, dict):
+        raise WarmStartError('invalid manifest {0}'.format(manifest_path))
+    if manifest.get('key') != image_key(image_path):
+        raise WarmStartError('snapshot was taken from another revision of '
+                             '{0}'.format(image_path))
+    if manifest.get('signature') != signature:
+        raise WarmStartError('virtual hardware differs from the snapshot')
+
+    manifest['memory'] = os.path.join(os.path.dirname(mem_path),
+                                      manifest.get('memory', ''))
+    if not os.path.isfile(manifest['memory']):
+        raise WarmStartError('missing memory file '
+                             '{0}'.format(manifest['memory']))
+
+    return manifest
+
+def identity_script(hostname, old_macs, new_macs):
+    """Returns a guest shell script applying the identity of a VM
+
+    Interfaces whose MAC address changed are found through their
+    address in the snapshot and renumbered before renewing their DHCP
+    lease.
+
+    """
+    script = ['hostname {0}'.format(hostname),
+              'echo {0} > /etc/hostname'.format(hostname),
+              'if command -v systemd-machine-id-setup >/dev/null; then '
+              'rm -f /etc/machine-id && systemd-machine-id-setup; fi']
+
+    for net in sorted(new_macs):
+        old_mac = old_macs.get(net)
+        new_mac = new_macs[net]
+        if not old_mac or old_mac == new_mac:
+            continue
+        script.append(
+            'for d in /sys/class/net/*; do '
+            'if [ "$(cat $d/address)" = "{0}" ]; then '
+            'i=$(basename $d); '
+            'ip link set $i down; '
+            'ip link set $i address {1}; '
+            'ip link set $i up; '
+            '(dhclient -r $i; dhclient $i) || '
+            'networkctl reconfigure $i || '
+            'nmcli device reapply $i; '
+            'fi; done'.format(old_mac.lower(), new_mac.lower()))
+
+    return '\n'.join(script) + '\n'
@@ -25,6 +25,7 @@ import signal
 import os
 import termios
 import shlex
+import pipes
 import datetime
 import struct
 import errno
@@ -40,6 +41,15 @@ from pcocc import PcoccError, Config, Cluster, Hypervisor
 from pcocc.Backports import subprocess_check_output
 from pcocc.Batch import ProcessType
 from pcocc.Misc import fake_signalfd, wait_or_term_child, stop_threads
+from pcocc.Misc import parse_io_limits, parse_size
+from pcocc.Compaction import compact_image, chain_stats
+from pcocc.Checkpoint import load_manifest, stripe_write, stripe_read
+from pcocc.Checkpoint import next_rotation_dir, commit_rotation
+from pcocc.Checkpoint import remove_uncommitted
+from pcocc.Checkpoint import remove_checkpoint, save_ram_delta, drain
+from pcocc.Checkpoint import dedup_write, dedup_read, dedup_file
+from pcocc.Checkpoint import record_checkpoint_time, expected_checkpoint_time
+from pcocc.Checkpoint import ROTATION_LATEST
 from pcocc.scripts.Shine.TextTable import TextTable
 
 helperdir = '/etc/pcocc/helpers'
@@ -401,8 +411,11 @@ def vm_name_to_index(name):
 @click.option('-s', '--safe',
               help='Wait indefinitely for the Qemu agent to freeze filesystems',
               is_flag=True)
+@click.option('-w', '--warm',
+              help='Also save the memory of the VM for warm starts',
+              is_flag=True)
 @click.argument('vm', nargs=1, default='vm0')
-def pcocc_save(jobid, jobname, dest,  vm, safe):
+def pcocc_save(jobid, jobname, dest,  vm, safe, warm):
     """Save the disk of a VM to a new disk image
 
     By default the output file only contains the differences between
@@ -413,6 +426,10 @@ def pcocc_save(jobid, jobname, dest,  vm, safe):
     To save the disk to a new independant image file specify a new
     path with --dest.
 
+    With --warm, the memory of the VM is also saved so that VMs
+    started from the new image with warm-start enabled restore it
+    instead of booting.
+
     \b
     Example usage:
            pcocc save vm1
@@ -446,11 +463,32 @@ def pcocc_save(jobid, jobname, dest,  vm, safe):
         else:
             freeze_opt = Hypervisor.VM_FREEZE_OPT.TRY
 
-        vm.save(save_path, full, freeze_opt)
+        if warm:
+            vm.warm_save(save_path, full)
+            click.secho('vm%d disk and memory '
+                        'succesfully saved to %s' % (index,
+                                                     save_path), fg='green')
+        else:
+            vm.save(save_path, full, freeze_opt)
+            click.secho('vm%d disk '
+                        'succesfully saved to %s' % (index,
+                                                     save_path), fg='green')
 
-        click.secho('vm%d disk '
-                    'succesfully saved to %s' % (index,
-                                                 save_path), fg='green')
+        if not full and vm.auto_compact:
+            try:
+                layers = chain_stats(save_path)['layers']
+            except PcoccError as err:
+                click.secho(str(err), fg='red', err=True)
+                layers = 0
+
+            if layers > vm.auto_compact:
+                click.secho('Image chain has %d layers, compacting it in '
+                            'the background' % (layers))
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.Popen(['pcocc', 'template', 'compact',
+                                      vm.template_name],
+                                     stdout=devnull, stderr=devnull,
+                                     close_fds=True, preexec_fn=os.setsid)
 
     except PcoccError as err:
         handle_error(err)
@@ -487,6 +525,50 @@ def pcocc_reset(jobid, jobname,  vm):
 
 
 
+@cli.command(name='recycle',
+             short_help='Revert a VM to a recorded state')
+@click.option('-j', '--jobid', type=int,
+              help='Jobid of the selected cluster')
+@click.option('-J', '--jobname',
+              help='Job name of the selected cluster')
+@click.option('-s', '--save',
+              help='Record the current state of the VM as its recycle point',
+              is_flag=True)
+@click.argument('vm', nargs=1, default='vm0')
+def pcocc_recycle(jobid, jobname, save, vm):
+    """Revert a VM to a recorded state
+
+    The memory and disk state of a running VM are first recorded
+    with --save, usually right after it has booted. Each recycle then
+    reverts the VM to this state within the same allocation.
+
+    \b
+    Example usage:
+           pcocc recycle --save vm1
+           pcocc recycle vm1
+
+    """
+    try:
+        load_config(jobid, jobname, default_batchname='pcocc')
+        cluster = load_batch_cluster()
+        index = vm_name_to_index(vm)
+        vm = cluster.vms[index]
+
+        if vm.image_dir is None:
+            click.secho('Template is not based on a CoW image',
+                        fg='red', err=True)
+            sys.exit(-1)
+
+        if save:
+            vm.recycle_save()
+            click.secho('vm%d recycle point recorded' % (index), fg='green')
+        else:
+            vm.recycle()
+            click.secho('vm%d has been recycled' % (index), fg='green')
+
+    except PcoccError as err:
+        handle_error(err)
+
 @cli.command(name='monitor-cmd',
              short_help='Send a command to the monitor')
 @click.option('-j', '--jobid', type=int,
@@ -516,6 +598,65 @@ def pcocc_monitor_cmd(jobid, jobname,  vm, cmd):
         handle_error(err)
 
 
+@cli.command(name='io-throttle',
+             short_help='Show or adjust the I/O limits of a VM')
+@click.option('-j', '--jobid', type=int,
+              help='Jobid of the selected cluster')
+@click.option('-J', '--jobname',
+              help='Job name of the selected cluster')
+@click.option('-d', '--drive', multiple=True,
+              help='Drive to update (default: all drives)')
+@click.argument('vm', nargs=1, default='vm0')
+@click.argument('limits', nargs=-1)
+def pcocc_io_throttle(jobid, jobname, drive, vm, limits):
+    """Show or adjust the I/O limits of a VM
+
+    Limits are specified as LIMIT=VALUE pairs and take effect
+    immediately. A value of 0 removes a limit.
+
+    \b
+    Example usage:
+           pcocc io-throttle vm0 iops-total=500 bps-total=100M
+           pcocc io-throttle -d datadisk0 vm1 bps-write=0
+
+    """
+    try:
+        load_config(jobid, jobname, default_batchname='pcocc')
+        cluster = load_batch_cluster()
+        index = vm_name_to_index(vm)
+        vm = cluster.vms[index]
+        vm.wait_start()
+
+        if limits:
+            for l in limits:
+                if not '=' in l:
+                    raise click.UsageError('invalid limit: ' + l)
+            try:
+                limits = parse_io_limits(dict(l.split('=', 1)
+                                              for l in limits),
+                                         partial=True)
+            except ValueError as err:
+                raise click.UsageError(str(err))
+
+            vm.set_io_throttle(limits, list(drive) or None)
+            click.secho('vm%d I/O limits have been updated' % (index),
+                        fg='green')
+            return
+
+        for name, drive_limits in sorted(vm.get_io_throttle().iteritems()):
+            if drive and name not in drive:
+                continue
+            group = drive_limits.pop('group', None)
+            desc = ' '.join('%s=%s' % (k, v)
+                            for k, v in sorted(drive_limits.iteritems()))
+            if group:
+                desc += ' (group %s)' % group
+            print '%s: %s' % (name, desc or 'unlimited')
+
+    except PcoccError as err:
+        handle_error(err)
+
+
 @cli.command(name='dump',
              short_help='Dump VM memory to a file')
 @click.option('-j', '--jobid', type=int,
@@ -559,19 +700,66 @@ def pcocc_dump(jobid, jobname,  vm, dumpfile):
               help='Job name of the selected cluster')
 @click.option('-F', '--force', is_flag=True,
               help='Overwrite directory if exists')
+@click.option('-l', '--live', is_flag=True,
+              help='Copy memory while the VMs are running')
+@click.option('--max-remaining', default='256M',
+              help='Stop the VMs once less than this amount of memory '
+              'remains to copy in live mode (default: 256M)')
+@click.option('--deadline', type=int, default=300,
+              help='Stop the VMs after this number of seconds '
+              'in live mode (default: 300)')
+@click.option('--host-concurrency', type=click.IntRange(min=1), default=2,
+              help='Number of VMs checkpointed at once on each host '
+              '(default: 2)')
+@click.option('--adaptive/--no-adaptive', default=True,
+              help='Adjust the number of VMs writing at once to the '
+              'checkpoint filesystem from the throughput (default: on)')
+@click.option('--bandwidth', metavar='SIZE',
+              help='Maximum memory transfer rate of each VM per second '
+              '(for example 500M)')
+@click.option('-c', '--continue', 'resume', is_flag=True,
+              help='Resume the VMs instead of terminating the cluster')
+@click.option('--every', type=click.IntRange(min=1), metavar='SECONDS',
+              help='Checkpoint periodically, rotating checkpoints in '
+              'CKPT_DIR')
+@click.option('--rotate', is_flag=True,
+              help='Checkpoint once in a new subdirectory of CKPT_DIR as '
+              'with --every')
+@click.option('--keep', type=click.IntRange(min=1), default=2,
+              help='Number of checkpoints kept with --every or --rotate '
+              '(default: 2)')
 @click.argument('ckpt-dir', nargs=1)
-def pcocc_ckpt(jobid, jobname, force, ckpt_dir):
+def pcocc_ckpt(jobid, jobname, force, live, max_remaining, deadline,
+               host_concurrency, adaptive, bandwidth, resume, every, rotate,
+               keep, ckpt_dir):
     """Checkpoint the current state of a cluster
 
     Both the disk image and memory of all VMs of the cluster are
-    saved and the cluster is terminated. It is then possible to
-    restart from this state using the --restart-ckpt option of
-    the alloc and batch commands.
+    saved and the cluster is terminated, unless --continue is
+    specified. It is then possible to restart from this state using
+    the --restart-ckpt option of the alloc and batch commands.
 
     CKPT_DIR should not already exist unless -F is specified. In that
     case, make sure you're not overwriting the checkpoint from which
     the cluster was restarted.
 
+    With --live, the memory is copied while the VMs are running and
+    they are only stopped for the final copy of memory pages modified
+    in the meantime, and to save their disks. Otherwise, all VMs are
+    stopped before any of them is saved.
+
+    At most --host-concurrency VMs are checkpointed at once on each
+    host. The number of VMs writing at once to the checkpoint
+    filesystem starts low and is adjusted from the measured throughput,
+    within the limits of the batch configuration. A single progress
+    line reports the data written, the throughput and the remaining
+    time.
+
+    With --every, the cluster keeps running and is checkpointed every
+    SECONDS in a new subdirectory of CKPT_DIR. Only the last --keep
+    checkpoints are kept and CKPT_DIR/latest points to the most recent
+    one. --rotate takes a single checkpoint the same way.
+
     \b
     Example usage:
            pcocc ckpt /path/to/checkpoints/mycheckpoint
@@ -581,9 +769,50 @@ def pcocc_ckpt(jobid, jobname, force, ckpt_dir):
         load_config(jobid, jobname, default_batchname='pcocc')
         cluster = load_batch_cluster()
 
+        try:
+            max_remaining = parse_size(max_remaining)
+            if bandwidth:
+                bandwidth = parse_size(bandwidth)
+        except ValueError as err:
+            raise click.UsageError(str(err))
+
+        ckpt_opts = {'live': live,
+                     'max_remaining': max_remaining,
+                     'deadline': deadline,
+                     'host_concurrency': host_concurrency,
+                     'bandwidth': bandwidth,
+                     'adaptive': adaptive}
+
+        if every:
+            dest_dir = validate_save_dir(ckpt_dir, True)
+            # Exit once the current checkpoint is over when terminated
+            stopping = threading.Event()
+            signal.signal(signal.SIGTERM,
+                          lambda signum, frame: stopping.set())
+            while not stopping.wait(every):
+                try:
+                    path = rotate_checkpoint(cluster, dest_dir, keep, True,
+                                             **ckpt_opts)
+                except PcoccError as err:
+                    sys.stderr.write('Periodic checkpoint failed: '
+                                     '%s\n' % (err))
+                    continue
+
+                click.secho('Cluster state succesfully checkpointed '
+                            'to %s'%(path), fg='green')
+            return
+
+        if rotate:
+            path = rotate_checkpoint(cluster,
+                                     validate_save_dir(ckpt_dir, True),
+                                     keep, resume, **ckpt_opts)
+            click.secho('Cluster state succesfully checkpointed '
+                        'to %s'%(path), fg='green')
+            return
+
         dest_dir = validate_save_dir(ckpt_dir, force)
 
-        cluster.checkpoint(dest_dir)
+        cluster.checkpoint(dest_dir, resume=resume, **ckpt_opts)
         click.secho('Cluster state succesfully checkpointed '
                     'to %s'%(dest_dir), fg='green')
 
@@ -591,6 +820,23 @@ def pcocc_ckpt(jobid, jobname, force, ckpt_dir):
         handle_error(err)
 
 
+def rotate_checkpoint(cluster, parent, keep, resume, **ckpt_opts):
+    """Checkpoints a cluster in a new subdirectory of parent"""
+    remove_uncommitted(parent)
+    path = next_rotation_dir(parent)
+    start = time.time()
+    try:
+        cluster.checkpoint(path, resume=resume, **ckpt_opts)
+    except PcoccError:
+        remove_checkpoint(path)
+        raise
+
+    # Used to request the warning before the end of batch jobs
+    record_checkpoint_time(parent, time.time() - start)
+    commit_rotation(parent, path, keep)
+    return path
+
+
 @cli.command(name='console',
              short_help='Connect to a VM console')
 @click.option('-j', '--jobid', type=int,
@@ -731,6 +977,51 @@ def gen_ckpt_opt(restart_ckpt):
     else:
         return []
 
+def gen_periodic_ckpt_opt(ckpt_every, ckpt_dir, ckpt_keep,
+                          ckpt_signal=None, resubmit=False):
+    if resubmit and not ckpt_signal:
+        raise click.UsageError('--resubmit requires --ckpt-on-signal')
+    if not (ckpt_every or ckpt_signal):
+        return []
+    if not ckpt_dir:
+        raise click.UsageError('--ckpt-every and --ckpt-on-signal '
+                               'require --ckpt-dir')
+
+    opt = ['--ckpt-keep', str(ckpt_keep),
+           '--ckpt-dir', os.path.abspath(ckpt_dir)]
+    if ckpt_every:
+        opt += ['--ckpt-every', str(ckpt_every)]
+    if ckpt_signal:
+        opt += ['--ckpt-on-signal', ckpt_signal]
+    if resubmit:
+        opt += ['--resubmit']
+
+    return opt
+
+def signal_name(name):
+    """Returns the name of a signal without its SIG prefix"""
+    name = name.upper()
+    if name.startswith('SIG'):
+        name = name[3:]
+    if not name.isdigit() and not isinstance(getattr(signal, 'SIG' + name,
+                                                     None), int):
+        raise click.UsageError('invalid signal: %s' % (name))
+
+    return name
+
+def parse_signal(name):
+    """Returns the number of a signal given by name or number"""
+    name = signal_name(name)
+    if name.isdigit():
+        return int(name)
+
+    return getattr(signal, 'SIG' + name)
+
+def ckpt_warning_time(ckpt_dir):
+    """Returns how long before the end of a job to checkpoint it"""
+    # Slurm doesn't accept longer warning times
+    return min(expected_checkpoint_time(os.path.abspath(ckpt_dir)), 65535)
+
 def get_license_opts(cluster):
     license_list = cluster.get_license_list()
     if license_list:
@@ -748,11 +1039,26 @@ def get_license_opts(cluster):
               help='Launch a batch script in the first vm')
 @click.option('-E', '--host-script', type=click.File('r'),
               help='Launch a batch script on the first host')
+@click.option('--ckpt-every', type=click.IntRange(min=1), metavar='SECONDS',
+              help='Checkpoint the cluster periodically')
+@click.option('--ckpt-dir', metavar='DIR',
+              help='Directory where periodic checkpoints are rotated')
+@click.option('--ckpt-keep', type=click.IntRange(min=1), default=2,
+              help='Number of periodic checkpoints kept (default: 2)')
+@click.option('--ckpt-on-signal', is_flag=True,
+              help='Checkpoint the cluster in --ckpt-dir before the job '
+              'is terminated')
+@click.option('--ckpt-signal', default='USR1', metavar='SIGNAL',
+              help='Signal warning of the end of the job (default: USR1)')
+@click.option('--resubmit', is_flag=True,
+              help='Requeue the job to restart from the checkpoint taken '
+              'on signal')
 @click.argument('batch-options', nargs=-1, type=click.UNPROCESSED)
 @click.argument('cluster-definition', nargs=1)
 @docstring(batch_alloc_doc+batch_doc)
-def pcocc_batch(restart_ckpt, batch_script, host_script, batch_options,
-                cluster_definition):
+def pcocc_batch(restart_ckpt, batch_script, host_script, ckpt_every,
+                ckpt_dir, ckpt_keep, ckpt_on_signal, ckpt_signal, resubmit,
+                batch_options, cluster_definition):
 
     try:
         config = load_config(process_type=ProcessType.OTHER)
@@ -760,7 +1066,16 @@ def pcocc_batch(restart_ckpt, batch_script, host_script, batch_options,
         cluster_definition = ascii(cluster_definition)
         cluster = Cluster(cluster_definition)
         batch_options=list(batch_options)
+        ckpt_signal = ckpt_on_signal and signal_name(ckpt_signal) or None
         ckpt_opt = gen_ckpt_opt(restart_ckpt)
+        ckpt_opt += [pipes.quote(opt) for opt in
+                     gen_periodic_ckpt_opt(ckpt_every, ckpt_dir, ckpt_keep,
+                                           ckpt_signal, resubmit)]
+        if ckpt_signal:
+            # Leave enough time to checkpoint before the job is killed
+            warning = (ckpt_signal, ckpt_warning_time(ckpt_dir))
+        else:
+            warning = None
 
         (wrpfile, wrpname) = tempfile.mkstemp()
         wrpfile = os.fdopen(wrpfile, 'w')
@@ -806,18 +1121,32 @@ chmod u+x "$TEMP_HOST_SCRIPT"
         wrpfile.write(
 """
 PYTHONUNBUFFERED=true pcocc %s internal launcher %s %s %s &
-wait
-rm "$TEMP_BATCH_SCRIPT" 2>/dev/null
-rm "$TEMP_HOST_SCRIPT" 2>/dev/null
 """ % (' '.join(build_verbose_opt()), ' '.join(launcher_opt),
        ' '.join(ckpt_opt), cluster_definition))
 
+        if ckpt_signal:
+            # The warning is sent to this script, forward it
+            wrpfile.write(
+"""PCOCC_LAUNCHER_PID=$!
+trap 'kill -%s $PCOCC_LAUNCHER_PID' %s
+while kill -0 $PCOCC_LAUNCHER_PID 2>/dev/null; do
+    wait $PCOCC_LAUNCHER_PID
+done
+""" % (ckpt_signal, ckpt_signal))
+        else:
+            wrpfile.write("wait\n")
+
+        wrpfile.write(
+"""rm "$TEMP_BATCH_SCRIPT" 2>/dev/null
+rm "$TEMP_HOST_SCRIPT" 2>/dev/null
+""")
+
         wrpfile.close()
         ret = config.batch.batch(cluster,
                                  batch_options +
                                  get_license_opts(cluster) +
                                  ['-n', '%d' % (len(cluster.vms))],
-                                  wrpname)
+                                  wrpname, warning, resubmit)
         sys.exit(ret)
 
     except PcoccError as err:
@@ -838,10 +1167,17 @@ def build_verbose_opt():
               metavar='DIR')
 @click.option('-E', '--alloc-script', metavar='SCRIPT',
               help='Execute a script on the allocation node')
+@click.option('--ckpt-every', type=click.IntRange(min=1), metavar='SECONDS',
+              help='Checkpoint the cluster periodically')
+@click.option('--ckpt-dir', metavar='DIR',
+              help='Directory where periodic checkpoints are rotated')
+@click.option('--ckpt-keep', type=click.IntRange(min=1), default=2,
+              help='Number of periodic checkpoints kept (default: 2)')
 @click.argument('batch-options', nargs=-1, type=click.UNPROCESSED)
 @click.argument('cluster-definition', nargs=1)
 @docstring(batch_alloc_doc+alloc_doc)
-def pcocc_alloc(restart_ckpt, alloc_script, batch_options, cluster_definition):
+def pcocc_alloc(restart_ckpt, alloc_script, ckpt_every, ckpt_dir, ckpt_keep,
+                batch_options, cluster_definition):
     try:
         config = load_config(process_type = ProcessType.OTHER)
 
@@ -849,6 +1185,7 @@ def pcocc_alloc(restart_ckpt, alloc_script, batch_options, cluster_definition):
         cluster = Cluster(cluster_definition)
         batch_options=list(batch_options)
         ckpt_opt = gen_ckpt_opt(restart_ckpt)
+        ckpt_opt += gen_periodic_ckpt_opt(ckpt_every, ckpt_dir, ckpt_keep)
         alloc_opt = gen_alloc_script_opt(alloc_script)
 
         ret = config.batch.alloc(cluster,
@@ -875,8 +1212,20 @@ def pcocc_alloc(restart_ckpt, alloc_script, batch_options, cluster_definition):
               help='Run a script in the first VM and exit')
 @click.option('-E', '--alloc-script',
               help='Run a script on the allocation node and exit')
+@click.option('--ckpt-every', type=int,
+              help='Checkpoint the cluster periodically')
+@click.option('--ckpt-dir',
+              help='Directory where periodic checkpoints are rotated')
+@click.option('--ckpt-keep', type=int, default=2,
+              help='Number of periodic checkpoints kept')
+@click.option('--ckpt-on-signal',
+              help='Checkpoint the cluster when receiving this signal')
+@click.option('--resubmit', is_flag=True,
+              help='Requeue the job after checkpointing on signal')
 @click.argument('cluster-definition', nargs=1)
-def pcocc_launcher(restart_ckpt, wait, script, alloc_script, cluster_definition):
+def pcocc_launcher(restart_ckpt, wait, script, alloc_script, ckpt_every,
+                   ckpt_dir, ckpt_keep, ckpt_on_signal, resubmit,
+                   cluster_definition):
     config = load_config(process_type=ProcessType.LAUNCHER)
     batch = config.batch
 
@@ -885,6 +1234,11 @@ def pcocc_launcher(restart_ckpt, wait, script, alloc_script, cluster_definition)
 
     batch.populate_env()
 
+    latest = ckpt_dir and os.path.join(ckpt_dir, ROTATION_LATEST)
+    if resubmit and batch.restart_count and os.path.exists(latest):
+        # The job was requeued after a checkpoint on signal
+        restart_ckpt = os.path.realpath(latest)
+
     if restart_ckpt:
         ckpt_opt=['-r', restart_ckpt]
     else:
@@ -937,10 +1291,33 @@ def pcocc_launcher(restart_ckpt, wait, script, alloc_script, cluster_definition)
 
     monitor_list.append(s_exec.pid)
 
+    if ckpt_every:
+        s_ckpt = subprocess.Popen(['pcocc'] + build_verbose_opt() +
+                                  ['ckpt', '--every', str(ckpt_every),
+                                   '--keep', str(ckpt_keep), ckpt_dir])
+    else:
+        s_ckpt = None
+
+    sig_ckpt = []
+    if ckpt_on_signal:
+        def _on_warning(signum, frame):
+            if sig_ckpt:
+                return
+            thread = threading.Thread(target=signal_checkpoint,
+                                      args=(s_ckpt, ckpt_dir, ckpt_keep,
+                                            resubmit))
+            thread.start()
+            sig_ckpt.append(thread)
+
+        signal.signal(parse_signal(ckpt_on_signal), _on_warning)
+
     while True:
         status, pid, _ = wait_or_term_child(monitor_list,
                                             signal.SIGTERM, term_sigfd, 40)
         if pid == s_pjob.pid:
+            stop_periodic_ckpt(s_ckpt)
+            for thread in sig_ckpt:
+                thread.join()
             if status != 0:
                 sys.stderr.write("The cluster terminated unexpectedly\n")
             else:
@@ -956,6 +1333,7 @@ def pcocc_launcher(restart_ckpt, wait, script, alloc_script, cluster_definition)
 
             sys.exit(status >> 8)
         elif pid == s_exec.pid and not wait:
+            stop_periodic_ckpt(s_ckpt)
             sys.stderr.write("Terminating the cluster...\n")
             t = threading.Timer(40, wait_timeout, [s_pjob])
             t.start()
@@ -965,6 +1343,35 @@ def pcocc_launcher(restart_ckpt, wait, script, alloc_script, cluster_definition)
             sys.exit(status >> 8)
 
 
+def stop_periodic_ckpt(s_ckpt):
+    """Waits for periodic checkpoints to stop
+
+    A checkpoint in progress is completed first so that the VMs aren't
+    left stopped in the middle of a migration.
+
+    """
+    if s_ckpt and s_ckpt.poll() is None:
+        s_ckpt.terminate()
+        s_ckpt.wait()
+
+def signal_checkpoint(s_ckpt, ckpt_dir, ckpt_keep, resubmit):
+    """Checkpoints and terminates the cluster before the end of the job"""
+    stop_periodic_ckpt(s_ckpt)
+    sys.stderr.write("The job is about to end, checkpointing the "
+                     "cluster...\n")
+    ret = subprocess.call(['pcocc'] + build_verbose_opt() +
+                          ['ckpt', '--rotate', '--keep', str(ckpt_keep),
+                           ckpt_dir])
+    if ret != 0:
+        sys.stderr.write("Checkpoint before the end of the job failed\n")
+        return
+
+    if resubmit:
+        try:
+            Config().batch.requeue()
+        except PcoccError as err:
+            sys.stderr.write("Unable to resubmit the job: %s\n" % (err))
+
 def wait_timeout(s_proc):
     try:
         logging.error("Forcibly killing hypervisor processes...\n")
@@ -1013,6 +1420,68 @@ def pcocc_run(restart_ckpt):
     except PcoccError as err:
         handle_error(err)
 
+@internal.command(name='ckpt-write',
+             short_help="For internal use")
+@click.argument('manifest')
+def pcocc_ckpt_write(manifest):
+    # Qemu streams the VM memory to our stdin
+    try:
+        layout = load_manifest(manifest, True)
+        if layout.get('store'):
+            dedup_write(manifest, sys.stdin.fileno())
+        else:
+            stripe_write(layout, sys.stdin.fileno())
+    except PcoccError as err:
+        handle_error(err)
+
+@internal.command(name='ckpt-read',
+             short_help="For internal use")
+@click.argument('manifest')
+def pcocc_ckpt_read(manifest):
+    # Qemu reads the VM memory from our stdout
+    try:
+        layout = load_manifest(manifest, True)
+        if layout.get('store'):
+            dedup_read(manifest, sys.stdout.fileno())
+        else:
+            stripe_read(layout, sys.stdout.fileno())
+    except PcoccError as err:
+        handle_error(err)
+
+@internal.command(name='ckpt-ram',
+             short_help="For internal use")
+@click.option('--base', help='Manifest of the previous RAM delta')
+@click.option('--dedup', is_flag=True,
+              help='Store blocks in the chunk store of the checkpoint')
+@click.argument('ram-file')
+@click.argument('manifest')
+def pcocc_ckpt_ram(base, dedup, ram_file, manifest):
+    try:
+        # The caller aggregates the number of bytes written
+        print save_ram_delta(ram_file, manifest, base, dedup)
+    except PcoccError as err:
+        handle_error(err)
+
+@internal.command(name='ckpt-dedup',
+             short_help="For internal use")
+@click.argument('path')
+@click.argument('manifest')
+def pcocc_ckpt_dedup(path, manifest):
+    try:
+        dedup_file(path, manifest)
+    except PcoccError as err:
+        handle_error(err)
+
+@internal.command(name='ckpt-drain',
+             short_help="For internal use")
+@click.argument('ckpt-dir')
+@click.argument('rank', type=int)
+def pcocc_ckpt_drain(ckpt_dir, rank):
+    try:
+        drain(ckpt_dir, rank)
+    except PcoccError as err:
+        handle_error(err)
+
 @cli.command(name='exec',
              short_help="Execute commands through the guest agent",
              context_settings=dict(ignore_unknown_options=True,
@@ -1128,6 +1597,52 @@ def pcocc_tpl_list():
         handle_error(err)
     print tbl
 
+@template.command(name='compact',
+             short_help="Merge the image revisions of a template")
+@click.argument('template', nargs=1)
+def pcocc_tpl_compact(template):
+    """Merge the image revisions of a template
+
+    The latest revision of the template image is replaced by a
+    standalone image with the same content, so that VMs no longer
+    read through the chain of previous revisions. The revision number
+    and date are kept as well as the previous revisions.
+
+    \b
+    Example usage:
+           pcocc template compact mytpl
+
+    """
+    try:
+        config = load_config()
+
+        try:
+            tpl = config.tpls[template]
+        except KeyError as err:
+            click.secho('Template not found: ' + template, fg='red', err=True)
+            sys.exit(-1)
+
+        image_file, _ = tpl.resolve_image()
+        if image_file is None:
+            click.secho('Template is not based on a CoW image',
+                        fg='red', err=True)
+            sys.exit(-1)
+
+        click.secho('Compacting %s...' % (image_file))
+        before, after = compact_image(image_file)
+
+        if before['layers'] == after['layers']:
+            click.secho('Image is already standalone', fg='green')
+        else:
+            click.secho('Merged %d layers (%.1f MB) into a standalone image '
+                        '(%.1f MB): uncached reads now go through 1 layer '
+                        'instead of up to %d' % (
+                            before['layers'], before['size'] / 1048576.,
+                            after['size'] / 1048576., before['layers']),
+                        fg='green')
+    except PcoccError as err:
+        handle_error(err)
+
 @template.command(name='show',
              short_help="Display a template")
 @click.argument('template', nargs=1)
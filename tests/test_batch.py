@@ -0,0 +1,33 @@
+import pytest
+
+from pcocc.Batch import BatchManager, ProcessType
+from pcocc.Error import InvalidConfigurationError
+
+batch_config = """
+type: local
+settings:
+  etcd-servers:
+    - localhost
+  etcd-client-port: 2379
+  etcd-protocol: http
+  etcd-auth-type: none
+  launch-concurrency:
+    /shared: 32
+  checkpoint-concurrency:
+    /shared: {0}
+    default: 8
+"""
+
+def load_batch(tmpdir, limit):
+    path = tmpdir.join('batch.yaml')
+    path.write(batch_config.format(limit))
+    return BatchManager.load(str(path), None, None, 'pcocc',
+                             ProcessType.OTHER, 'user')
+
+def test_concurrency_settings(tmpdir):
+    batch = load_batch(tmpdir, 64)
+    assert batch.launch_concurrency == {'/shared': 32}
+    assert batch.checkpoint_concurrency == {'/shared': 64, 'default': 8}
+
+    with pytest.raises(InvalidConfigurationError):
+        load_batch(tmpdir, 0)
@@ -0,0 +1,218 @@
+import os
+import hashlib
+import pytest
+
+from pcocc import Checkpoint
+from pcocc.Checkpoint import memory_layout, save_manifest, load_manifest
+from pcocc.Checkpoint import stripe_write, stripe_read, codec_commands
+from pcocc.Checkpoint import CheckpointImageError
+from pcocc.Checkpoint import rotation_dirs, next_rotation_dir, commit_rotation
+from pcocc.Checkpoint import remove_uncommitted
+from pcocc.Checkpoint import save_ram_delta, load_ram_manifest, compose_ram
+from pcocc.Checkpoint import checkpoint_bases, ram_image
+from pcocc.Checkpoint import save_staging_record, staged_files, drain
+from pcocc.Checkpoint import clear_staging
+from pcocc.Checkpoint import dedup_write, dedup_read, dedup_file, restore_file
+from pcocc.Checkpoint import record_checkpoint_time, expected_checkpoint_time
+
+def roundtrip(tmpdir, manifest, data):
+    src = tmpdir.join('stream')
+    src.write(data, 'wb')
+    fd = os.open(str(src), os.O_RDONLY)
+    stripe_write(manifest, fd)
+    os.close(fd)
+
+    out = tmpdir.join('restored')
+    fd = os.open(str(out), os.O_WRONLY | os.O_CREAT)
+    stripe_read(manifest, fd)
+    os.close(fd)
+    return out.read('rb')
+
+def test_codec_commands():
+    assert codec_commands('zstd', 3, 0) == (['zstd', '-q', '-c', '-3', '-T0'],
+                                            ['zstd', '-q', '-dc'])
+    assert codec_commands('none') == (None, None)
+    with pytest.raises(CheckpointImageError):
+        codec_commands('bzip2')
+
+@pytest.mark.parametrize("size", [0, 1000, 4096, 10000])
+def test_stripes(tmpdir, size):
+    dirs = [str(tmpdir.mkdir('a')), str(tmpdir.mkdir('b'))]
+    manifest = memory_layout('memory-vm0', dirs,
+                             {'codec': 'none', 'stripes': 3,
+                              'chunk-size': 1024})
+    assert manifest['stripes'][2] == os.path.join(dirs[0], 'memory-vm0.2')
+
+    data = os.urandom(size)
+    assert roundtrip(tmpdir, manifest, data) == data
+    assert sum(os.path.getsize(p) for p in manifest['stripes']) == size
+
+def test_compressed(tmpdir, monkeypatch):
+    monkeypatch.setitem(Checkpoint.CODECS, 'gzip',
+                        (['gzip', '-c'], ['gzip', '-dc'], '.gz'))
+    manifest = memory_layout('memory-vm1', [str(tmpdir)],
+                             {'codec': 'gzip', 'stripes': 2,
+                              'chunk-size': 4096})
+    save_manifest(str(tmpdir.join('memory-vm1.yaml')), manifest)
+    manifest = load_manifest(str(tmpdir.join('memory-vm1.yaml')))
+    assert manifest['stripes'][1].endswith('memory-vm1.1.gz')
+
+    data = 'x' * 100000
+    assert roundtrip(tmpdir, manifest, data) == data
+    assert os.path.getsize(manifest['stripes'][0]) < 10000
+
+def test_missing_manifest(tmpdir):
+    assert load_manifest(str(tmpdir.join('memory-vm0.yaml'))) is None
+    with pytest.raises(CheckpointImageError):
+        load_manifest(str(tmpdir.join('memory-vm0.yaml')), True)
+
+def test_rotation(tmpdir):
+    parent = tmpdir.mkdir('periodic')
+    stripes = tmpdir.mkdir('stripes')
+    paths = []
+    for _ in range(4):
+        path = next_rotation_dir(str(parent))
+        stripe = stripes.join(os.path.basename(path) + '-memory-vm0.0.lzo')
+        stripe.write('memory')
+        save_manifest(os.path.join(path, 'memory-vm0.yaml'),
+                      {'codec': 'lzop', 'stripes': [str(stripe)]})
+        commit_rotation(str(parent), path, 2)
+        paths.append(path)
+
+    assert [os.path.basename(p) for p in paths] == ['ckpt-0', 'ckpt-1',
+                                                    'ckpt-2', 'ckpt-3']
+    assert rotation_dirs(str(parent)) == paths[2:]
+    assert parent.join('latest').readlink() == 'ckpt-3'
+    # Stripes of removed checkpoints are removed as well
+    assert sorted(os.listdir(str(stripes))) == [
+        'ckpt-2-memory-vm0.0.lzo', 'ckpt-3-memory-vm0.0.lzo']
+
+    # Interrupted checkpoints are removed
+    next_rotation_dir(str(parent))
+    remove_uncommitted(str(parent))
+    assert rotation_dirs(str(parent)) == paths[2:]
+
+def test_checkpoint_times(tmpdir):
+    parent = str(tmpdir)
+    assert expected_checkpoint_time(parent) == Checkpoint.DEFAULT_CKPT_TIME
+
+    for duration in [100, 40] + [10] * Checkpoint.CKPT_TIMES_KEPT:
+        record_checkpoint_time(parent, duration)
+        if duration == 40:
+            assert expected_checkpoint_time(parent) == 150 + 60
+
+    # Only the most recent checkpoints are considered
+    assert expected_checkpoint_time(parent) == 15 + 60
+
+def test_ram_delta(tmpdir):
+    block = Checkpoint.RAM_BLOCK_SIZE
+    ram = tmpdir.join('ram')
+    ram.write('a' * block + '\0' * block + 'b' * block, 'wb')
+
+    full = str(tmpdir.mkdir('ckpt-0').join('ram-vm0-0.yaml'))
+    assert save_ram_delta(str(ram), full) == 2 * block
+    # A delta without a base is an image of the RAM
+    with open(ram_image(full), 'rb') as f:
+        assert f.read() == ram.read('rb')
+
+    # Only the modified block is written
+    ram.write('a' * block + '\0' * block + 'c' * block, 'wb')
+    delta = str(tmpdir.mkdir('ckpt-1').join('ram-vm0-0.yaml'))
+    assert save_ram_delta(str(ram), delta, full) == block
+    assert load_ram_manifest(delta)['blocks'] == [2]
+    assert ram_image(delta) is None
+    assert checkpoint_bases(str(tmpdir.join('ckpt-1'))) == set(
+        [str(tmpdir.join('ckpt-0'))])
+
+    restored = tmpdir.join('restored')
+    compose_ram(delta, str(restored))
+    assert restored.read('rb') == ram.read('rb')
+
+    os.unlink(full[:-len('.yaml')] + '.delta')
+    with pytest.raises(CheckpointImageError):
+        compose_ram(delta, str(restored))
+
+def test_dedup(tmpdir, monkeypatch):
+    monkeypatch.setattr(Checkpoint, 'DEDUP_CHUNK_SIZE', 4096)
+    chunk = Checkpoint.DEDUP_CHUNK_SIZE
+    shared = os.urandom(2 * chunk)
+    store = tmpdir.join('chunks')
+
+    # Identical chunks of two VMs are only stored once
+    for rank in range(2):
+        manifest = str(tmpdir.join('memory-vm{0}.yaml'.format(rank)))
+        save_manifest(manifest, memory_layout('memory-vm{0}'.format(rank),
+                                              [str(tmpdir)],
+                                              {'dedup': True, 'stripes': 3}))
+        data = shared + '\0' * chunk + str(rank) * 100
+        tmpdir.join('stream').write(data, 'wb')
+        fd = os.open(str(tmpdir.join('stream')), os.O_RDONLY)
+        dedup_write(manifest, fd)
+        os.close(fd)
+
+        out = tmpdir.join('restored')
+        fd = os.open(str(out), os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        dedup_read(manifest, fd)
+        os.close(fd)
+        assert out.read('rb') == data
+    assert len(list(store.visit(lambda p: p.isfile()))) == 4
+
+    disk = tmpdir.join('disk-vm0')
+    disk.write(shared + 'disk', 'wb')
+    dedup_file(str(disk), str(disk) + '.yaml')
+    assert not disk.check()
+    assert len(list(store.visit(lambda p: p.isfile()))) == 5
+    restore_file(str(disk) + '.yaml', str(tmpdir.join('rebuilt')))
+    assert tmpdir.join('rebuilt').read('rb') == shared + 'disk'
+
+    # A missing chunk is detected
+    digest = hashlib.sha1(shared[:chunk]).hexdigest()
+    store.join(digest[:2], digest).remove()
+    with pytest.raises(CheckpointImageError):
+        restore_file(str(disk) + '.yaml', str(tmpdir.join('rebuilt')))
+
+def test_dedup_ram_delta(tmpdir):
+    block = Checkpoint.RAM_BLOCK_SIZE
+    ram = tmpdir.join('ram')
+    ram.write('a' * block + 'b' * block, 'wb')
+    full = str(tmpdir.mkdir('ckpt-0').join('ram-vm0-0.yaml'))
+    assert save_ram_delta(str(ram), full, dedup=True) == 2 * block
+    assert ram_image(full) is None
+
+    ram.write('a' * block + 'c' * block, 'wb')
+    delta = str(tmpdir.mkdir('ckpt-1').join('ram-vm0-0.yaml'))
+    assert save_ram_delta(str(ram), delta, full, dedup=True) == block
+    assert not tmpdir.join('ckpt-1').listdir('*.delta')
+
+    restored = tmpdir.join('restored')
+    compose_ram(delta, str(restored))
+    assert restored.read('rb') == ram.read('rb')
+
+def test_drain(tmpdir):
+    ckpt_dir = tmpdir.mkdir('ckpt')
+    staging = tmpdir.mkdir('local')
+    staging.join('memory-vm1.0.lzo').write('memory')
+    staging.join('disk-vm1').write('disk')
+    manifest = str(ckpt_dir.join('memory-vm1.yaml'))
+    save_manifest(manifest, {'codec': 'lzop',
+                             'stripes': [str(staging.join(
+                                 'memory-vm1.0.lzo'))]})
+    save_staging_record(str(ckpt_dir), 1, 'node1', str(staging), manifest,
+                        {str(staging.join('memory-vm1.0.lzo')):
+                             str(ckpt_dir.join('memory-vm1.0.lzo')),
+                         str(staging.join('disk-vm1')):
+                             str(ckpt_dir.join('disk-vm1'))})
+
+    assert staged_files(str(ckpt_dir), 0) is None
+    assert staged_files(str(ckpt_dir), 1)[str(ckpt_dir.join('disk-vm1'))] == (
+        str(staging.join('disk-vm1')))
+
+    drain(str(ckpt_dir), 1)
+    assert staged_files(str(ckpt_dir), 1) is None
+    assert ckpt_dir.join('disk-vm1').read() == 'disk'
+    assert load_manifest(manifest)['stripes'] == [
+        str(ckpt_dir.join('memory-vm1.0.lzo'))]
+    assert not staging.check()
+
+    clear_staging(str(ckpt_dir), 1)
+    assert not ckpt_dir.join('drained-vm1').check()
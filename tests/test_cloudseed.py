@@ -0,0 +1,75 @@
+import os
+import struct
+
+from pcocc.CloudSeed import make_seed, write_iso, SECTOR_SIZE
+
+def read_dir(data, lba):
+    """Returns the files of an ISO9660 directory as a name -> content dict"""
+    files = {}
+    offset = lba * SECTOR_SIZE
+    end = offset + SECTOR_SIZE
+    while offset < end:
+        length = ord(data[offset])
+        if length == 0:
+            break
+        extent = struct.unpack('<I', data[offset + 2:offset + 6])[0]
+        size = struct.unpack('<I', data[offset + 10:offset + 14])[0]
+        flags = ord(data[offset + 25])
+        name_len = ord(data[offset + 32])
+        name = data[offset + 33:offset + 33 + name_len]
+        if not flags & 2:
+            files[name] = data[extent * SECTOR_SIZE:
+                               extent * SECTOR_SIZE + size]
+        offset += length
+    return files
+
+def root_lba(data, sector):
+    vd = data[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+    return vd, struct.unpack('<I', vd[158:162])[0]
+
+def test_write_iso(tmpdir):
+    path = str(tmpdir.join('seed.iso'))
+    user_data = '#cloud-config\n' + 'x' * 3000
+    write_iso(path, 'cidata', {'user-data': user_data,
+                               'meta-data': 'instance-id: 1\n'})
+
+    data = open(path, 'rb').read()
+    assert len(data) % SECTOR_SIZE == 0
+
+    pvd, lba = root_lba(data, 16)
+    assert pvd[0:6] == '\x01CD001'
+    assert pvd[40:72].rstrip() == 'cidata'
+    assert struct.unpack('<I', pvd[80:84])[0] * SECTOR_SIZE == len(data)
+    assert read_dir(data, lba) == {'USER_DAT.;1': user_data,
+                                   'META_DAT.;1': 'instance-id: 1\n'}
+
+    svd, lba = root_lba(data, 17)
+    assert svd[0:6] == '\x02CD001'
+    assert svd[88:91] == '%/E'
+    assert svd[40:52].decode('utf-16-be') == 'cidata'
+    files = read_dir(data, lba)
+    assert files == {u'user-data'.encode('utf-16-be'): user_data,
+                     u'meta-data'.encode('utf-16-be'): 'instance-id: 1\n'}
+
+    assert data[18 * SECTOR_SIZE:18 * SECTOR_SIZE + 6] == '\xffCD001'
+
+def test_seed_cache(tmpdir):
+    cache_dir = tmpdir.mkdir('cache')
+    files = {'user-data': 'shared', 'meta-data': '{}\n'}
+
+    path1 = make_seed(files, str(tmpdir.join('vm0')), str(cache_dir))
+    path2 = make_seed(dict(files), str(tmpdir.join('vm1')), str(cache_dir))
+    assert path1 == path2
+    assert os.path.dirname(path1) == str(cache_dir)
+    assert not tmpdir.join('vm0').check()
+    assert len(cache_dir.listdir()) == 1
+
+    files['user-data'] = 'other'
+    path3 = make_seed(files, str(tmpdir.join('vm2')), str(cache_dir))
+    assert path3 != path1
+    assert len(cache_dir.listdir()) == 2
+
+def test_seed_no_cache(tmpdir):
+    path = str(tmpdir.join('vm0'))
+    assert make_seed({'user-data': '', 'meta-data': ''}, path) == path
+    assert os.path.getsize(path) > 0
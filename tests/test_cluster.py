@@ -0,0 +1,91 @@
+import time
+import pytest
+import threading
+
+from pcocc.Cluster import Cluster, run_per_host
+from pcocc.Hypervisor import CheckpointError
+
+class FakeVM(object):
+    def __init__(self, rank, host):
+        self.rank = rank
+        self.host = host
+
+    def get_host(self):
+        return self.host
+
+def test_run_per_host():
+    vms = [FakeVM(i, 'node{0}'.format(i % 2)) for i in range(8)]
+    lock = threading.Lock()
+    running = {'node0': 0, 'node1': 0}
+    peak = {'node0': 0, 'node1': 0}
+    done = []
+
+    def _func(vm):
+        with lock:
+            running[vm.host] += 1
+            peak[vm.host] = max(peak[vm.host], running[vm.host])
+        time.sleep(0.05)
+        with lock:
+            running[vm.host] -= 1
+            done.append(vm.rank)
+        if vm.rank == 3:
+            raise ValueError('disk full')
+
+    errors = run_per_host(vms, _func, 2)
+
+    # A failed VM doesn't prevent the others from completing
+    assert sorted(done) == range(8)
+    assert errors.keys() == [3]
+    assert str(errors[3]) == 'disk full'
+    assert peak == {'node0': 2, 'node1': 2}
+
+class FakeCkptVM(FakeVM):
+    def __init__(self, rank, host, duration, events):
+        super(FakeCkptVM, self).__init__(rank, host)
+        self.duration = duration
+        self.events = events
+        self.checkpoint_settings = {}
+
+    def checkpoint(self, ckpt_dir, live, max_remaining, deadline,
+                   progress, bandwidth):
+        stop_time = time.time()
+        time.sleep(self.duration)
+        self.events.append(('saved', self.rank))
+        return stop_time
+
+    def cont(self):
+        self.events.append(('cont', self.rank))
+
+def test_live_checkpoint_resume(config, mocker, tmpdir, capsys):
+    mocker.patch.object(config, 'hyp')
+    config.batch.checkpoint_concurrency = {}
+    config.hyp.checkpoint_img_file.return_value = str(tmpdir.join('none'))
+    config.hyp.migration_blocker.return_value = None
+
+    events = []
+    cluster = Cluster.__new__(Cluster)
+    cluster.vms = [FakeCkptVM(0, 'node0', 0.01, events),
+                   FakeCkptVM(1, 'node1', 0.5, events)]
+    cluster.checkpoint(str(tmpdir), live=True, resume=True)
+
+    # Each VM is resumed once its own checkpoint is complete
+    assert events == [('saved', 0), ('cont', 0), ('saved', 1), ('cont', 1)]
+    # The downtime lasts until the VMs are resumed
+    out = capsys.readouterr()[0]
+    assert float(out.split('downtime ')[1].split('s max')[0]) >= 0.5
+
+def test_checkpoint_blocker(config, mocker, tmpdir):
+    mocker.patch.object(config, 'hyp')
+    config.hyp.migration_blocker.side_effect = lambda vm: (
+        'virtiofs' if vm.rank == 1 else None)
+
+    events = []
+    cluster = Cluster.__new__(Cluster)
+    cluster.vms = [FakeCkptVM(0, 'node0', 0, events),
+                   FakeCkptVM(1, 'node1', 0, events)]
+
+    # VMs which can't be migrated are rejected before any is stopped
+    with pytest.raises(CheckpointError) as err:
+        cluster.checkpoint(str(tmpdir))
+    assert str(err.value).endswith('vm1: virtiofs')
+    assert not events and not config.hyp.stop.called
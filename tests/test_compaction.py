@@ -0,0 +1,55 @@
+import os
+import sys
+import pytest
+
+import pcocc
+from pcocc.Compaction import compact_image, chain_stats, CompactionError
+from pcocc.Qcow2 import create_overlay, image_info
+
+# Stand-in for qemu-img convert which writes an empty standalone image
+CONVERTER = [sys.executable, '-c', """
+import sys
+sys.path.insert(0, {0!r})
+from pcocc.Qcow2 import create_image, image_info
+create_image(sys.argv[2], image_info(sys.argv[1])['virtual-size'])
+""".format(os.path.dirname(os.path.dirname(pcocc.__file__)))]
+
+def make_revisions(tmpdir, count):
+    base = str(tmpdir.join('image'))
+    with open(base, 'wb') as f:
+        f.truncate(1024 * 1024)
+    for i in range(1, count + 1):
+        create_overlay(str(tmpdir.join('image-rev%d' % i)),
+                       'image-rev%d' % (i - 1) if i > 1 else 'image')
+    return str(tmpdir.join('image-rev%d' % count))
+
+def test_compact(tmpdir):
+    top = make_revisions(tmpdir, 3)
+    os.chmod(top, 0o640)
+    os.utime(top, (1000, 1000))
+
+    before, after = compact_image(top, CONVERTER)
+    assert before['layers'] == 4
+    assert after['layers'] == 1
+    assert chain_stats(top) == after
+
+    assert image_info(top)['backing-file'] is None
+    assert os.stat(top).st_mtime == 1000
+    assert os.stat(top).st_mode & 0o777 == 0o640
+    # Previous revisions are kept
+    assert os.path.exists(str(tmpdir.join('image-rev2')))
+    assert not [f for f in os.listdir(str(tmpdir))
+                if f.startswith('.image-rev3')]
+
+    # Standalone images are left untouched
+    assert compact_image(top, ['false']) == (after, after)
+
+def test_concurrent_update(tmpdir):
+    top = make_revisions(tmpdir, 2)
+    converter = ['sh', '-c', 'touch -d @0 "$0"; cp "$0" "$1"']
+
+    with pytest.raises(CompactionError):
+        compact_image(top, converter)
+    assert image_info(top)['backing-file'] == 'image-rev1'
+    assert sorted(os.listdir(str(tmpdir))) == ['.compact.lock', 'image',
+                                               'image-rev1', 'image-rev2']
@@ -0,0 +1,564 @@
+import os
+import stat
+import json
+import time
+import pytest
+
+from pcocc.Hypervisor import Qemu, QemuCapabilities, HypervisorError
+from pcocc.Hypervisor import CheckpointError
+from pcocc.Hypervisor import parse_qemu_version, parse_qemu_devices
+from pcocc.Hypervisor import parse_qemu_list, parse_qemu_machines
+from pcocc.Hypervisor import parse_block_chain, parse_block_snapshots
+from pcocc.Hypervisor import admission_key, find_virtiofsd, VM_FREEZE_OPT
+from pcocc.Checkpoint import save_ram_delta, compose_ram, ram_chain
+from pcocc.Qcow2 import image_info
+from pcocc.ImageCache import ImageCache
+from pcocc.WarmStart import hardware_signature
+
+FAKE_QEMU = """#!/bin/sh
+echo "$@" >> {log}
+case "$1 $2" in
+  "--version ")
+    echo "QEMU emulator version 4.2.1 (qemu-kvm-4.2.1)";;
+  "-machine help")
+    echo "Supported machines are:"
+    echo "pc                   Standard PC (alias of pc-i440fx-4.2)"
+    echo "q35                  Standard PC (Q35 + ICH9, 2009)";;
+  "-device help")
+    echo 'name "virtio-blk-pci", bus PCI, alias "virtio-blk"'
+    echo 'name "virtio-net-pci", bus PCI';;
+  "-device virtio-blk-pci,help")
+    echo "virtio-blk-pci.num-queues=uint16"
+    echo "virtio-blk-pci.iothread=link<iothread>";;
+  "-object help")
+    echo "List of user creatable objects:"
+    echo "  iothread"
+    echo "  memory-backend-ram";;
+  "-accel help")
+    echo "Accelerators supported in QEMU binary:"
+    echo "tcg"
+    echo "kvm";;
+esac
+"""
+
+@pytest.fixture
+def qemu_bin(tmpdir):
+    path = str(tmpdir.join('qemu-system-x86_64'))
+    with open(path, 'w') as f:
+        f.write(FAKE_QEMU.format(log=str(tmpdir.join('probe.log'))))
+    os.chmod(path, stat.S_IRWXU)
+    return path
+
+def probe_count(tmpdir):
+    log = tmpdir.join('probe.log')
+    if not log.check():
+        return 0
+    return len(log.readlines())
+
+def test_parsers():
+    assert parse_qemu_version('QEMU emulator version 2.12.0') == [2, 12, 0]
+    assert parse_qemu_version('QEMU PC emulator version 1.5') == [1, 5, 0]
+    with pytest.raises(HypervisorError):
+        parse_qemu_version('garbage')
+
+    assert parse_qemu_machines('Supported machines are:\n'
+                               'pc    Standard PC\n'
+                               'q35   Q35\n') == ['pc', 'q35']
+    assert parse_qemu_devices('name "e1000", bus PCI, alias "e1000-82540em"'
+                              ) == ['e1000', 'e1000-82540em']
+    assert parse_qemu_list('Accelerators supported in QEMU binary:\n'
+                           'tcg\nkvm\n') == ['tcg', 'kvm']
+    assert parse_qemu_list('Possible accelerators: kvm, xen, tcg\n'
+                           ) == ['kvm', 'xen', 'tcg']
+
+def test_block_chain():
+    blocks = [{'device': 'floppy0', 'removable': True},
+              {'device': 'bootdisk',
+               'dirty-bitmaps': [{'name': 'pcocc-save', 'count': 0}],
+               'inserted': {
+                   'image': {'filename': '/tmp/overlay',
+                             'backing-image': {
+                                 'filename': '/images/image-rev1',
+                                 'backing-image': {
+                                     'filename': '/images/image'}}}}}]
+
+    assert parse_block_chain(blocks, 'bootdisk') == (
+        ['/tmp/overlay', '/images/image-rev1', '/images/image'],
+        ['pcocc-save'])
+    with pytest.raises(HypervisorError):
+        parse_block_chain(blocks, 'floppy0')
+
+def test_block_snapshots():
+    blocks = [{'device': 'bootdisk',
+               'inserted': {
+                   'image': {'filename': '/tmp/overlay',
+                             'snapshots': [{'id': '1',
+                                            'name': 'pcocc-recycle'}]}}},
+              {'device': 'datadisk0',
+               'inserted': {'image': {'filename': '/data/disk'}}}]
+
+    assert parse_block_snapshots(blocks, 'bootdisk') == ['pcocc-recycle']
+    assert parse_block_snapshots(blocks, 'datadisk0') == []
+    with pytest.raises(HypervisorError):
+        parse_block_snapshots(blocks, 'scratchdev')
+
+def test_admission_key():
+    limits = {'/shared': 16, '/shared/images': 4}
+    assert admission_key(limits, '/shared/images/centos/image') == (
+        '/shared/images')
+    assert admission_key(limits, '/shared/ckpt/memory-vm0') == '/shared'
+    assert admission_key(limits, '/sharedfs/image') is None
+
+    limits['default'] = 8
+    assert admission_key(limits, '/tmp/image') == 'default'
+
+def test_probe(qemu_bin):
+    caps = QemuCapabilities(qemu_bin)
+    assert caps.version == (4, 2, 1)
+    assert caps.has_machine('q35')
+    assert not caps.has_machine('virt')
+    assert caps.has_device('virtio-blk')
+    assert caps.iothreads
+    assert caps.blk_multiqueue
+    assert caps.has_accel('kvm')
+    assert 'io_uring' not in caps.aio_modes
+
+def test_cache(qemu_bin, tmpdir):
+    cache_file = str(tmpdir.join('caps.yaml'))
+
+    QemuCapabilities(qemu_bin, cache_file)
+    count = probe_count(tmpdir)
+    assert count > 0
+
+    # Served from the cache
+    caps = QemuCapabilities(qemu_bin, cache_file)
+    assert probe_count(tmpdir) == count
+    assert caps.version == (4, 2, 1)
+
+    # A modified binary must be probed again
+    st = os.stat(qemu_bin)
+    os.utime(qemu_bin, (st.st_atime, st.st_mtime + 10))
+    QemuCapabilities(qemu_bin, cache_file)
+    assert probe_count(tmpdir) == 2 * count
+
+def test_missing_binary(tmpdir):
+    with pytest.raises(HypervisorError):
+        QemuCapabilities(str(tmpdir.join('nonexistent')))
+
+class FakeVM(object):
+    def __init__(self, mount_points=None, **profile):
+        self.rank = 0
+        self.mount_points = mount_points or {}
+        self.io_throttle = None
+        self.scratch_disk = None
+        self.custom_args = []
+        self.kernel = self.initrd = self.append = self.firmware = None
+        self.checkpoint_settings = {'incremental': 0}
+        self.block_profile = {'aio': 'threads',
+                              'iothreads': False,
+                              'queues': 1,
+                              'l2-cache-size': None,
+                              'discard': False,
+                              'detect-zeroes': 'off'}
+        self.block_profile.update(profile)
+
+    def get_host(self):
+        return 'node0'
+
+def test_block_profile(qemu_bin):
+    qemu = Qemu()
+    caps = QemuCapabilities(qemu_bin)
+
+    vm = FakeVM()
+    assert qemu._blk_drive_opts(vm, caps, 'unsafe', 'qcow2') == ',aio=threads'
+    assert qemu._blk_device_opts(vm, caps, 8, 'ioth0') == ''
+    assert qemu._blk_iothread(vm, caps, 'ioth0') == []
+
+    vm = FakeVM(aio='native', iothreads=True, queues='auto',
+                discard=True, **{'detect-zeroes': 'unmap',
+                                 'l2-cache-size': 4194304})
+    assert qemu._blk_drive_opts(vm, caps, 'none', 'qcow2') == (
+        ',aio=native,discard=unmap,detect-zeroes=unmap,'
+        'l2-cache-size=4194304')
+    assert qemu._blk_device_opts(vm, caps, 8, 'ioth0') == (
+        ',iothread=ioth0,num-queues=8')
+    assert qemu._blk_iothread(vm, caps, 'ioth0') == ['-object',
+                                                     'iothread,id=ioth0']
+
+    # Native aio requires direct I/O
+    assert qemu._blk_drive_opts(vm, caps, 'writeback').startswith(
+        ',aio=threads')
+
+    # io_uring is not supported by this Qemu version
+    vm = FakeVM(aio='io_uring')
+    assert qemu._blk_drive_opts(vm, caps, 'none') == ',aio=threads'
+
+def test_shared_ram(qemu_bin):
+    qemu = Qemu()
+    caps = QemuCapabilities(qemu_bin)
+
+    vm = FakeVM({'homedir': {'path': '/home'}})
+    assert qemu._ram_backend(vm, caps) == 'memory-backend-ram'
+
+    vm = FakeVM({'homedir': {'path': '/home', 'type': 'virtiofs'}})
+    assert qemu._ram_backend(vm, caps) == ('memory-backend-file,'
+                                           'mem-path=/dev/shm,share=on')
+
+def test_incremental_ram(qemu_bin, config):
+    qemu = Qemu()
+    caps = QemuCapabilities(qemu_bin)
+
+    config.batch.batchid = 42
+
+    vm = FakeVM()
+    vm.checkpoint_settings['incremental'] = 4
+    assert qemu._ram_backend(vm, caps, 1) == (
+        'memory-backend-file,mem-path=/dev/shm/pcocc-42-vm0-ram-1,share=on')
+
+    # Lazy restore maps the checkpoint privately
+    assert qemu._ram_backend(vm, caps, 0, '/ckpt/ram-vm0-0.delta') == (
+        'memory-backend-file,mem-path=/ckpt/ram-vm0-0.delta,share=off')
+
+def test_throttle_opts():
+    qemu = Qemu()
+
+    vm = FakeVM()
+    assert qemu._blk_throttle_opts(vm, 'bootdisk') == ''
+
+    vm.io_throttle = {'scope': 'vm', 'iops-total': 500,
+                      'iops-total-max': 1000, 'burst-length': 10,
+                      'bps-read': 0}
+    assert qemu._blk_throttle_opts(vm, 'bootdisk') == (
+        ',throttling.iops-total=500,throttling.iops-total-max=1000,'
+        'throttling.iops-total-max-length=10,throttling.group=vm0')
+
+    # Drive limits use a separate group
+    assert qemu._blk_throttle_opts(vm, 'datadisk0', {'bps-write': 1024}) == (
+        ',throttling.bps-write=1024,throttling.group=datadisk0')
+
+    vm.io_throttle = {'scope': 'drive', 'iops-read': 100}
+    assert qemu._blk_throttle_opts(vm, 'datadisk1') == (
+        ',throttling.iops-read=100,throttling.group=datadisk1')
+
+@pytest.mark.parametrize("fmt", ['raw', 'qcow2'])
+def test_scratch_disk(fmt, tmpdir, config):
+    vm = FakeVM()
+    vm.scratch_disk = {'size': 1 << 30, 'format': fmt,
+                       'path': str(tmpdir), 'cache': 'unsafe'}
+
+    path = Qemu()._create_scratch_disk(vm)
+    assert os.path.dirname(path) == str(tmpdir)
+    assert image_info(path)['format'] == fmt
+    assert image_info(path)['virtual-size'] == 1 << 30
+    # The file is sparse
+    assert os.stat(path).st_blocks * 512 < 1 << 20
+
+def test_boot_args(tmpdir, config):
+    qemu = Qemu()
+
+    vm = FakeVM()
+    assert qemu._boot_args(vm) == ['-boot', 'order=cd']
+    vm.firmware = 'seabios'
+    vm.custom_args = ['-boot', 'menu=on']
+    assert qemu._boot_args(vm) == []
+
+    kernel = tmpdir.join('vmlinuz')
+    kernel.write('')
+    vm.kernel = str(kernel)
+    vm.append = 'root=/dev/vda1 console=ttyS0'
+    vm.firmware = 'qboot'
+    assert qemu._boot_args(vm) == ['-bios', 'qboot.rom',
+                                   '-kernel', str(kernel),
+                                   '-append', 'root=/dev/vda1 console=ttyS0']
+
+    vm.initrd = str(tmpdir.join('missing'))
+    with pytest.raises(HypervisorError):
+        qemu._boot_args(vm)
+
+class FakeMonitor(object):
+    def __init__(self, states):
+        self.states = states
+        self.stopped = False
+        self.bandwidth = None
+        self.events = []
+        self.capabilities = {}
+
+    def set_migration_capability(self, capability, state):
+        self.capabilities[capability] = state
+
+    def start_migration(self, uri, bandwidth=None):
+        self.bandwidth = bandwidth
+
+    def stop(self):
+        self.stopped = True
+
+    def continue_migration(self, state):
+        self.events.append('continue ' + state)
+
+    def cancel_migration(self):
+        self.events.append('cancel')
+
+    def query_migration(self):
+        state = self.states.pop(0)
+        self.events.append(state['status'])
+        return json.dumps({'return': state})
+
+def active(remaining):
+    return {'status': 'active', 'ram': {'remaining': remaining,
+                                        'transferred': (4 << 30) - remaining,
+                                        'total': 4 << 30}}
+
+def test_live_memory_save(mocker):
+    mocker.patch('pcocc.Hypervisor.time.sleep')
+    qemu = Qemu()
+    vm = FakeVM()
+
+    # Stop once the dirty memory is small enough
+    mon = FakeMonitor([active(4 << 30), active(1 << 30), active(1 << 20),
+                       {'status': 'completed', 'downtime': 50}])
+    assert qemu._save_memory(vm, mon, 'exec:cat', True, 64 << 20, 300)
+    assert mon.stopped and not mon.states
+
+    # Stop at the deadline if the memory doesn't converge
+    mon = FakeMonitor([active(4 << 30), active(4 << 30),
+                       {'status': 'completed'}])
+    assert qemu._save_memory(vm, mon, 'exec:cat', True, 64 << 20, 0)
+    assert mon.stopped
+
+    # Qemu did the final pass by itself
+    mon = FakeMonitor([active(4 << 30), {'status': 'completed',
+                                         'downtime': 2000}])
+    stop_time = qemu._save_memory(vm, mon, 'exec:cat', True, 0, 300)
+    assert not mon.stopped
+    assert 1.5 < time.time() - stop_time < 10
+
+    # Progress is reported instead of printed
+    progress = []
+    mon = FakeMonitor([active(3 << 30), active(1 << 30),
+                       {'status': 'completed',
+                        'ram': {'remaining': 0, 'transferred': 5 << 30}}])
+    qemu._save_memory(vm, mon, 'exec:cat', progress=lambda *p:
+                          progress.append(p), bandwidth=100 << 20)
+    assert progress == [(1 << 30, 3 << 30), (3 << 30, 1 << 30),
+                        (5 << 30, 0)]
+    assert mon.bandwidth == 100 << 20
+
+def test_live_memory_save_switchover(mocker):
+    mocker.patch('pcocc.Hypervisor.time.sleep')
+    qemu = Qemu()
+    vm = FakeVM()
+
+    # The disk is saved while paused before the switchover
+    mon = FakeMonitor([active(4 << 30), {'status': 'pre-switchover'},
+                       {'status': 'completed'}])
+    stop_time = qemu._save_memory(vm, mon, 'exec:cat', True, 0, 300,
+                                  before_switchover=lambda:
+                                      mon.events.append('disk'))
+    assert stop_time
+    assert mon.events == ['active', 'pre-switchover', 'disk',
+                          'continue pre-switchover', 'completed']
+    assert mon.capabilities == {'pause-before-switchover': False}
+
+    # A failed disk save cancels the migration
+    def fail():
+        raise HypervisorError('backup failed')
+    mon = FakeMonitor([{'status': 'pre-switchover'}])
+    mon.cont = lambda: mon.events.append('cont')
+    with pytest.raises(CheckpointError):
+        qemu._save_memory(vm, mon, 'exec:cat', True, 0, 300,
+                          before_switchover=fail)
+    assert mon.events == ['pre-switchover', 'cancel', 'cont']
+
+def test_checkpoint_ram(tmpdir, config, mocker):
+    output = mocker.patch('pcocc.Hypervisor.subprocess_check_output')
+    output.return_value = '{0}\n'.format(3 << 20)
+    qemu = Qemu()
+    vm = FakeVM()
+    vm.checkpoint_settings['incremental'] = 4
+    config.batch.write_key('cluster/user', qemu._ram_state_key(0),
+                           '[/dev/shm/ram-0, /dev/shm/ram-1]')
+
+    # The bytes written are reported instead of printed
+    progress = []
+    qemu._checkpoint_ram(vm, str(tmpdir), progress.append)
+    assert progress == [3 << 20, 6 << 20]
+    assert output.call_args[0][0][:5] == ['ssh', 'node0', 'pcocc',
+                                          'internal', 'ckpt-ram']
+
+def test_checkpoint_ram_reuse(tmpdir, config, mocker):
+    def _ckpt_ram(cmd):
+        base = cmd[cmd.index('--base') + 1] if '--base' in cmd else None
+        return str(save_ram_delta(cmd[5], cmd[6], base))
+    mocker.patch('pcocc.Hypervisor.subprocess_check_output',
+                 side_effect=_ckpt_ram)
+
+    ram = tmpdir.join('ram')
+    ram.write('a' * (4 << 20))
+    qemu = Qemu()
+    vm = FakeVM()
+    vm.checkpoint_settings['incremental'] = 4
+    config.batch.write_key('cluster/user', qemu._ram_state_key(0),
+                           '[{0}]'.format(ram))
+
+    ckpt1 = tmpdir.mkdir('ckpt1')
+    ckpt2 = tmpdir.mkdir('ckpt2')
+    manifest = qemu._checkpoint_ram_manifest(vm, str(ckpt1), 0)
+    qemu._checkpoint_ram(vm, str(ckpt1))
+    qemu._checkpoint_ram(vm, str(ckpt2))
+    assert len(ram_chain(qemu._checkpoint_ram_manifest(vm, str(ckpt2),
+                                                       0))) == 2
+
+    # Reusing a directory of the chain starts a full delta
+    ram.write('b' * (4 << 20))
+    qemu._checkpoint_ram(vm, str(ckpt1))
+    assert len(ram_chain(manifest)) == 1
+    qemu._checkpoint_ram(vm, str(ckpt1))
+    assert len(ram_chain(manifest)) == 1
+
+    out = tmpdir.join('composed')
+    compose_ram(manifest, str(out))
+    assert out.read() == 'b' * (4 << 20)
+
+def test_hardware_description(qemu_bin):
+    qemu = Qemu()
+    caps = QemuCapabilities(qemu_bin)
+
+    def _signature(vm):
+        return hardware_signature(qemu._hardware_description(
+                vm, caps, 4096, 2, 1, False))
+
+    def _vm(mount_points=None, **profile):
+        vm = FakeVM(mount_points, **profile)
+        vm.machine_type = 'pc'
+        vm.eth_ifs = {}
+        vm.nic_model = vm.disk_model = 'virtio'
+        vm.persistent_drives = {}
+        vm.serial_ports = []
+        vm.remote_display = None
+        vm.cloud_seed = None
+        return vm
+
+    base = _signature(_vm())
+    assert _signature(_vm()) == base
+
+    # Settings which change the device model change the signature
+    vm = _vm(iothreads=True)
+    assert _signature(vm) != base
+    vm = _vm()
+    vm.cloud_seed = 'iso'
+    assert _signature(vm) != base
+    vm = _vm()
+    vm.io_throttle = {'scope': 'vm', 'iops-total': 100}
+    assert _signature(vm) != base
+    vm = _vm()
+    vm.checkpoint_settings['incremental'] = 2
+    assert _signature(vm) != base
+    assert (_signature(_vm({'home': {'path': '/home'}})) !=
+            _signature(_vm({'home': {'path': '/home', 'type': 'virtiofs'}})))
+
+    # VMs with virtiofs mounts can't be warm started
+    vm = _vm({'home': {'path': '/home', 'type': 'virtiofs'}})
+    vm.image_dir = '/images'
+    vm.vfio_ifs = {}
+    assert qemu._find_warm_snapshot(vm, base) is None
+
+def test_find_virtiofsd(tmpdir, mocker):
+    mocker.patch('pcocc.Hypervisor.find_executable', return_value=None)
+    c_daemon = tmpdir.join('c-virtiofsd')
+    c_daemon.write('#!/bin/sh\necho "    -o source=PATH"\n')
+    rust_daemon = tmpdir.join('virtiofsd')
+    rust_daemon.write('#!/bin/sh\necho "    --shared-dir <shared-dir>"\n')
+    for path in [c_daemon, rust_daemon]:
+        os.chmod(str(path), stat.S_IRWXU)
+
+    mocker.patch('pcocc.Hypervisor.VIRTIOFSD_PATHS', [str(c_daemon)])
+    with pytest.raises(HypervisorError) as err:
+        find_virtiofsd()
+    assert 'Rust virtiofsd' in str(err.value)
+
+    mocker.patch('pcocc.Hypervisor.VIRTIOFSD_PATHS', [str(c_daemon),
+                                                      str(rust_daemon)])
+    assert find_virtiofsd() == str(rust_daemon)
+
+def test_readahead_shared_image(tmpdir, mocker):
+    drop = mocker.patch('pcocc.Hypervisor.drop_cache')
+    record = mocker.patch('pcocc.Hypervisor.start_recording')
+    image = tmpdir.join('image')
+    image.write('disk')
+    cached = tmpdir.join('layer0')
+    cached.write('disk')
+
+    qemu = Qemu()
+    vm = FakeVM()
+    vm.image_path = str(image)
+    vm.image_dir = str(tmpdir)
+    vm.revision = 0
+    vm.boot_readahead = {'window': 120}
+
+    # The shared image isn't evicted from the page cache
+    qemu._setup_readahead(vm, str(image))
+    assert not drop.called and not record.called
+
+    qemu._setup_readahead(vm, str(cached))
+    drop.assert_called_once_with(str(cached))
+    assert record.called
+
+def test_save_closes_monitor(mocker):
+    monitor = mocker.patch('pcocc.Hypervisor.RemoteMonitor')
+    mon = monitor.return_value
+    mon.query_block.return_value = [{'device': 'bootdisk', 'inserted': {
+                'image': {'filename': '/tmp/snapshot'}}}]
+    mon.drive_backup.side_effect = HypervisorError('backup failed')
+
+    vm = FakeVM()
+    vm.image_path = '/images/image'
+    with pytest.raises(HypervisorError):
+        Qemu().save(vm, '/tmp/image-rev1', True, VM_FREEZE_OPT.NO)
+    assert mon.close_monitor.called
+
+def test_incremental_save_on_host(mocker, config, tmpdir):
+    image = tmpdir.join('image-rev1')
+    image.write('')
+    monitor = mocker.patch('pcocc.Hypervisor.RemoteMonitor')
+    mon = monitor.return_value
+    mon.query_block.return_value = [{'device': 'bootdisk', 'inserted': {
+                'image': {'filename': '/tmp/snapshot'},
+                'dirty-bitmaps': [{'name': 'pcocc-save'}]}}]
+    same_file = mocker.patch('pcocc.Hypervisor.subprocess.call',
+                             return_value=0)
+    check_call = mocker.patch('pcocc.Hypervisor.subprocess.check_call')
+    config.batch.write_key('cluster/user', 'state/saves/0',
+                           'path: ' + str(image))
+
+    vm = FakeVM()
+    vm.image_path = str(image)
+    Qemu().save(vm, '/local/staging/image-rev2', False, VM_FREEZE_OPT.NO)
+
+    # The last save is compared and the overlay created on the VM host
+    assert same_file.call_args[0][0][:2] == ['ssh', 'node0']
+    cmd = check_call.call_args[0][0]
+    assert cmd[:4] == ['ssh', 'node0', 'qemu-img', 'create']
+    assert cmd[-1] == '/local/staging/image-rev2'
+    assert mon.drive_backup.call_args[0][2] == 'incremental'
+
+def test_staged_save_from_image_cache(mocker, config, tmpdir):
+    image = tmpdir.join('image')
+    image.write('')
+    cache_copy = '/var/cache/pcocc/{0}/image'.format(
+        ImageCache.entry_key(str(image)))
+    monitor = mocker.patch('pcocc.Hypervisor.RemoteMonitor')
+    mon = monitor.return_value
+    mon.query_block.return_value = [{'device': 'bootdisk', 'inserted': {
+                'image': {'filename': '/tmp/snapshot',
+                          'backing-image': {'filename': cache_copy}}}}]
+    mocker.patch('pcocc.Hypervisor.subprocess.call', return_value=1)
+    check_call = mocker.patch('pcocc.Hypervisor.subprocess.check_call')
+
+    vm = FakeVM()
+    vm.image_path = str(image)
+    Qemu().save(vm, '/local/staging/image-rev1', False, VM_FREEZE_OPT.NO)
+
+    # The staged image is not visible from the client
+    cmd = check_call.call_args[0][0]
+    assert cmd[:5] == ['ssh', 'node0', 'qemu-img', 'rebase', '-u']
+    assert cmd[-1] == '/local/staging/image-rev1'
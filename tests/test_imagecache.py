@@ -0,0 +1,116 @@
+import os
+import socket
+import threading
+
+from pcocc.ImageCache import ImageCache, ImageBroadcast
+from pcocc.ImageCache import broadcast_tree, image_chain
+from pcocc.Qcow2 import create_overlay, image_info
+
+def make_chain(tmpdir):
+    base = str(tmpdir.join('image'))
+    with open(base, 'wb') as f:
+        f.write('base' * 1024)
+        f.truncate(1024 * 1024)
+    rev1 = str(tmpdir.join('image-rev1'))
+    # Relative backing file
+    create_overlay(rev1, 'image')
+    return base, rev1
+
+def test_broadcast_tree():
+    tree = broadcast_tree([3, 0, 1, 2, 4])
+    assert tree[3] == (None, [0, 1])
+    assert tree[0] == (3, [2, 4])
+    assert tree[1] == (3, [])
+    assert tree[4] == (0, [])
+
+def test_image_chain(tmpdir):
+    base, rev1 = make_chain(tmpdir)
+    assert image_chain(rev1) == [rev1, base]
+    assert image_chain(base) == [base]
+
+def fill_entry(cache, key, size):
+    tmp_dir = cache.new_entry()
+    with open(os.path.join(tmp_dir, 'layer0'), 'wb') as f:
+        f.write('x' * size)
+    cache.commit_entry(key, tmp_dir, 1)
+
+def test_eviction(tmpdir):
+    cache = ImageCache(str(tmpdir.join('cache')), 3 * 4096)
+    fill_entry(cache, 'old', 4096)
+    fill_entry(cache, 'inuse', 4096)
+    fill_entry(cache, 'new', 4096)
+    path, lock = cache.lookup('inuse')
+    assert path.endswith('layer0')
+    os.utime(os.path.join(cache.cache_dir, 'old'), (0, 0))
+    os.utime(os.path.join(cache.cache_dir, 'inuse'), (1, 1))
+
+    assert not cache.reserve(4 * 4096)
+    assert cache.reserve(4096)
+    assert cache.lookup('old') == (None, None)
+    assert cache.lookup('new')[0] is not None
+    os.utime(os.path.join(cache.cache_dir, 'new'), (0, 0))
+
+    # The entry in use was kept although it is older
+    assert not cache.reserve(3 * 4096)
+    assert cache.lookup('inuse')[0] is not None
+    lock.close()
+
+def test_transfer(tmpdir):
+    base, rev1 = make_chain(tmpdir.mkdir('shared'))
+    root_cache = ImageCache(str(tmpdir.join('root')), 1 << 30)
+    leaf_cache = ImageCache(str(tmpdir.join('leaf')), 1 << 30)
+
+    root = ImageBroadcast(root_cache, rev1, [0, 1], 2, 10)
+    leaf = ImageBroadcast(leaf_cache, rev1, [0, 1], 2, 10)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    listener.settimeout(10)
+    peers = {0: {'host': '127.0.0.1',
+                 'port': listener.getsockname()[1],
+                 'token': 'secret'}}
+
+    leaf_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    leaf_listener.bind(('127.0.0.1', 0))
+    leaf_listener.listen(1)
+
+    result = {}
+    def run_leaf():
+        result['leaf'] = leaf._transfer(leaf_listener, 'other', peers,
+                                        0, [], None, None)
+    thread = threading.Thread(target=run_leaf)
+    thread.start()
+
+    root_path, root_lock = root._transfer(listener, 'secret', peers,
+                                          None, [1], None, None)
+    thread.join()
+    leaf_path, leaf_lock = result['leaf']
+
+    for path in [root_path, leaf_path]:
+        info = image_info(path)
+        assert info['format'] == 'qcow2'
+        assert info['backing-file'] == os.path.join(os.path.dirname(path),
+                                                    'layer1')
+        with open(info['backing-file'], 'rb') as f:
+            assert f.read() == open(base, 'rb').read()
+
+    root_lock.close()
+    leaf_lock.close()
+
+def test_cleanup(config, tmpdir):
+    base, _ = make_chain(tmpdir)
+    cache = ImageCache(str(tmpdir.join('cache')), 1 << 30)
+    bcast = ImageBroadcast(cache, base, [0, 1], 3, 10)
+    config.batch.task_rank = 2
+    bcast._acknowledge(False)
+    config.batch.write_key.assert_called_with(
+        'cluster/user', 'image-cache-ack/{0}/2'.format(bcast.key), 'done')
+
+    bcast._cleanup()
+    config.batch.wait_child_count.assert_called_with(
+        'cluster/user', 'image-cache-ack/' + bcast.key, 3, timeout=10)
+    deleted = [c[0][1] for c in config.batch.delete_dir.call_args_list]
+    assert deleted == ['image-cache/' + bcast.key,
+                       'image-cache-done/' + bcast.key,
+                       'image-cache-ack/' + bcast.key]
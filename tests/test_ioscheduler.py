@@ -0,0 +1,63 @@
+import time
+import threading
+from StringIO import StringIO
+
+from pcocc.IOScheduler import IOScheduler, FilesystemWindow
+
+class FakeVM(object):
+    def __init__(self, rank, host):
+        self.rank = rank
+        self.host = host
+
+    def get_host(self):
+        return self.host
+
+def test_window():
+    window = FilesystemWindow(limit=6, initial=4)
+
+    # Grows while the aggregate throughput holds
+    window.update(100., 4)
+    assert window.size == 5
+    window.update(90., 5)
+    assert window.size == 6
+    window.update(80., 6)
+    assert window.size == 6
+
+    # Halves when the aggregate throughput drops
+    window.update(20., 6)
+    assert window.size == 3
+
+    # Windows which are not filled don't grow
+    window.update(100., 1)
+    assert window.size == 3
+
+def test_scheduler():
+    vms = [FakeVM(i, 'node{0}'.format(i % 2)) for i in range(16)]
+    lock = threading.Lock()
+    running = {'hosts': {}, 'fs': 0}
+    peak = {'hosts': 0, 'fs': 0}
+
+    def _func(vm, report):
+        with lock:
+            running['hosts'][vm.host] = running['hosts'].get(vm.host, 0) + 1
+            running['fs'] += 1
+            peak['hosts'] = max(peak['hosts'], running['hosts'][vm.host])
+            peak['fs'] = max(peak['fs'], running['fs'])
+        report(1000, 1000)
+        time.sleep(0.02)
+        with lock:
+            running['hosts'][vm.host] -= 1
+            running['fs'] -= 1
+        if vm.rank == 5:
+            raise ValueError('disk full')
+        return 2000
+
+    out = StringIO()
+    scheduler = IOScheduler(2, {'/shared': 3}, out=out)
+    errors = scheduler.run(vms, _func, lambda vm: '/shared', 'Checkpointing')
+
+    assert errors.keys() == [5]
+    assert peak == {'hosts': 2, 'fs': 3}
+    assert 1 <= scheduler.windows['/shared'].size <= 3
+    assert out.getvalue().startswith('Checkpointing: 16/16 VMs done, '
+                                     '0 running, 30.3 KB')
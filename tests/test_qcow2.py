@@ -0,0 +1,94 @@
+import struct
+import pytest
+
+from pcocc.Qcow2 import create_overlay, set_backing_file, image_info
+from pcocc.Qcow2 import create_image
+from pcocc.Qcow2 import Qcow2Error
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    fields = struct.unpack('>4sIQIIQIIQQIIQQQQII', data[:104])
+    return data, fields
+
+@pytest.fixture
+def raw_image(tmpdir):
+    path = str(tmpdir.join('base.raw'))
+    with open(path, 'wb') as f:
+        f.truncate(10 * 1024 * 1024 * 1024 + 512)
+    return path
+
+def test_create_overlay(tmpdir, raw_image):
+    path = str(tmpdir.join('overlay'))
+    create_overlay(path, raw_image, lazy_refcounts=True)
+
+    data, fields = read_header(path)
+    (magic, version, backing_offset, backing_size, cluster_bits, size,
+     _, l1_size, l1_offset, rt_offset, rt_clusters, _, _,
+     incompat, compat, _, refcount_order, header_length) = fields
+
+    assert magic == 'QFI\xfb'
+    assert version == 3
+    assert cluster_bits == 16
+    assert size == 10 * 1024 * 1024 * 1024 + 512
+    # 64K clusters with 8K entries per L2 table map 512M per L1 entry
+    assert l1_size == 21
+    assert compat == 1
+    assert incompat == 0
+    assert refcount_order == 4
+    assert data[backing_offset:backing_offset + backing_size] == raw_image
+    assert 'raw' in data[header_length:backing_offset]
+    assert len(data) == 4 * 65536
+
+    # Every allocated cluster has a refcount of 1
+    rb_offset = struct.unpack('>Q', data[rt_offset:rt_offset + 8])[0]
+    refcounts = struct.unpack('>4H', data[rb_offset:rb_offset + 8])
+    assert refcounts == (1, 1, 1, 1)
+    assert data[l1_offset:l1_offset + l1_size * 8] == '\x00' * l1_size * 8
+
+    info = image_info(path)
+    assert info['format'] == 'qcow2'
+    assert info['virtual-size'] == size
+    assert info['backing-file'] == raw_image
+
+def test_overlay_chain(tmpdir, raw_image):
+    top = str(tmpdir.join('top'))
+    middle = str(tmpdir.join('middle'))
+    create_overlay(middle, raw_image, cluster_size=4096)
+    create_overlay(top, middle)
+
+    data, _ = read_header(top)
+    assert 'qcow2' in data
+    assert image_info(top)['virtual-size'] == image_info(raw_image)['virtual-size']
+
+def test_create_image(tmpdir):
+    path = str(tmpdir.join('scratch'))
+    create_image(path, 1024 * 1024 * 1024)
+
+    data, fields = read_header(path)
+    assert fields[2] == 0
+    assert fields[3] == 0
+    assert image_info(path) == {'format': 'qcow2',
+                                'virtual-size': 1024 * 1024 * 1024,
+                                'backing-file': None}
+
+def test_invalid_cluster_size(tmpdir, raw_image):
+    with pytest.raises(Qcow2Error):
+        create_overlay(str(tmpdir.join('overlay')), raw_image,
+                       cluster_size=3000)
+
+def test_set_backing_file(tmpdir, raw_image):
+    path = str(tmpdir.join('overlay'))
+    create_overlay(path, raw_image)
+
+    new_base = str(tmpdir.join('new_base.qcow2'))
+    create_overlay(new_base, raw_image)
+    set_backing_file(path, new_base)
+
+    data, _ = read_header(path)
+    assert image_info(path)['backing-file'] == new_base
+    assert 'qcow2' in data[104:200]
+    assert 'raw' not in data[104:200]
+
+    set_backing_file(path, '')
+    assert image_info(path)['backing-file'] is None
@@ -0,0 +1,47 @@
+import os
+
+from pcocc.Readahead import merge_extents, resident_extents, prefetch
+from pcocc.Readahead import load_trace, save_trace, claim_recording
+from pcocc.Readahead import PAGE_SIZE
+
+def test_merge_extents():
+    extents = [[8192, 4096], [0, 4096], [4096, 4096], [1 << 20, 4096]]
+    assert merge_extents(extents) == [[0, 12288], [1 << 20, 4096]]
+    assert merge_extents(extents, 1 << 20) == [[0, (1 << 20) + 4096]]
+
+def test_resident_extents(tmpdir):
+    path = str(tmpdir.join('image'))
+    with open(path, 'wb') as f:
+        f.write('x' * 4 * PAGE_SIZE)
+
+    # A file we just wrote is in the page cache
+    assert resident_extents(path) == [[0, 4 * PAGE_SIZE]]
+
+def test_trace(tmpdir):
+    image = str(tmpdir.join('image-rev1'))
+    base = str(tmpdir.join('image'))
+    for path in [image, base]:
+        with open(path, 'wb') as f:
+            f.write('x' * 3 * PAGE_SIZE)
+
+    trace_path = str(tmpdir.join('readahead-rev1'))
+    assert load_trace(trace_path, image, [image, base]) is None
+
+    layers = [[[0, PAGE_SIZE]], [[PAGE_SIZE, 2 * PAGE_SIZE]]]
+    save_trace(trace_path, image, layers)
+    assert load_trace(trace_path, image, [image, base]) == layers
+    assert prefetch([image, base], layers) == 3 * PAGE_SIZE
+
+    # The chain doesn't match
+    assert load_trace(trace_path, image, [image]) is None
+
+    # The image was modified
+    os.utime(image, (0, 0))
+    assert load_trace(trace_path, image, [image, base]) is None
+
+def test_claim_recording(tmpdir):
+    trace_path = str(tmpdir.join('readahead-rev1'))
+    assert claim_recording(trace_path)
+    assert not claim_recording(trace_path)
+    os.utime(trace_path + '.recording', (0, 0))
+    assert claim_recording(trace_path)
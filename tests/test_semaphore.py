@@ -0,0 +1,62 @@
+import os
+import time
+
+from pcocc.Misc import KeySemaphore
+from conftest import kvstore
+
+def test_semaphore(config):
+    sem = KeySemaphore('test/sem', 2)
+
+    assert sem.try_acquire(0) == 0
+    assert sem.try_acquire(1) == 0
+    # Acquiring again is a no-op
+    assert sem.try_acquire(1) == 0
+
+    # Waiters are queued in arrival order
+    assert sem.try_acquire(2) == 1
+    assert sem.try_acquire(3) == 2
+    assert sem.try_acquire(3) == 2
+
+    # The first waiter gets the free slot
+    sem.release(0)
+    assert sem.try_acquire(3) == 2
+    assert sem.try_acquire(2) == 0
+    assert sem.try_acquire(3) == 1
+
+    sem.release(1)
+    assert sem.try_acquire(3) == 0
+
+def test_semaphore_stale(config, mocker):
+    sem = KeySemaphore('test/stale', 1, stale_delay=100, wait_delay=10)
+    now = time.time()
+    clock = mocker.patch('pcocc.Misc.time.time')
+
+    clock.return_value = now
+    assert sem.try_acquire(0) == 0
+    assert sem.try_acquire(1) == 1
+    assert sem.try_acquire(2) == 2
+
+    # Waiter 1 stopped polling
+    clock.return_value = now + 20
+    assert sem.try_acquire(2) == 1
+
+    # Holder 0 died without releasing the semaphore
+    clock.return_value = now + 200
+    assert sem.try_acquire(2) == 0
+
+def test_semaphore_acquire(config):
+    sem = KeySemaphore('test/acquire', 1)
+    config.batch.read_key_index.side_effect = lambda kt, k: (
+        kvstore.get(os.path.join(kt, k)), 1)
+    assert sem.try_acquire(0) == 0
+
+    # The waiter blocks on the key until the holder releases it
+    def _release(*args, **kwargs):
+        sem.release(0)
+    config.batch.wait_key_index.side_effect = _release
+
+    positions = []
+    sem.acquire(1, positions.append)
+    assert positions == [1]
+    assert config.batch.wait_key_index.call_count == 1
+    assert config.batch.atom_update_key.call_count == 4
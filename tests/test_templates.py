@@ -43,6 +43,11 @@ def test_template_inheritance(datadir, config):
     ('templates_bad_herit.yaml', 'inherits from invalid template'),
     ('templates_bad_rset.yaml', 'invalid resource set'),
     ('templates_bad_name.yaml', 'restricted'),
+    ('templates_bad_mount.yaml', 'invalid type'),
+    ('templates_bad_throttle.yaml', 'cannot be combined'),
+    ('templates_bad_cloudseed.yaml', 'invalid cloud-seed'),
+    ('templates_bad_readahead.yaml', 'window must be'),
+    ('templates_bad_prefetch.yaml', 'prefetch requires staging-dir'),
 ])
 def test_bad_templates(conf_file, expected_error, datadir, config):
     config.tpls = TemplateConfig()
@@ -69,6 +74,20 @@ emulator-cores    No           2
 resource-set      No           default
 remote-display    No           spice
 instance-id       No           example
+cloud-seed        No           smbios
+overlay           No           {'path': '/dev/shm'}
+image-cache       No           {}
+boot-readahead    No           {'window': 60}
+block-profile     No           {'iothreads': True}
+io-throttle       No           {'iops-total': 500}
+scratch-disk      No           {'size': 1073741824}
+auto-compact      No           5
+kernel            No           /boot/vmlinuz
+initrd            No           /boot/initrd.img
+append            No           console=ttyS0
+firmware          No           qboot
+warm-start        No           True
+checkpoint        No           {'codec': 'zstd'}
 mount-points      No           {'homedir': {'path': '/home'}}
 qemu-bin          No           /path/to/qemu/bin/qemu-system-x86
 custom-args       No           ['-cdrom', '/path/to/my-iso']
@@ -87,6 +106,20 @@ full-node         Yes          True
 inherits          No           example
 nic-model         Yes          e1000
 instance-id       Yes          example
+cloud-seed        Yes          smbios
+overlay           Yes          {'path': '/dev/shm'}
+image-cache       Yes          {}
+boot-readahead    Yes          {'window': 60}
+block-profile     Yes          {'iothreads': True}
+io-throttle       Yes          {'iops-total': 500}
+scratch-disk      Yes          {'size': 1073741824}
+auto-compact      Yes          5
+kernel            Yes          /boot/vmlinuz
+initrd            Yes          /boot/initrd.img
+append            Yes          console=ttyS0
+firmware          Yes          qboot
+warm-start        Yes          True
+checkpoint        Yes          {'codec': 'zstd'}
 custom-args       Yes          ['-cdrom', '/path/to/my-iso']
 resource-set      Yes          default
 disk-cache        Yes          writeback
@@ -0,0 +1,51 @@
+import os
+import pytest
+
+from pcocc.WarmStart import snapshot_paths, save_manifest, load_manifest
+from pcocc.WarmStart import hardware_signature, identity_script
+from pcocc.WarmStart import WarmStartError
+
+def test_manifest(tmpdir):
+    image = str(tmpdir.join('image-rev2'))
+    tmpdir.join('image-rev2').write('disk')
+    signature = hardware_signature({'memory': 4096, 'cpus': 2,
+                                    'networks': ['eth0']})
+
+    mem_path, manifest_path = snapshot_paths(image)
+    assert mem_path == str(tmpdir.join('warm-image-rev2'))
+    assert manifest_path == mem_path + '.yaml'
+    assert load_manifest(image, signature) is None
+
+    save_manifest(image, signature, {'eth0': '52:54:00:00:00:01'})
+
+    # The memory file is missing
+    with pytest.raises(WarmStartError):
+        load_manifest(image, signature)
+
+    tmpdir.join('warm-image-rev2').write('memory')
+    manifest = load_manifest(image, signature)
+    assert manifest['memory'] == mem_path
+    assert manifest['macs'] == {'eth0': '52:54:00:00:00:01'}
+
+    with pytest.raises(WarmStartError):
+        load_manifest(image, hardware_signature({'memory': 8192, 'cpus': 2,
+                                                 'networks': ['eth0']}))
+
+    # The snapshot belongs to another revision of the image
+    st = os.stat(image)
+    os.utime(image, (st.st_atime, st.st_mtime + 10))
+    with pytest.raises(WarmStartError):
+        load_manifest(image, signature)
+
+def test_identity_script():
+    script = identity_script('vm3.cluster',
+                             {'eth0': '52:54:00:00:00:01',
+                              'ib0': '52:54:00:00:00:02'},
+                             {'eth0': '52:54:00:00:00:0A',
+                              'ib0': '52:54:00:00:00:02'})
+
+    assert 'hostname vm3.cluster\n' in script
+    assert '"52:54:00:00:00:01"' in script
+    assert 'address 52:54:00:00:00:0a' in script
+    # Unchanged interfaces are left alone
+    assert '52:54:00:00:00:02' not in script